@@ -0,0 +1,354 @@
+from archive import iter_events
+from contextlib import contextmanager
+from models import Game, GameEvent, sqlbuilder, sqlhub
+import atexit
+import calendar
+import fcntl
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Vectorized queries need NumPy, which is optional; /analytics responds 501
+# Not Implemented without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The columns of the snapshot, see EventSnapshot, and their types. Null ids
+# are stored as -1, event and game types as their index in the column's
+# enumValues, and timestamps as seconds since the epoch, UTC.
+SNAPSHOT_COLUMNS = (
+    ('id', 'int64'),
+    ('game', 'int32'),
+    ('player', 'int32'),
+    ('to', 'int32'),
+    ('eventType', 'int8'),
+    ('timestamp', 'int64'),
+)
+
+# Seconds between checks for new events to add to the snapshot
+DEFAULT_ANALYTICS_REFRESH = 5
+
+# Events read from the database and appended to the snapshot at once
+APPEND_PAGE_SIZE = 10000
+
+# Number of event ids before the last one in the snapshot that are read again
+# on each refresh, see EventSnapshot
+DEFAULT_RECHECK_IDS = 10000
+
+# The timestamp of events that don't have one
+NULL_TIME = -2 ** 63
+
+# Names that ?group-by= accepts, and ?interval= in seconds
+GROUP_BY = ('game-type', 'event-type', 'game-id', 'player-id', 'to-id')
+INTERVALS = {'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800}
+
+EVENT_TYPES = GameEvent.sqlmeta.columns['eventType'].enumValues
+GAME_TYPES = Game.sqlmeta.columns['gameType'].enumValues
+
+
+class EventSnapshot(object):
+    """A columnar copy of every event, kept in memory-mapped NumPy arrays so
+    aggregates over millions of events are a few vectorized operations.
+
+    Each column is a file of fixed size values in directory, appended to as
+    events are written; refresh() reads the events after the last one in the
+    snapshot, at most every refreshInterval seconds. Several processes can
+    share a directory: appends are made under a lock file, and meta.json
+    says how many rows are complete. Without a directory, a temporary one is
+    used for this process.
+
+    Events are only ever added. Those of deleted games are left out of
+    queries, as their game no longer exists, but changes to events aren't
+    seen until the directory is deleted and the snapshot built again. Each
+    game's type is looked up on refresh too, see gameTypes.
+
+    Databases other than SQLite hand out ids before the events commit, so
+    an event can commit after one with a larger id was appended. Each refresh
+    reads the last recheckIds ids again and appends any that are missing;
+    events that commit later than that are left out. With SQLite, which
+    commits one write at a time, recheckIds defaults to 0."""
+
+    def __init__(self, directory, refreshInterval=DEFAULT_ANALYTICS_REFRESH, recheckIds=None):
+        self.directory = directory
+        self.refreshInterval = refreshInterval
+        self.recheckIds = recheckIds
+        self.lock = threading.Lock()
+        self.columns = None
+        self.gameTypes = None
+        self.count = 0
+        self.lastEventId = None
+        self.refreshed = 0
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def refresh(self, force=False):
+        """Appends any new events, and returns a dict of the columns' arrays"""
+        with self.lock:
+            if self.columns is not None and not force and time.time() - self.refreshed < self.refreshInterval:
+                return self.columns
+
+            with self.locked():
+                count, lastEventId = self.read_meta()
+                self.truncate(count)
+
+                after = lastEventId
+                known = set()
+                recheckIds = self.recheckIds
+                if recheckIds is None:
+                    recheckIds = 0 if sqlhub.getConnection().dbName == 'sqlite' else DEFAULT_RECHECK_IDS
+                if recheckIds and lastEventId is not None:
+                    after = max(lastEventId - recheckIds, 0)
+                    ids = self.map(count)['id']
+                    known = set(ids[ids > after].tolist())
+
+                rows = iter_events(APPEND_PAGE_SIZE, after)
+                while True:
+                    page = list(itertools.islice(rows, APPEND_PAGE_SIZE))
+                    if not page:
+                        break
+
+                    lastEventId = max(lastEventId, page[-1][0])
+                    page = [row for row in page if row[0] not in known]
+                    if page:
+                        self.append(page)
+                        count += len(page)
+                        self.write_meta(count, lastEventId)
+
+            self.columns = self.map(count)
+            self.gameTypes = game_types()
+            self.count = count
+            self.lastEventId = lastEventId
+            self.refreshed = time.time()
+            return self.columns
+
+    @contextmanager
+    def locked(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='ledgerman-analytics-')
+            atexit.register(shutil.rmtree, self.directory, True)
+        elif not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        with open(self.path('lock'), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def read_meta(self):
+        try:
+            with open(self.path('meta.json')) as f:
+                meta = json.load(f)
+        except IOError:
+            return 0, None
+
+        if meta.get('columns') != [name for name, dtype in SNAPSHOT_COLUMNS]:
+            return 0, None
+        return meta['count'], meta['lastEventId']
+
+    def write_meta(self, count, lastEventId):
+        # Replaced atomically, so readers never see a partly written file
+        with open(self.path('meta.json.tmp'), 'w') as f:
+            json.dump({'columns': [name for name, dtype in SNAPSHOT_COLUMNS], 'count': count,
+                       'lastEventId': lastEventId}, f)
+        os.rename(self.path('meta.json.tmp'), self.path('meta.json'))
+
+    def truncate(self, count):
+        """Drops anything after the first count rows, left by an append that didn't finish"""
+        for name, dtype in SNAPSHOT_COLUMNS:
+            with open(self.path(name), 'ab') as f:
+                f.truncate(count * numpy.dtype(dtype).itemsize)
+
+    def append(self, rows):
+        for name, values in zip([name for name, dtype in SNAPSHOT_COLUMNS], column_arrays(rows)):
+            with open(self.path(name), 'ab') as f:
+                f.write(values.tostring())
+
+    def map(self, count):
+        columns = {}
+        for name, dtype in SNAPSHOT_COLUMNS:
+            if count:
+                columns[name] = numpy.memmap(self.path(name), dtype=dtype, mode='r', shape=(count,))
+            else:
+                columns[name] = numpy.zeros(0, dtype=dtype)
+        return columns
+
+
+# Positions of the snapshot's columns in the rows read by iter_events()
+ROW_INDEXES = dict((col.name, GameEvent.sqlmeta.columnList.index(col) + 1)
+                   for col in GameEvent.sqlmeta.columnList)
+EVENT_TYPE_CODES = dict((eventType, code) for code, eventType in enumerate(EVENT_TYPES))
+
+
+def column_arrays(rows):
+    """Converts event rows, as read by select_rows(), to an array per column"""
+    arrays = []
+    for name, dtype in SNAPSHOT_COLUMNS:
+        if name == 'id':
+            values = [row[0] for row in rows]
+        elif name == 'eventType':
+            values = [EVENT_TYPE_CODES.get(row[ROW_INDEXES['eventType']], -1) for row in rows]
+        elif name == 'timestamp':
+            # NumPy parses the strings SQLite returns, or datetimes; nulls become NaT
+            values = numpy.array([row[ROW_INDEXES['timestamp']] for row in rows], dtype='datetime64[s]')
+            values = values.astype('int64')
+        else:
+            index = ROW_INDEXES[name + 'ID']
+            values = [-1 if row[index] is None else row[index] for row in rows]
+
+        arrays.append(numpy.asarray(values, dtype=dtype))
+
+    return arrays
+
+
+def game_types():
+    """Returns an array of each game's game type code, indexed by game id,
+    with -1 for ids that aren't games"""
+    conn = sqlhub.getConnection()
+    rows = conn.queryAll(conn.sqlrepr(sqlbuilder.Select([Game.q.id, Game.q.gameType])))
+    lookup = numpy.full(max([gameId for gameId, gameType in rows] or [0]) + 2, -1, dtype='int8')
+    for gameId, gameType in rows:
+        lookup[gameId] = GAME_TYPES.index(gameType) if gameType in GAME_TYPES else -1
+    return lookup
+
+
+def aggregate(columns, filters, groupBy=(), interval=None, lookup=None):
+    """Counts the events in the snapshot columns matching filters, a dict of
+    ?group-by= names to lists of values plus optional 'since' and 'until'
+    epoch seconds, grouped by the groupBy names and by interval seconds.
+    lookup is the array from game_types(), e.g. EventSnapshot.gameTypes,
+    which is read if it isn't given.
+
+    Returns a list of dicts of the group's values and its count, in order."""
+    if lookup is None:
+        lookup = game_types()
+
+    # Events of deleted games, and any since, have no game type
+    gameIds = columns['game']
+    gameType = lookup[numpy.clip(gameIds, 0, len(lookup) - 1)]
+    mask = gameType >= 0
+
+    values = {
+        'game-type': gameType,
+        'event-type': columns['eventType'],
+        'game-id': gameIds,
+        'player-id': columns['player'],
+        'to-id': columns['to'],
+    }
+    for name, wanted in filters.iteritems():
+        if name == 'since':
+            mask &= columns['timestamp'] >= wanted
+        elif name == 'until':
+            mask &= columns['timestamp'] < wanted
+        else:
+            mask &= numpy.in1d(values[name], wanted)
+
+    if interval:
+        mask &= columns['timestamp'] != NULL_TIME
+
+    keys = [(name, values[name][mask]) for name in groupBy]
+    if interval:
+        keys.append(('time', columns['timestamp'][mask] // interval))
+
+    if not keys:
+        return [{'count': int(mask.sum())}]
+
+    # Give each combination of the keys' values a number, in order, then
+    # count them with bincount(), or with unique() if there are too many to
+    # count in an array
+    combined = numpy.zeros(len(keys[0][1]), dtype='int64')
+    dims = []
+    offsets = []
+    for name, key in keys:
+        low, high = (int(key.min()), int(key.max())) if len(key) else (0, 0)
+        size = high - low + 1
+        if reduce(lambda x, y: x * y, dims, size) >= 2 ** 62:
+            raise ValueError('Too many groups, add filters or group by less')
+
+        combined = combined * size + (key - low)
+        dims.append(size)
+        offsets.append(low)
+
+    if reduce(lambda x, y: x * y, dims) <= max(len(combined) * 4, 1 << 20):
+        counts = numpy.bincount(combined, minlength=1)
+        codes = numpy.flatnonzero(counts)
+        counts = counts[codes]
+    else:
+        codes, counts = numpy.unique(combined, return_counts=True)
+
+    groups = numpy.unravel_index(codes, dims) if len(codes) else [[]] * len(keys)
+    results = []
+    for i, count in enumerate(counts):
+        result = dict((name, decode(name, group[i] + low, interval))
+                      for (name, key), group, low in zip(keys, groups, offsets))
+        result['count'] = int(count)
+        results.append(result)
+
+    return results
+
+
+def decode(name, value, interval):
+    """Converts a group's value in the snapshot back to what the API uses"""
+    value = int(value)
+    if name == 'game-type':
+        return GAME_TYPES[value]
+    elif name == 'event-type':
+        return EVENT_TYPES[value] if value >= 0 else None
+    elif name == 'time':
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(value * interval))
+    return value if value >= 0 else None
+
+
+def parse_filters(params):
+    """Converts query string parameters into filters for aggregate()"""
+    filters = {}
+    for name in GROUP_BY:
+        value = params.get(name)
+        if value is None:
+            continue
+
+        wanted = []
+        for x in value if type(value) is list else [value]:
+            if name == 'game-type':
+                if x not in GAME_TYPES:
+                    raise ValueError("'game-type' must be one of {0}".format(', '.join(GAME_TYPES)))
+                wanted.append(GAME_TYPES.index(x))
+            elif name == 'event-type':
+                if x not in EVENT_TYPES:
+                    raise ValueError("'event-type' must be one of {0}".format(', '.join(EVENT_TYPES)))
+                wanted.append(EVENT_TYPES.index(x))
+            elif x == 'null':
+                wanted.append(-1)
+            else:
+                wanted.append(GameEvent.parse_id_value(name, x))
+        filters[name] = wanted
+
+    for name in ('since', 'until'):
+        value = params.get(name)
+        if type(value) is list:
+            raise ValueError("'{0}' must be a single value".format(name))
+        if value is not None:
+            filters[name] = calendar.timegm(GameEvent.parse_datetime(name, value).utctimetuple())
+
+    return filters
+
+
+def init_snapshot():
+    """Returns the EventSnapshot kept in LEDGERMAN_ANALYTICS_DIR, or in a
+    temporary directory for this process, or None without NumPy"""
+    if numpy is None:
+        return None
+
+    return EventSnapshot(os.environ.get('LEDGERMAN_ANALYTICS_DIR') or None,
+                         float(os.environ.get('LEDGERMAN_ANALYTICS_REFRESH', DEFAULT_ANALYTICS_REFRESH)))
+
+
+snapshot = init_snapshot()
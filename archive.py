@@ -0,0 +1,367 @@
+from collections import OrderedDict
+from models import GameEvent, LedgermanModel, format_datetime, sqlbuilder, sqlhub, transaction
+from sqlobject import BLOBCol, IN, IntCol, NoDefault, SODateTimeCol
+import bisect
+import heapq
+import itertools
+import json
+import os
+import threading
+import zlib
+
+# Set LEDGERMAN_ARCHIVE=1 to archive a game's events as soon as it's marked
+# inactive, see archive_game()
+archiveGames = bool(int(os.environ.get('LEDGERMAN_ARCHIVE', 0)))
+
+# Number of decoded archives kept in memory, see ArchiveCache
+DEFAULT_ARCHIVE_CACHE_SIZE = 64
+
+
+class GameArchive(LedgermanModel):
+    """The events of a game that's no longer active, compressed into one row.
+    Shares its id with the Game.
+
+    data is the zlib compressed JSON of the events' rows, as read by
+    GameEvent.select_rows(), and the names of their columns. Archives are
+    never changed, only replaced when a game that was made active again is
+    archived again. The game_archive_player table lists the players with
+    events in each archive."""
+    events = IntCol()
+    firstEventId = IntCol()
+    lastEventId = IntCol()
+    data = BLOBCol()
+
+
+class Archive(object):
+    """A decoded archive: its rows in id order, and their ids to search"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.ids = [row[0] for row in rows]
+
+    def rows_after(self, after):
+        """Generates the rows after the event id after"""
+        start = 0 if after is None else bisect.bisect_right(self.ids, after)
+        return itertools.islice(self.rows, start, None)
+
+    def find(self, eventId):
+        i = bisect.bisect_left(self.ids, eventId)
+        return self.rows[i] if i < len(self.ids) and self.ids[i] == eventId else None
+
+
+class ArchiveCache(object):
+    """An LRU cache of decoded archives, so paging through archived events
+    doesn't decompress and parse the same archives for every page.
+
+    Entries are keyed on the game id and the id of the archive's last event.
+    Archives are never changed, only replaced by ones with more events, so
+    an entry can't be found once its archive has been replaced."""
+
+    def __init__(self, maxSize=DEFAULT_ARCHIVE_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            archive = self.entries.pop(key, None)
+            if archive is not None:
+                self.entries[key] = archive
+            return archive
+
+    def put(self, key, archive):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = archive
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+
+archiveCache = ArchiveCache(int(os.environ.get('LEDGERMAN_ARCHIVE_CACHE_SIZE', DEFAULT_ARCHIVE_CACHE_SIZE)))
+
+
+def archive_game(gameId, conn=None):
+    """Moves gameId's events from the game_event table into its archive,
+    along with any that are already archived, and returns how many were moved.
+
+    Should be run in the transaction that makes the game inactive, so events
+    are never in neither place."""
+    if conn is None:
+        conn = sqlhub.getConnection()
+
+    archive = load_archive(gameId, conn)
+    rows, nextAfter = GameEvent.select_rows(None, [GameEvent.q.gameID == gameId], conn=conn)
+    if not rows:
+        return 0
+
+    archived = list(archive.rows) if archive is not None else []
+    archived.extend(canonical_row(row) for row in rows)
+    archived.sort(key=row_id)
+    data = zlib.compress(json.dumps({
+        'columns': [col.name for col in GameEvent.sqlmeta.columnList],
+        'rows': archived,
+    }, separators=(',', ':')))
+
+    delete_archive(gameId, conn)
+    conn.query(conn.sqlrepr(sqlbuilder.Insert(GameArchive.sqlmeta.table, values={
+        GameArchive.sqlmeta.idName: gameId,
+        GameArchive.sqlmeta.columns['events'].dbName: len(archived),
+        GameArchive.sqlmeta.columns['firstEventId'].dbName: archived[0][0],
+        GameArchive.sqlmeta.columns['lastEventId'].dbName: archived[-1][0],
+        GameArchive.sqlmeta.columns['data'].dbName: conn.createBinary(data),
+    })))
+
+    for playerId in set(row[PLAYER_ID] for row in archived if row[PLAYER_ID] is not None):
+        conn.query(conn.sqlrepr(sqlbuilder.Insert('game_archive_player', values={
+            'game_id': gameId, 'player_id': playerId})))
+
+    # Event ids are never reused, as game_event's ids autoincrement (see
+    # migrations.autoincrement_event_ids()), so all of them can go
+    conn.query(conn.sqlrepr(sqlbuilder.Delete(GameEvent.sqlmeta.table, where=GameEvent.q.gameID == gameId)))
+
+    return len(rows)
+
+
+def load_archive(gameId, conn=None, lastEventId=None):
+    """Returns gameId's Archive, or None if it hasn't been archived.
+
+    Decoded archives are cached, see ArchiveCache; lastEventId, if it's
+    already known, saves looking it up to find the archive there."""
+    if conn is None:
+        conn = sqlhub.getConnection()
+
+    if lastEventId is None:
+        row = conn.queryOne(conn.sqlrepr(sqlbuilder.Select(
+            [GameArchive.q.lastEventId], where=GameArchive.q.id == gameId)))
+        if row is None:
+            return None
+        lastEventId = row[0]
+
+    key = (gameId, lastEventId)
+    archive = archiveCache.get(key)
+    if archive is not None:
+        return archive
+
+    row = conn.queryOne(conn.sqlrepr(sqlbuilder.Select(
+        [GameArchive.q.lastEventId, GameArchive.q.data], where=GameArchive.q.id == gameId)))
+    if row is None:
+        return None
+
+    lastEventId, data = row
+
+    # SQLObject keeps BLOBs base64 encoded in SQLite
+    data = conn.module.decode(data) if conn.dbName == 'sqlite' else str(data)
+    decoded = json.loads(zlib.decompress(data))
+
+    # Columns added since the game was archived are null
+    positions = dict((name, i + 1) for i, name in enumerate(decoded['columns']))
+    indexes = [positions.get(col.name) for col in GameEvent.sqlmeta.columnList]
+    archive = Archive([[row[0]] + [row[i] if i is not None else None for i in indexes]
+                       for row in decoded['rows']])
+
+    archiveCache.put((gameId, lastEventId), archive)
+    return archive
+
+
+def delete_archive(gameId, conn=None):
+    if conn is None:
+        conn = sqlhub.getConnection()
+
+    conn.query(conn.sqlrepr(sqlbuilder.Delete(GameArchive.sqlmeta.table, where=GameArchive.q.id == gameId)))
+    conn.query(conn.sqlrepr(sqlbuilder.Delete(
+        'game_archive_player', where=sqlbuilder.Field('game_archive_player', 'game_id') == gameId)))
+
+
+def select_events(gameId, columns, filters, after=None, limit=None):
+    """Like GameEvent.select_rows() for gameId's events, with filters from
+    GameEvent.parse_filters(), but reads archived events from the archive"""
+    return select_archived([gameId], [('gameID', '==', gameId)] + filters, columns, after, limit)
+
+
+def select_player_events(playerId, columns, filters, after=None, limit=None):
+    """Like select_events() for the events by playerId, in any game"""
+    conn = sqlhub.getConnection()
+    gameIds = conn.queryAll(conn.sqlrepr(sqlbuilder.Select(
+        [sqlbuilder.Field('game_archive_player', 'game_id')],
+        where=sqlbuilder.Field('game_archive_player', 'player_id') == playerId)))
+
+    return select_archived([gameId for gameId, in gameIds], [('playerID', '==', playerId)] + filters,
+                           columns, after, limit)
+
+
+def select_all_events(columns, filters, after=None, limit=None):
+    """Like select_events() for every game's events, as GET /events lists them"""
+    for attrName, op, value in filters:
+        if attrName == 'gameID' and op == '==' and value is not None:
+            return select_archived([value], filters, columns, after, limit)
+        if attrName == 'playerID' and op == '==' and value is not None:
+            return select_player_events(value, columns, filters, after, limit)
+
+    return select_archived(None, filters, columns, after, limit)
+
+
+def select_archived(gameIds, filters, columns, after, limit):
+    """Selects the events matching filters as GameEvent.select_rows() would,
+    reading the events of the games gameIds, or of every game if it's None,
+    from their archives and the rest from game_event"""
+    if gameIds is not None and not gameIds:
+        return GameEvent.select_rows(columns, GameEvent.filter_clauses(filters), after, limit)
+
+    rows = list(itertools.islice(merge_events(gameIds, filters, after, limit + 1 if limit else 1000),
+                                 limit + 1 if limit else None))
+
+    nextAfter = None
+    if limit and len(rows) > limit:
+        nextAfter = rows[limit - 1][0]
+        rows = rows[:limit]
+
+    return project_rows(rows, columns), nextAfter
+
+
+def iter_events(pageSize=1000, after=None):
+    """Generates every event after the id after in id order, as
+    GameEvent.iter_rows() would, merging the archived ones in"""
+    return merge_events(None, [], after, pageSize)
+
+
+def merge_events(gameIds, filters, after, pageSize):
+    """Generates the events after the id after that match filters in id
+    order, merging the events in game_event, read pageSize at a time, with
+    those in the archives of the games gameIds, or of every game if it's None.
+
+    Archives are loaded in the order of their first events, once the merge
+    gets to them, so a page only loads the archives it overlaps and only
+    those of games that overlap are held at once."""
+    conn = sqlhub.getConnection()
+    where = []
+    if after is not None:
+        where.append(GameArchive.q.lastEventId > after)
+    if gameIds is not None:
+        where.append(IN(GameArchive.q.id, list(gameIds)))
+    archives = conn.queryAll(conn.sqlrepr(sqlbuilder.Select(
+        [GameArchive.q.id, GameArchive.q.firstEventId, GameArchive.q.lastEventId],
+        where=sqlbuilder.AND(*where) if where else NoDefault,
+        orderBy=GameArchive.q.firstEventId)))
+    archives.reverse()
+
+    matches = filter_predicate(filters)
+    heap = []
+
+    def push(rows):
+        row = next(rows, None)
+        if row is not None:
+            heapq.heappush(heap, (row[0], row, rows))
+
+    clauses = GameEvent.filter_clauses(filters)
+    if after is not None:
+        clauses.append(GameEvent.q.id > after)
+    push(GameEvent.iter_rows(clauses, pageSize))
+    while heap or archives:
+        while archives and (not heap or archives[-1][1] <= heap[0][0]):
+            gameId, firstEventId, lastEventId = archives.pop()
+            archive = load_archive(gameId, conn, lastEventId)
+            if archive is not None:
+                push(row for row in archive.rows_after(after) if matches(row))
+
+        if heap:
+            eventId, row, rows = heapq.heappop(heap)
+            yield row
+            push(rows)
+
+
+def find_event(eventId, columns):
+    """Returns the archived row for eventId, or None if it isn't archived"""
+    conn = sqlhub.getConnection()
+    archives = conn.queryAll(conn.sqlrepr(sqlbuilder.Select(
+        [GameArchive.q.id, GameArchive.q.lastEventId], where=sqlbuilder.AND(
+            GameArchive.q.firstEventId <= eventId, GameArchive.q.lastEventId >= eventId))))
+
+    for gameId, lastEventId in archives:
+        archive = load_archive(gameId, conn, lastEventId)
+        row = archive.find(eventId) if archive else None
+        if row is not None:
+            return project_rows([row], columns)[0]
+
+    return None
+
+
+def row_id(row):
+    return row[0]
+
+
+def canonical_row(row):
+    """Converts a row read from game_event to the form it's archived in, with
+    datetimes formatted the same way on every database so they can be
+    compared as strings"""
+    return [value if convert is None or value is None else convert(value)
+            for value, convert in zip(row, ROW_CONVERTERS)]
+
+
+def project_rows(rows, columns):
+    """Picks the given columns out of archived rows, as select_rows() would"""
+    if columns is None:
+        return rows
+
+    indexes = [GameEvent.sqlmeta.columnList.index(col) + 1 for col in columns]
+    return [[row[0]] + [row[i] for i in indexes] for row in rows]
+
+
+def filter_predicate(filters):
+    """Returns a function that tests whether an archived row matches filters
+    from GameEvent.parse_filters(), the same as their SQL conditions would"""
+    tests = []
+    for attrName, op, value in filters:
+        col = GameEvent.sqlmeta.columns[attrName]
+        if isinstance(col, SODateTimeCol):
+            value = [format_value(x) for x in value] if op == 'in' else format_value(value)
+        tests.append((GameEvent.sqlmeta.columnList.index(col) + 1, op, value))
+
+    def matches(row):
+        for i, op, value in tests:
+            rowValue = row[i]
+            if op == '==':
+                if rowValue != value:
+                    return False
+            elif op == 'in':
+                if rowValue not in value:
+                    return False
+            # NULL is neither before nor after anything in SQL
+            elif rowValue is None:
+                return False
+            elif op == '>=':
+                if rowValue < value:
+                    return False
+            elif rowValue >= value:
+                return False
+
+        return True
+
+    return matches
+
+
+def format_value(value):
+    return None if value is None else format_datetime(value)
+
+
+# Position of the player id in a row, and the functions that convert each of
+# a row's values to how it's archived
+PLAYER_ID = GameEvent.sqlmeta.columnList.index(GameEvent.sqlmeta.columns['playerID']) + 1
+ROW_CONVERTERS = [None] + [format_datetime if isinstance(col, SODateTimeCol) else None
+                           for col in GameEvent.sqlmeta.columnList]
+
+
+def archive_finished_games():
+    """Archives the events of every inactive game that still has events in
+    game_event, each in its own transaction, and returns how many games were
+    archived. For databases from before archiving was turned on, see
+    archive_games.py."""
+    conn = sqlhub.getConnection()
+    gameIds = conn.queryAll(
+        'SELECT DISTINCT e.game_id FROM game_event e JOIN game g ON g.id = e.game_id WHERE g.active = {0}'.format(
+            conn.sqlrepr(False)))
+
+    for gameId, in gameIds:
+        with transaction() as trans:
+            archive_game(gameId, trans)
+
+    return len(gameIds)
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# Archives the events of every game that has ended, for databases that were
+# in use before LEDGERMAN_ARCHIVE was turned on, see archive.py.
+#
+#   python archive_games.py [database]
+#
+# The database defaults to LEDGERMAN_DB, as for the server.
+from archive import archive_finished_games
+from models import init_db
+import sys
+
+if __name__ == '__main__':
+    init_db(sys.argv[1] if len(sys.argv) > 1 else None)
+    print 'Archived {0} games'.format(archive_finished_games())
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# Benchmarks every endpoint of the API in-process, through the WSGI app.
+#
+#   python bench.py --scale small --save
+#   python bench.py --scale small --threads 8 --compare
+#
+# Seeds a fresh database with fake players, games, events and achievements,
+# then times a number of requests to each endpoint and reports throughput,
+# p50/p99 latency and peak memory. --save keeps the results as the baseline
+# for that scale and thread count, and --compare reports the change from the
+# baseline, exiting with status 1 if any endpoint got slower than --tolerance.
+import argparse
+import datetime
+import faker
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+# Data set sizes. events is per game.
+SCALES = {
+    'small': {'players': 100, 'games': 10, 'events': 1000, 'achievements': 200},
+    'medium': {'players': 1000, 'games': 50, 'events': 5000, 'achievements': 2000},
+    'large': {'players': 10000, 'games': 200, 'events': 10000, 'achievements': 10000},
+}
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+# Events sent per POST /events/batch while seeding, and in the batch benchmark
+SEED_BATCH_SIZE = 1000
+BENCH_BATCH_SIZE = 100
+
+EVENT_TYPES = ('spawned', 'fragged', 'fragged', 'damaged', 'damaged', 'damaged')
+
+fake = faker.Factory.create()
+
+
+class Bench(object):
+    """Seeds the database through the API and runs the benchmarks against it"""
+
+    def __init__(self, client, headers, scale):
+        self.client = client
+        self.headers = headers
+        self.scale = scale
+        self.players = []
+        self.games = []
+        self.activeGames = []
+        self.events = []
+        self.achievementTypes = []
+        self.achievements = []
+
+    def request(self, method, path, body=None, query_string=None):
+        res = self.client.simulate_request(method, path, headers=self.headers, query_string=query_string,
+                                           body=None if body is None else json.dumps(body))
+        if res.status_code >= 400:
+            raise RuntimeError('{0} {1} failed: {2} {3}'.format(method, path, res.status, res.content))
+        return res
+
+    def post(self, path, body):
+        return self.request('POST', path, body).json
+
+    # Fake objects
+
+    def fake_player(self):
+        return {'type': 'player', 'attributes': {
+            'email': fake.email(), 'name': fake.name(), 'handle': fake.user_name(), 'avatar-url': None}}
+
+    def fake_game(self):
+        return {'type': 'game', 'attributes': {
+            'started-at': str(datetime.datetime.now()), 'ended-at': None, 'active': True,
+            'game-type': random.choice(('ffa', 'duel', 'ctf')), 'winner-id': None}}
+
+    def fake_event(self, gameId, eventType, playerId, toId=None):
+        return {'type': 'event', 'attributes': {
+            'game-id': gameId, 'event-type': eventType, 'player-id': playerId, 'to-id': toId,
+            'timestamp': str(datetime.datetime.now())}}
+
+    def fake_events(self, gameId, playerIds, count):
+        for i in xrange(count):
+            eventType = random.choice(EVENT_TYPES)
+            playerId, toId = random.sample(playerIds, 2)
+            yield self.fake_event(gameId, eventType, playerId, toId if eventType != 'spawned' else None)
+
+    def fake_achievement(self):
+        return {'type': 'achievement', 'attributes': {
+            'achievement-type-id': random.choice(self.achievementTypes),
+            'game-id': random.choice(self.games),
+            'player-id': random.choice(self.players),
+            'timestamp': str(datetime.datetime.now())}}
+
+    # Seeding
+
+    def seed(self):
+        started = time.time()
+        scale = self.scale
+        self.players = [self.post('/players', self.fake_player())['id'] for i in xrange(scale['players'])]
+
+        for i in xrange(scale['games']):
+            gameId = self.post('/games', self.fake_game())['id']
+            self.games.append(gameId)
+
+            playerIds = random.sample(self.players, min(len(self.players), random.randint(2, 16)))
+            events = [self.fake_event(gameId, 'joined', playerId) for playerId in playerIds]
+            events.extend(self.fake_events(gameId, playerIds, scale['events'] - len(events)))
+            for start in xrange(0, len(events), SEED_BATCH_SIZE):
+                self.post('/events/batch', events[start:start + SEED_BATCH_SIZE])
+
+            # Leave some games going for the event benchmarks
+            if i % 2 == 0:
+                self.activeGames.append((gameId, playerIds))
+            else:
+                game = self.request('GET', '/games/{0}'.format(gameId)).json
+                game['attributes'].update({'active': False, 'winner-id': random.choice(playerIds),
+                                           'ended-at': str(datetime.datetime.now())})
+                self.request('PATCH', '/games/{0}'.format(gameId), game)
+
+        for name in ('First Blood', 'Flawless', 'Rampage', 'Untouchable', 'Marathon'):
+            self.achievementTypes.append(self.post('/achievement-types', {
+                'type': 'achievement-type', 'attributes': {'name': name, 'description': name}})['id'])
+
+        self.achievements = [self.post('/achievements', self.fake_achievement())['id']
+                             for i in xrange(scale['achievements'])]
+
+        # A sample of event ids, for /events/{eventId}
+        self.events = [e['id'] for e in self.request('GET', '/events', query_string='limit=1000').json]
+
+        return time.time() - started
+
+    # Benchmarks
+
+    def endpoints(self):
+        """Returns (name, function) pairs, each function making one request"""
+        player = lambda: random.choice(self.players)
+        game = lambda: random.choice(self.games)
+        get = lambda path, query_string=None: lambda: self.request('GET', path(), query_string=query_string)
+
+        def post_event():
+            gameId, playerIds = random.choice(self.activeGames)
+            self.request('POST', '/events', next(self.fake_events(gameId, playerIds, 1)))
+
+        def post_batch():
+            gameId, playerIds = random.choice(self.activeGames)
+            self.request('POST', '/events/batch', list(self.fake_events(gameId, playerIds, BENCH_BATCH_SIZE)))
+
+        def patch_player():
+            playerId = player()
+            self.request('PATCH', '/players/{0}'.format(playerId), {
+                'id': playerId, 'type': 'player', 'attributes': {'handle': fake.user_name()}})
+
+        def patch_game():
+            gameId = game()
+            self.request('PATCH', '/games/{0}'.format(gameId), {
+                'id': gameId, 'type': 'game', 'attributes': {'game-type': random.choice(('ffa', 'duel', 'ctf'))}})
+
+        def delete_player():
+            playerId = self.post('/players', self.fake_player())['id']
+            self.request('DELETE', '/players/{0}'.format(playerId))
+
+        return [
+            ('GET /players', get(lambda: '/players')),
+            ('GET /players?limit=1000', get(lambda: '/players', 'limit=1000')),
+            ('GET /players/{id}', get(lambda: '/players/{0}'.format(player()))),
+            ('GET /players/{id}?include=...', get(lambda: '/players/{0}'.format(player()),
+                                                  'include=games,events,achievements')),
+            ('GET /players/{id}/games', get(lambda: '/players/{0}/games'.format(player()))),
+            ('GET /players/{id}/events', get(lambda: '/players/{0}/events'.format(player()))),
+            ('GET /players/{id}/achievements', get(lambda: '/players/{0}/achievements'.format(player()))),
+            ('GET /players/{id}/stats', get(lambda: '/players/{0}/stats'.format(player()))),
+            ('GET /games', get(lambda: '/games')),
+            ('GET /games/{id}', get(lambda: '/games/{0}'.format(game()))),
+            ('GET /games/{id}/players', get(lambda: '/games/{0}/players'.format(game()))),
+            ('GET /games/{id}/events', get(lambda: '/games/{0}/events'.format(game()))),
+            ('GET /games/{id}/events?limit=1000', get(lambda: '/games/{0}/events'.format(game()), 'limit=1000')),
+            ('GET /games/{id}/events/stream', get(lambda: '/games/{0}/events/stream'.format(game()), 'wait=0')),
+            ('GET /games/{id}/achievements', get(lambda: '/games/{0}/achievements'.format(game()))),
+            ('GET /games/{id}/stats', get(lambda: '/games/{0}/stats'.format(game()))),
+            ('GET /events', get(lambda: '/events')),
+            ('GET /events?limit=1000', get(lambda: '/events', 'limit=1000')),
+            ('GET /events/{id}', get(lambda: '/events/{0}'.format(random.choice(self.events)))),
+            ('GET /events/queue', get(lambda: '/events/queue')),
+            ('GET /achievement-types', get(lambda: '/achievement-types')),
+            ('GET /achievement-types/{id}', get(lambda: '/achievement-types/{0}'.format(
+                random.choice(self.achievementTypes)))),
+            ('GET /achievements', get(lambda: '/achievements')),
+            ('GET /achievements/{id}', get(lambda: '/achievements/{0}'.format(random.choice(self.achievements)))),
+            ('GET /leaderboard', get(lambda: '/leaderboard', 'by=frags')),
+            ('GET /cache-stats', get(lambda: '/cache-stats')),
+            ('POST /players', lambda: self.post('/players', self.fake_player())),
+            ('PATCH /players/{id}', patch_player),
+            ('DELETE /players/{id}', delete_player),
+            ('POST /games', lambda: self.post('/games', self.fake_game())),
+            ('PATCH /games/{id}', patch_game),
+            ('POST /events', post_event),
+            ('POST /events/batch', post_batch),
+            ('POST /achievements', lambda: self.post('/achievements', self.fake_achievement())),
+        ]
+
+    def run(self, requests, threads, only=None):
+        results = {}
+        for name, func in self.endpoints():
+            if only and not any(word in name for word in only):
+                continue
+
+            results[name] = measure(func, requests, threads)
+            print_result(name, results[name])
+
+        return results
+
+
+class MemorySampler(object):
+    """Samples the resident set size every interval seconds while it's
+    running, to find the peak while a benchmark runs. Reads /proc, so on
+    other systems it falls back to the process's peak so far."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def __enter__(self):
+        self.running = True
+        self.peak = rss()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, rss())
+            time.sleep(self.interval)
+
+
+def rss():
+    """Returns the resident set size of this process in KiB"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(func, requests, threads):
+    """Calls func requests times, spread over threads threads, and returns
+    the throughput, latency percentiles in milliseconds and peak RSS in KiB"""
+    latencies = []
+    errors = []
+    counts = [requests // threads + (1 if i < requests % threads else 0) for i in range(threads)]
+
+    def worker(count):
+        times = []
+        try:
+            for i in xrange(count):
+                started = time.time()
+                func()
+                times.append(time.time() - started)
+        except Exception as ex:
+            errors.append(ex)
+        latencies.extend(times)
+
+    with MemorySampler() as memory:
+        started = time.time()
+        workers = [threading.Thread(target=worker, args=(count,)) for count in counts]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.time() - started
+
+    if errors:
+        raise errors[0]
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99': round(percentile(latencies, 0.99) * 1000, 3),
+        'peak-rss': memory.peak,
+    }
+
+
+def percentile(values, p):
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def print_result(name, result, baseline=None):
+    line = '{0:<36} {1[rps]:>9.1f} req/s  p50 {1[p50]:>8.3f} ms  p99 {1[p99]:>8.3f} ms  {1[peak-rss]:>8} KiB'.format(
+        name, result)
+    if baseline is not None:
+        line += '  p50 {0:+.0%} p99 {1:+.0%}'.format(change(result, baseline, 'p50'), change(result, baseline, 'p99'))
+    print line
+    sys.stdout.flush()
+
+
+def change(result, baseline, key):
+    return (result[key] - baseline[key]) / max(baseline[key], 0.001)
+
+
+def baseline_path(scale, threads):
+    return os.path.join(BASELINE_DIR, '{0}-{1}t.json'.format(scale, threads))
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change from baseline for each endpoint and returns the
+    names of those whose p50 latency grew by more than tolerance"""
+    print
+    print 'Compared to baseline:'
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+
+        print_result(name, results[name], baseline[name])
+        if change(results[name], baseline[name], 'p50') > tolerance:
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Ledgerman API')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--threads', type=int, default=1, help='concurrent clients per endpoint')
+    parser.add_argument('--db', help='database to seed, which should be empty (default: a new SQLite file)')
+    parser.add_argument('--only', nargs='*', help='only run endpoints whose names contain one of these')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the fake data')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results with the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='largest p50 increase over the baseline allowed by --compare (default 0.2)')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    fake.seed(args.seed)
+
+    tempDir = None
+    if args.db is None:
+        tempDir = tempfile.mkdtemp()
+        args.db = os.path.join(tempDir, 'bench.db')
+
+    # ledgerman connects to LEDGERMAN_DB when it's imported
+    os.environ['LEDGERMAN_DB'] = args.db
+    import falcon.testing
+    import ledgerman
+
+    client = falcon.testing.TestClient(ledgerman.api)
+    headers = {'X-API-Token': ledgerman.APITokenMiddleware.gen_api_token()}
+    bench = Bench(client, headers, SCALES[args.scale])
+
+    print 'Seeding {0} data set: {1}'.format(args.scale, ', '.join(
+        '{0} {1}'.format(v, k) for k, v in sorted(SCALES[args.scale].items())))
+    print 'Seeded in {0:.1f}s'.format(bench.seed())
+    print
+
+    results = bench.run(args.requests, args.threads, args.only)
+
+    path = baseline_path(args.scale, args.threads)
+    status = 0
+    if args.compare:
+        if not os.path.exists(path):
+            print 'No baseline at {0}, run with --save first'.format(path)
+            status = 1
+        else:
+            with open(path) as f:
+                regressions = compare(results, json.load(f)['endpoints'], args.tolerance)
+            if regressions:
+                print
+                print 'Slower than the baseline by more than {0:.0%}: {1}'.format(args.tolerance, ', '.join(regressions))
+                status = 1
+
+    if args.save:
+        if not os.path.isdir(BASELINE_DIR):
+            os.makedirs(BASELINE_DIR)
+        with open(path, 'w') as f:
+            json.dump({'scale': args.scale, 'threads': args.threads, 'requests': args.requests,
+                       'python': sys.version.split()[0], 'endpoints': results}, f, indent=2, sort_keys=True)
+        print
+        print 'Saved baseline to {0}'.format(path)
+
+    if tempDir is not None:
+        for name in os.listdir(tempDir):
+            os.remove(os.path.join(tempDir, name))
+        os.rmdir(tempDir)
+
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# Compares serving the API from WSGI threads with serve_async.py, over real
+# connections, while clients watch games:
+#
+#   python bench_serving.py --threads 8 --clients 16 --watchers 64
+#
+# Seeds a new database as bench.py does, then for each mode starts a server
+# on it in a subprocess with --threads threads for requests. --watchers
+# clients long poll active games, re-polling whenever they get an answer,
+# while --clients keep-alive clients make --requests requests between them:
+# reads of events, players and the leaderboard, and writes of events, which
+# wake the watchers. Reports the clients' throughput and latency, requests
+# that failed or timed out, and the server's threads and peak RSS.
+#
+# The WSGI mode stands in for a server like gunicorn with sync workers: a
+# fixed pool of threads, each handling one connection at a time, closed
+# after each request.
+from bench import SCALES, Bench, fake, percentile
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+import argparse
+import httplib
+import json
+import os
+import Queue
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MODES = ('wsgi', 'async')
+
+# Seconds a client waits for a response before counting it as failed
+CLIENT_TIMEOUT = 10
+
+# Seconds each long poll waits for events
+WATCH_WAIT = 30
+
+
+class PooledWSGIServer(WSGIServer):
+    """wsgiref's server, handling connections on a fixed pool of threads"""
+
+    def __init__(self, address, threads):
+        WSGIServer.__init__(self, address, QuietHandler)
+        self.requests = Queue.Queue()
+        for i in xrange(threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(mode, db, port, threads):
+    """Runs a server in this process, for run_mode()"""
+    os.environ['LEDGERMAN_DB'] = db
+    import ledgerman
+
+    if mode == 'async':
+        from serve_async import AsyncServer
+        server = AsyncServer(ledgerman.api, '127.0.0.1', port, threads)
+    else:
+        server = PooledWSGIServer(('127.0.0.1', port), threads)
+        server.set_app(ledgerman.api)
+
+    print 'Listening'
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+class Client(object):
+    """A keep-alive connection, reconnecting if the server closes it"""
+
+    def __init__(self, port, headers):
+        self.port = port
+        self.headers = headers
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=CLIENT_TIMEOUT)
+        try:
+            self.conn.request(method, path, body, self.headers)
+            res = self.conn.getresponse()
+            data = res.read()
+        except (socket.error, httplib.HTTPException):
+            self.conn.close()
+            self.conn = None
+            raise
+        if res.getheader('connection', '').lower() == 'close' or res.version == 10:
+            self.conn.close()
+            self.conn = None
+        if res.status >= 400:
+            raise RuntimeError('{0} {1} failed: {2}'.format(method, path, res.status))
+        return data
+
+
+def run_mode(mode, bench, args):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, '--db', args.db,
+                               '--port', str(port), '--threads', str(args.threads)], stdout=subprocess.PIPE)
+    server.stdout.readline()
+
+    headers = dict(bench.headers, **{'Content-Type': 'application/json'})
+    stopping = threading.Event()
+    failures = []
+    watched = [0]
+
+    def watch(gameId):
+        client = Client(port, headers)
+        after = 0
+        while not stopping.is_set():
+            try:
+                events = json.loads(client.request('GET', '/games/{0}/events/stream?after={1}&wait={2}'.format(
+                    gameId, after, WATCH_WAIT)))
+                after = max([after] + [event['id'] for event in events])
+                watched[0] += 1
+            except Exception as ex:
+                failures.append(ex)
+                time.sleep(0.1)
+
+    watchers = []
+    for i in xrange(args.watchers):
+        gameId, playerIds = bench.activeGames[i % len(bench.activeGames)]
+        thread = threading.Thread(target=watch, args=(gameId,))
+        thread.daemon = True
+        watchers.append(thread)
+    for thread in watchers:
+        thread.start()
+    time.sleep(1)
+
+    latencies = []
+    errors = []
+    counts = [args.requests // args.clients + (1 if i < args.requests % args.clients else 0)
+              for i in xrange(args.clients)]
+
+    def work(count):
+        client = Client(port, headers)
+        times = []
+        for i in xrange(count):
+            method, path, body = next_request(bench)
+            started = time.time()
+            try:
+                client.request(method, path, body)
+                times.append(time.time() - started)
+            except Exception as ex:
+                errors.append(ex)
+        latencies.extend(times)
+
+    peak = [0, 0]
+    sampling = threading.Event()
+
+    def sample():
+        while not sampling.is_set():
+            threads, rssKb = server_usage(server.pid)
+            peak[0] = max(peak[0], threads)
+            peak[1] = max(peak[1], rssKb)
+            time.sleep(0.05)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    started = time.time()
+    clients = [threading.Thread(target=work, args=(count,)) for count in counts]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.time() - started
+    sampling.set()
+    sampler.join()
+
+    stopping.set()
+    server.terminate()
+    server.wait()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50': round(percentile(latencies, 0.5) * 1000, 3) if latencies else 0,
+        'p99': round(percentile(latencies, 0.99) * 1000, 3) if latencies else 0,
+        'failed': len(errors),
+        'polls': watched[0],
+        'server-threads': peak[0],
+        'server-rss': peak[1],
+    }
+
+
+def next_request(bench):
+    """Returns a random (method, path, body) to make, mostly reads"""
+    choice = random.random()
+    if choice < 0.4:
+        return 'GET', '/games/{0}/events?limit=100'.format(random.choice(bench.games)), None
+    elif choice < 0.7:
+        return 'GET', '/players/{0}'.format(random.choice(bench.players)), None
+    elif choice < 0.8:
+        return 'GET', '/leaderboard', None
+    gameId, playerIds = random.choice(bench.activeGames)
+    playerId, toId = random.sample(playerIds, 2)
+    return 'POST', '/events', json.dumps(bench.fake_event(gameId, 'fragged', playerId, toId))
+
+
+def server_usage(pid):
+    """Returns the number of threads and RSS in KiB of process pid, from /proc"""
+    try:
+        with open('/proc/{0}/status'.format(pid)) as status:
+            fields = dict(line.split(':', 1) for line in status if ':' in line)
+        return int(fields['Threads']), int(fields['VmRSS'].split()[0])
+    except (IOError, KeyError):
+        return 0, 0
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare WSGI and async serving of the Ledgerman API')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--threads', type=int, default=8, help='threads handling requests in the server')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent keep-alive clients')
+    parser.add_argument('--watchers', type=int, default=64, help='clients long polling games')
+    parser.add_argument('--requests', type=int, default=2000, help='requests made by the clients in total')
+    parser.add_argument('--modes', nargs='*', choices=MODES, default=list(MODES))
+    parser.add_argument('--db', help='database to seed, which should be empty (default: a new SQLite file)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the fake data')
+    parser.add_argument('--serve', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.db, args.port, args.threads)
+        return
+
+    random.seed(args.seed)
+    fake.seed(args.seed)
+
+    tempDir = None
+    if args.db is None:
+        tempDir = tempfile.mkdtemp()
+        args.db = os.path.join(tempDir, 'bench.db')
+
+    # ledgerman connects to LEDGERMAN_DB when it's imported
+    os.environ['LEDGERMAN_DB'] = args.db
+    import falcon.testing
+    import ledgerman
+
+    bench = Bench(falcon.testing.TestClient(ledgerman.api),
+                  {'X-API-Token': ledgerman.APITokenMiddleware.gen_api_token()}, SCALES[args.scale])
+    print 'Seeded {0} data set in {1:.1f}s'.format(args.scale, bench.seed())
+    print '{0} server threads, {1} clients, {2} watchers, {3} requests'.format(
+        args.threads, args.clients, args.watchers, args.requests)
+    print
+
+    for mode in args.modes:
+        result = run_mode(mode, bench, args)
+        print ('{0:<6} {1[rps]:>8.1f} req/s  p50 {1[p50]:>8.3f} ms  p99 {1[p99]:>9.3f} ms  {1[failed]:>5} failed  '
+               '{1[polls]:>5} polls answered  {1[server-threads]:>4} threads  {1[server-rss]:>7} KiB').format(
+                   mode, result)
+        sys.stdout.flush()
+
+    if tempDir is not None:
+        for name in os.listdir(tempDir):
+            os.remove(os.path.join(tempDir, name))
+        os.rmdir(tempDir)
+
+
+if __name__ == '__main__':
+    main()
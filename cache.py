@@ -0,0 +1,221 @@
+from collections import OrderedDict
+from models import existingIds, sqlbuilder
+from shared import INVALIDATE_CHANNEL, sharedState
+from sqlobject import SOForeignKey
+from sqlobject.classregistry import findClass
+from sqlobject.joins import SORelatedJoin
+import os
+import threading
+import time
+import versions
+
+# Defaults for the cache of serialized responses, see ResponseCache
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 60
+
+
+class ResponseCache(object):
+    """An LRU cache of serialized response bodies that expire after ttl seconds.
+
+    Entries belong to a group, e.g. ('Game', 1) for a game and the documents
+    that include its relationships, or ('Game', 1, 'events') for the pages of
+    its events. Each group has a generation number that's part of the key of
+    its entries, so invalidating a group is just incrementing its generation;
+    the old entries can no longer be found and fall off the end of the LRU.
+
+    Invalidations made while a request's transaction is open are repeated
+    when it ends, by invalidate_pending(), so that a response cached by
+    another thread before the transaction committed doesn't outlive it.
+
+    With a SharedState, invalidations are also published to the other
+    workers once they're final, and theirs applied here.
+
+    Each entry also keeps its body compressed with each content coding it's
+    been sent with, see put_encoded(), so cache hits aren't compressed again."""
+
+    def __init__(self, maxSize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, state=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.state = state
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        if state is not None:
+            state.subscribe(INVALIDATE_CHANNEL, self.invalidated_elsewhere)
+
+    def key(self, group, variant=''):
+        """Returns the current key for the variant (e.g. query string) of an
+        entry in group"""
+        return group, self.generations.get(group, 0), variant
+
+    def get(self, key):
+        """Returns the (body, link) pair cached for key, or None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+
+            # Re-insert to mark as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1:3]
+
+    def put(self, key, body, link=None):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, body, link, {})
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def get_encoded(self, key, body, encoding):
+        """Returns body compressed with encoding, if it's the body cached
+        for key and that's been put_encoded(), or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] is not body:
+                return None
+            return entry[3].get(encoding)
+
+    def put_encoded(self, key, body, encoding, data):
+        """Keeps data, body compressed with encoding, with key's entry if
+        body is the one cached for it"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is body:
+                entry[3][encoding] = data
+
+    def invalidate(self, group):
+        self.bump([group])
+
+        pending = getattr(self.local, 'pending', None)
+        if pending is not None:
+            pending.add(group)
+        else:
+            self.publish([group])
+
+    def bump(self, groups):
+        with self.lock:
+            for group in groups:
+                self.generations[group] = self.generations.get(group, 0) + 1
+
+    def publish(self, groups):
+        if self.state is not None and groups:
+            self.state.publish(INVALIDATE_CHANNEL, groups)
+
+    def invalidated_elsewhere(self, groups):
+        self.bump([tuple(group) for group in groups])
+
+    def track_pending(self):
+        """Starts recording this thread's invalidations for invalidate_pending()"""
+        self.local.pending = set()
+
+    def invalidate_pending(self):
+        pending = getattr(self.local, 'pending', None)
+        self.local.pending = None
+        if pending:
+            self.bump(pending)
+            self.publish(list(pending))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations.clear()
+
+    def counters(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+responseCache = ResponseCache(
+    int(os.environ.get('LEDGERMAN_CACHE_SIZE', DEFAULT_CACHE_SIZE)),
+    float(os.environ.get('LEDGERMAN_CACHE_TTL', DEFAULT_CACHE_TTL)),
+    sharedState)
+
+
+def discard_existing(groups):
+    """Forgets rows other workers may have deleted, see invalidate()"""
+    for group in groups:
+        if len(group) == 2:
+            existingIds.discard(tuple(group))
+
+
+sharedState.subscribe(INVALIDATE_CHANNEL, discard_existing)
+
+
+def invalidate(group):
+    """Marks the responses in group as changed: drops any cached ones and
+    bumps the group's version for conditional GETs"""
+    responseCache.invalidate(group)
+    versions.touch(group)
+
+    # The row may have been deleted
+    if len(group) == 2:
+        existingIds.discard(group)
+
+
+def invalidate_object(obj):
+    """Invalidates everything cached that could contain obj.
+
+    Call it before changing or deleting obj, and again after creating or
+    changing it, so both the old and new relationships are covered."""
+    attrs = dict((col.name, getattr(obj, col.name)) for col in obj.sqlmeta.columnList)
+    invalidate_row(obj.__class__, obj.id, attrs)
+
+
+def invalidate_row(sqlObj, resourceId, attrs):
+    """Invalidates everything cached that could contain the sqlObj row with
+    id resourceId and column values attrs: the object itself, the objects its
+    foreign keys point at and their relationships that list it, and the
+    objects related to it through a RelatedJoin. resourceId may be None for
+    rows that were inserted without creating an object."""
+    if resourceId is not None:
+        invalidate((sqlObj.__name__, resourceId))
+
+    for col in sqlObj.sqlmeta.columnList:
+        foreignId = attrs.get(col.name)
+        if not isinstance(col, SOForeignKey) or foreignId is None:
+            continue
+
+        # Documents that ?include= this row, and relationships that list it
+        invalidate((col.foreignKey, foreignId))
+        for join in findClass(col.foreignKey).sqlmeta.joins:
+            if join.otherClass is sqlObj and join.joinColumn == col.dbName:
+                invalidate((col.foreignKey, foreignId, join.joinMethodName))
+
+    if resourceId is None:
+        return
+
+    for join in sqlObj.sqlmeta.joins:
+        if not isinstance(join, SORelatedJoin):
+            continue
+
+        conn = sqlObj._connection
+        relatedIds = conn.queryAll(conn.sqlrepr(sqlbuilder.Select(
+            [sqlbuilder.Field(join.intermediateTable, join.otherColumn)],
+            where=sqlbuilder.Field(join.intermediateTable, join.joinColumn) == resourceId)))
+
+        for row in relatedIds:
+            invalidate_join(join.otherClass, row[0], reverse_join(join), resourceId)
+
+
+def invalidate_join(sqlObj, resourceId, relAttr, otherId):
+    """Invalidates what's cached for both sides of a RelatedJoin when a row
+    is added to or removed from it, e.g. by Game.addPlayer()"""
+    join = sqlObj.find_join(relAttr)
+    otherName = join.otherClass.__name__
+
+    invalidate((sqlObj.__name__, resourceId))
+    invalidate((sqlObj.__name__, resourceId, relAttr))
+    invalidate((otherName, otherId))
+    invalidate((otherName, otherId, reverse_join(join)))
+
+
+def reverse_join(join):
+    """Returns the name of the other side of a RelatedJoin"""
+    for otherJoin in join.otherClass.sqlmeta.joins:
+        if isinstance(otherJoin, SORelatedJoin) and otherJoin.intermediateTable == join.intermediateTable:
+            return otherJoin.joinMethodName
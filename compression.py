@@ -0,0 +1,100 @@
+import os
+import zlib
+
+# Responses smaller than this many bytes aren't worth compressing; streamed
+# responses, whose size isn't known, always are
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+
+# zlib's compression level, from 1 (fastest) to 9 (smallest)
+DEFAULT_COMPRESS_LEVEL = 6
+
+# Content codings in order of preference, with the zlib window bits that
+# produce them: gzip's header and trailer, or deflate's zlib ones
+ENCODINGS = (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS))
+WBITS = dict(ENCODINGS)
+
+# Largest request body that will be decompressed, so a small compressed body
+# can't take up unbounded memory
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+
+def parse_qvalues(header):
+    """Returns the values of an Accept or Accept-Encoding header, lowercased,
+    mapped to their q-values; 0 means not acceptable"""
+    accepted = {}
+    for part in (header or '').split(','):
+        params = part.split(';')
+        value = params[0].strip().lower()
+        if not value:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, sep, qvalue = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(qvalue)
+                except ValueError:
+                    q = 0
+        accepted[value] = q
+    return accepted
+
+
+def choose_encoding(acceptEncoding):
+    """Returns the content coding to compress a response with, given the
+    Accept-Encoding header of its request, or None to send it as it is"""
+    if not acceptEncoding:
+        return None
+
+    accepted = parse_qvalues(acceptEncoding)
+    for coding, wbits in ENCODINGS:
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
+
+
+def compress(data, encoding, level=DEFAULT_COMPRESS_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_compressed(chunks, encoding, level=DEFAULT_COMPRESS_LEVEL):
+    """Compresses a streamed response. Each chunk is flushed as it's
+    compressed, so clients watching a stream of events get each one as soon
+    as it's written rather than when enough have built up."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    try:
+        for chunk in chunks:
+            if not chunk:
+                # Passed on, so async servers know the stream isn't ready
+                yield ''
+                continue
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            compressed = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def decompress(data, encoding, maxSize=MAX_DECOMPRESSED_SIZE):
+    """Decompresses a request body sent with Content-Encoding. Raises
+    ValueError if it's not valid, or larger than maxSize once decompressed."""
+    if encoding not in WBITS:
+        raise ValueError("Unsupported Content-Encoding '{0}', should be one of {1}".format(
+            encoding, ', '.join(coding for coding, wbits in ENCODINGS)))
+
+    decompressor = zlib.decompressobj(WBITS[encoding])
+    try:
+        decompressed = decompressor.decompress(data, maxSize + 1)
+    except zlib.error as ex:
+        raise ValueError('Body could not be decompressed: {0}'.format(ex))
+    if len(decompressed) > maxSize:
+        raise ValueError('Body is larger than {0} bytes decompressed'.format(maxSize))
+    return decompressed
+
+
+compressMinSize = int(os.environ.get('LEDGERMAN_COMPRESS_MIN_SIZE', DEFAULT_COMPRESS_MIN_SIZE))
+compressLevel = int(os.environ.get('LEDGERMAN_COMPRESS_LEVEL', DEFAULT_COMPRESS_LEVEL))
@@ -0,0 +1,376 @@
+from archive import select_events
+from collections import deque
+from models import GameEvent, dump_json
+from shared import FEED_CHANNEL, sharedState
+import os
+import Queue
+import threading
+import time
+
+# Number of events a subscriber can fall behind by before it has to catch up
+# from the database, see Subscription
+DEFAULT_FEED_QUEUE_SIZE = 256
+
+# Seconds between the ticks that check each watched game for new events,
+# see FeedHub
+DEFAULT_FEED_TICK = 5
+
+# Seconds a subscriber can go without being woken, see FeedHub
+FEED_KEEPALIVE = 15
+
+# Number of event ids each game remembers sending, see GameFeed
+RECENT_IDS = 1024
+
+# Largest number of events read from the database at once by watch_game()
+FEED_PAGE_SIZE = 1000
+
+# Queued in place of an event's JSON to tell a subscriber to read new events
+# from the database: RESYNC for events that were written without being
+# loaded, e.g. by a batch, and TICK from the ticker, see FeedHub
+RESYNC = object()
+TICK = object()
+
+
+class Subscription(object):
+    """A bounded queue of (eventId, json) pairs for one watcher of a game.
+
+    Publishing never blocks: if the queue is full the new event is dropped
+    and the subscription marked as lagged, so a slow watcher can't hold up
+    the writers or use unbounded memory. A lagged watcher reads what it
+    missed from the database instead, after the last event id it has seen.
+
+    Instead of blocking in wait(), a watcher can poll with take() and be
+    told when there's something to take by notify(), which is called by
+    whichever thread queued it.
+
+    deadline is when the watcher will have waited long enough, and woken
+    when the ticker last woke it up, see FeedHub.tick_games()."""
+
+    def __init__(self, gameId, queueSize, notify=None):
+        self.gameId = gameId
+        self.queue = Queue.Queue(queueSize)
+        self.lagged = False
+        self.notify = notify
+        self.deadline = float('inf')
+        self.woken = time.time()
+
+    def offer(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Queue.Full:
+            self.lagged = True
+            return False
+        finally:
+            if self.notify is not None:
+                self.notify()
+
+    def tick(self, now):
+        self.woken = now
+        # A full queue will wake the watcher anyway
+        try:
+            self.queue.put_nowait((None, TICK))
+        except Queue.Full:
+            pass
+        if self.notify is not None:
+            self.notify()
+
+    def wait(self):
+        """Blocks until something is queued, then returns everything that is"""
+        return [self.queue.get()] + self.take()
+
+    def take(self):
+        """Returns everything that's queued, without blocking"""
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return items
+
+
+class GameFeed(object):
+    """The subscriptions watching one game, and what the hub has sent them.
+
+    lastId is the highest event id the hub knows of for the game, which is
+    where the next catch up reads from; recentIds are the ids it has sent
+    lately, so an event that's both published and read isn't sent twice.
+    generation is bumped whenever the database should be checked, and synced
+    is the generation it was last checked for."""
+
+    def __init__(self):
+        self.subs = set()
+        self.lastId = 0
+        self.recent = deque()
+        self.recentIds = set()
+        self.generation = 0
+        self.synced = 0
+        self.syncLock = threading.Lock()
+
+    def remember(self, eventId):
+        """Returns whether eventId is new, and remembers it if it is"""
+        if eventId in self.recentIds:
+            return False
+        if len(self.recent) >= RECENT_IDS:
+            self.recentIds.discard(self.recent.popleft())
+        self.recent.append(eventId)
+        self.recentIds.add(eventId)
+        self.lastId = max(self.lastId, eventId)
+        return True
+
+
+class FeedHub(object):
+    """Fans the events written to each game out to the subscriptions watching it.
+
+    Events published while a request's transaction is open are held until it
+    commits, see publish_pending(), so watchers never see events that are
+    rolled back.
+
+    Subscribers block on their queues without a timeout, which costs nothing
+    while they wait; Python 2 implements waits with a timeout by polling.
+    Instead one thread ticks every tick seconds. A tick only wakes one
+    subscription of each game, which checks the database for the whole game,
+    see catch_up(); the others are woken once they've waited long enough, or
+    every FEED_KEEPALIVE seconds so streams can send something.
+
+    With a SharedState, events are also published to the other workers, and
+    theirs delivered to the watchers here; without one, watchers only find
+    out about other workers' events on the next tick."""
+
+    def __init__(self, queueSize=DEFAULT_FEED_QUEUE_SIZE, tick=DEFAULT_FEED_TICK, state=None):
+        self.queueSize = queueSize
+        self.tick = tick
+        self.state = state
+        self.games = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ticker = None
+        self.published = 0
+        self.dropped = 0
+        if state is not None:
+            state.subscribe(FEED_CHANNEL, self.published_elsewhere)
+
+    def subscribe(self, gameId, notify=None):
+        sub = Subscription(gameId, self.queueSize, notify)
+        with self.lock:
+            self.games.setdefault(gameId, GameFeed()).subs.add(sub)
+            if self.ticker is None:
+                self.ticker = threading.Thread(target=self.run_ticker, name='feed-ticker')
+                self.ticker.daemon = True
+                self.ticker.start()
+
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            game = self.games.get(sub.gameId)
+            if game is None:
+                return
+
+            game.subs.discard(sub)
+            if not game.subs:
+                del self.games[sub.gameId]
+
+    def publish(self, gameId, eventId=None, body=RESYNC):
+        """Sends an event, serialized to JSON as body, to gameId's watchers.
+        With no event, tells them to read new events from the database."""
+        pending = getattr(self.local, 'pending', None)
+        if pending is not None:
+            pending.append((gameId, eventId, body))
+        else:
+            self.deliver(gameId, eventId, body)
+            self.broadcast([(gameId, eventId, body)])
+
+    def deliver(self, gameId, eventId, body):
+        with self.lock:
+            game = self.games.get(gameId)
+            if game is None:
+                return
+            if body is RESYNC:
+                game.generation += 1
+                subs = list(game.subs)
+            elif game.remember(eventId):
+                subs = list(game.subs)
+            else:
+                return
+
+        if body is RESYNC:
+            self.wake_one(subs, RESYNC)
+            return
+
+        delivered = sum(1 for sub in subs if sub.offer((eventId, body)))
+        with self.lock:
+            self.published += delivered
+            self.dropped += len(subs) - delivered
+
+    def wake_one(self, subs, marker):
+        """Queues marker for the first of subs that can take it, so one
+        watcher catches up for all of them, and returns it. Lagged watchers
+        read for themselves, and a full queue lags."""
+        for sub in subs:
+            if not sub.lagged and sub.offer((None, marker)):
+                return sub
+
+    def seen(self, gameId, eventId):
+        """Notes that a watcher has read gameId's events up to eventId"""
+        with self.lock:
+            game = self.games.get(gameId)
+            if game is not None:
+                game.lastId = max(game.lastId, eventId)
+
+    def catch_up(self, gameId):
+        """Reads gameId's events from the database, unless that's already
+        been done since it was last asked for, and delivers any new ones to
+        all its watchers. Called by watchers when they're woken, so the
+        reads happen on their threads; if another watcher is reading,
+        there's no need to wait for it."""
+        with self.lock:
+            game = self.games.get(gameId)
+        if game is None:
+            return
+
+        while game.syncLock.acquire(False):
+            try:
+                with self.lock:
+                    if game.synced == game.generation:
+                        return
+                    game.synced = game.generation
+                    after = game.lastId
+
+                events, more = read_events(gameId, after)
+                for eventId, body in events:
+                    self.deliver(gameId, eventId, body)
+                if more:
+                    with self.lock:
+                        game.generation += 1
+            finally:
+                game.syncLock.release()
+
+    def track_pending(self):
+        """Starts holding this thread's events for publish_pending()"""
+        self.local.pending = []
+
+    def publish_pending(self):
+        pending = getattr(self.local, 'pending', None)
+        self.local.pending = None
+        for gameId, eventId, body in pending or ():
+            self.deliver(gameId, eventId, body)
+        self.broadcast(pending)
+
+    def broadcast(self, events):
+        if self.state is not None and events:
+            self.state.publish(FEED_CHANNEL, [(gameId, eventId, None if body is RESYNC else body)
+                                              for gameId, eventId, body in events])
+
+    def published_elsewhere(self, events):
+        for gameId, eventId, body in events:
+            self.deliver(gameId, eventId, RESYNC if body is None else str(body))
+
+    def discard_pending(self):
+        self.local.pending = None
+
+    def run_ticker(self, sleep=time.sleep, clock=time.time):
+        # These are bound early as module globals are cleared when Python exits
+        while True:
+            sleep(self.tick)
+            self.tick_games(clock())
+
+    def tick_games(self, now=None):
+        """Asks each game to be checked, and wakes the watchers that are due"""
+        now = now or time.time()
+        with self.lock:
+            games = self.games.values()
+            for game in games:
+                game.generation += 1
+            games = [list(game.subs) for game in games]
+
+        for subs in games:
+            leader = self.wake_one(subs, TICK)
+            for sub in subs:
+                if sub is leader:
+                    sub.woken = now
+                elif now >= sub.deadline or now >= sub.woken + FEED_KEEPALIVE:
+                    sub.tick(now)
+
+    def counters(self):
+        with self.lock:
+            watchers = sum(len(game.subs) for game in self.games.itervalues())
+            return {'games': len(self.games), 'watchers': watchers,
+                    'published': self.published, 'dropped': self.dropped}
+
+
+feedHub = FeedHub(
+    int(os.environ.get('LEDGERMAN_FEED_QUEUE_SIZE', DEFAULT_FEED_QUEUE_SIZE)),
+    float(os.environ.get('LEDGERMAN_FEED_TICK', DEFAULT_FEED_TICK)),
+    sharedState)
+
+
+def publish_event(event):
+    feedHub.publish(event.gameID, event.id, dump_json(event, 'event'))
+
+
+def watch_game(gameId, after, wait, hub=feedHub, notify=None):
+    """Generates lists of the (eventId, json) events written to gameId after
+    the event id after, for wait seconds (rounded up to the next tick).
+
+    The first list holds the events already in the database, and is empty if
+    there aren't any; after that lists are generated as events are published,
+    and empty ones when the watcher is woken without any. Every tick one of
+    the game's watchers also checks the database for all of them, for events
+    written by other worker processes, see FeedHub.catch_up().
+
+    With notify, waiting for events doesn't block: None is generated
+    instead, and notify() called from another thread when it's worth asking
+    for the next list, see serve_async.py."""
+    sub = hub.subscribe(gameId, notify)
+    try:
+        sub.deadline = deadline = time.time() + wait
+        readIds = set()
+        items = []
+        resync = True
+        while True:
+            if any(body is RESYNC or body is TICK for eventId, body in items):
+                hub.catch_up(gameId)
+                items += sub.take()
+
+            more = False
+            read = resync or sub.lagged
+            if read:
+                # Cleared first so anything dropped while reading is read next time
+                sub.lagged = False
+                events, more = read_events(gameId, after)
+                readIds = set(eventId for eventId, body in events)
+            else:
+                # Skip markers, and events that were also just read from the database
+                events = [(eventId, body) for eventId, body in items
+                          if body is not RESYNC and body is not TICK and eventId not in readIds]
+
+            if events:
+                after = max(after, max(eventId for eventId, body in events))
+            if read:
+                hub.seen(gameId, after)
+            yield events
+
+            resync = more
+            if more:
+                items = []
+            elif time.time() >= deadline:
+                return
+            elif notify is None:
+                items = sub.wait()
+            else:
+                items = sub.take()
+                while not items:
+                    yield None
+                    items = sub.take()
+    finally:
+        hub.unsubscribe(sub)
+
+
+def read_events(gameId, after):
+    """Reads a page of gameId's events after the id after from the database.
+    Returns the (eventId, json) pairs, and whether there are more."""
+    rows, nextAfter = select_events(gameId, None, [], after, FEED_PAGE_SIZE)
+    writer = GameEvent.row_writer(None, 'event')
+    events = [(row[0], writer.to_json(row)) for row in rows]
+    return events, nextAfter is not None
@@ -1,34 +1,134 @@
 from restfuls import *
-from models import init_db
+from cache import responseCache
+from compression import choose_encoding, compress, compressLevel, compressMinSize, iter_compressed
+from feed import feedHub
+from models import DEFAULT_POOL_TIMEOUT, PoolTimeout, init_db
+from metrics import count_queries, end_request, iter_counted, start_request
+from shared import sharedState
+from tokens import DEFAULT_TOKEN, TooManyFailures, check_limits, tokenStore
+from sqlobject import sqlhub
 import falcon
 import hashlib
 import json
+import math
 import re
 import sqlobject
-import md5
+import versions
+import os
 import __builtin__
 
+class MetricsMiddleware(object):
+    """Records each request's latency, response size, SQL queries and time
+    spent serializing, see metrics.py. Streamed responses are recorded once
+    they've been sent."""
+
+    def process_request(self, req, resp):
+        req.context['metrics'] = start_request(req.method)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        request = req.context.pop('metrics', None)
+        if request is None:
+            return
+
+        if resource is not None:
+            request.labels = (resource.__class__.__name__, req.method)
+
+        if resp.stream is not None:
+            resp.stream = iter_counted(resp.stream, request, resp.status)
+        else:
+            end_request(request, resp.status, len(resp.body or resp.data or ''))
+
+
+class CompressionMiddleware(object):
+    """Compresses responses with gzip or deflate, whichever the client
+    prefers in Accept-Encoding, see compression.py. Bodies under
+    compressMinSize bytes are sent as they are; streams always compressed.
+
+    As the compressed body differs from the uncompressed one, its ETag is
+    made weak, which If-None-Match still matches. Bodies from the response
+    cache are compressed once per content coding and cached alongside."""
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not compressLevel or req.method == 'HEAD' or resp.get_header('Content-Encoding'):
+            return
+        if resp.body is None and resp.data is None and resp.stream is None:
+            return
+
+        resp.append_header('Vary', 'Accept-Encoding')
+        encoding = choose_encoding(req.get_header('Accept-Encoding'))
+        if encoding is None:
+            return
+
+        if resp.stream is not None:
+            resp.stream = iter_compressed(resp.stream, encoding, compressLevel)
+            resp.stream_len = None
+        else:
+            body = original = resp.body if resp.body is not None else resp.data
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            if len(body) < compressMinSize:
+                return
+
+            cacheKey = req.context.get('cacheKey')
+            data = None if cacheKey is None else responseCache.get_encoded(cacheKey, original, encoding)
+            if data is None:
+                data = compress(body, encoding, compressLevel)
+                if cacheKey is not None:
+                    responseCache.put_encoded(cacheKey, original, encoding, data)
+
+            resp.body = None
+            resp.data = data
+
+        resp.set_header('Content-Encoding', encoding)
+        etag = resp.get_header('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            resp.set_header('ETag', 'W/' + etag)
+
+
 class APITokenMiddleware(object):
-    """Middleware to verify that a valid API token is present on the request."""
+    """Middleware to verify that a valid API token is present on the request,
+    and that it's within its limits for the route, see tokens.py.
 
-    def __init__(self):
-        self.apiToken = self.gen_api_token()
+    Routes are limited as 'read' for GET, HEAD and OPTIONS requests and
+    'write' for the others, unless their resource has a routeClass. Resources
+    with admin set can only be used with admin tokens."""
 
     @staticmethod
     def gen_api_token():
-        return md5.md5('In real life we would generate random api tokens for clients and store them in a table').hexdigest()
+        return DEFAULT_TOKEN
 
     def process_request(self, req, resp):
         token = req.get_header('X-API-Token')
+        try:
+            limits = tokenStore.lookup(token, req.remote_addr) if token else None
+        except TooManyFailures as e:
+            raise falcon.HTTPTooManyRequests(
+                'Too Many Requests', 'Too many invalid API tokens from this address.', int(math.ceil(e.wait)))
 
-        if token is None or not self.check_token(token):
+        if limits is None:
             title = 'Bad API token'
             description = 'X-API-Token header invalid or not present.'
 
             raise falcon.HTTPBadRequest(title, description)
 
-    def check_token(self, token):
-        return token == self.apiToken
+        req.context['token'] = limits
+
+    def process_resource(self, req, resp, resource, params):
+        limits = req.context.get('token')
+        if limits is None:
+            return
+
+        routeClass = getattr(resource, 'routeClass', None)
+        if routeClass is None:
+            routeClass = 'read' if req.method in ('GET', 'HEAD', 'OPTIONS') else 'write'
+
+        if getattr(resource, 'admin', False) and not limits.admin:
+            raise falcon.HTTPForbidden('Forbidden', 'This API token is not an admin token.')
+
+        exceeded = check_limits(limits, routeClass)
+        if exceeded is not None:
+            description, wait = exceeded
+            raise falcon.HTTPTooManyRequests('Too Many Requests', description, int(math.ceil(wait)))
 
 
 class ValidateIdsMiddleware(object):
@@ -45,16 +145,89 @@ class ValidateIdsMiddleware(object):
                 raise falcon.HTTPBadRequest('Bad Request', "Parameter '{0}' must be an integer.".format(k))
 
 
+class SharedStateMiddleware(object):
+    """Makes sure each worker process listens for the other workers'
+    messages, see shared.py. With gunicorn --preload the workers are forked
+    after the app is loaded, and one only finds out it's been forked here."""
+
+    def process_request(self, req, resp):
+        sharedState.check_fork()
+
+
+class TransactionMiddleware(object):
+    """Runs each request that writes to the database in a single transaction,
+    which is committed if the request succeeds and rolled back if it doesn't.
+
+    GET requests are left in autocommit mode so their results can be
+    streamed after the responder returns, as are requests to resources with
+    transactional = False, which commit as they go."""
+
+    def process_request(self, req, resp):
+        if req.method in ('GET', 'HEAD', 'OPTIONS'):
+            return
+
+        req.context['transaction'] = sqlhub.processConnection.transaction()
+        sqlhub.threadConnection = req.context['transaction']
+        responseCache.track_pending()
+        versions.track_pending()
+        feedHub.track_pending()
+
+    def process_resource(self, req, resp, resource, params):
+        # Only known once the request has been routed
+        if getattr(resource, 'transactional', True) or 'transaction' not in req.context:
+            return
+
+        del sqlhub.threadConnection
+        req.context.pop('transaction').rollback()
+        versions.discard_pending()
+        feedHub.discard_pending()
+        responseCache.invalidate_pending()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        trans = req.context.pop('transaction', None)
+        if trans is None:
+            return
+
+        del sqlhub.threadConnection
+        try:
+            if req_succeeded:
+                trans.commit(close=True)
+                versions.write_pending()
+                feedHub.publish_pending()
+            else:
+                trans.rollback()
+        except Exception:
+            trans.rollback()
+            raise
+        finally:
+            versions.discard_pending()
+            feedHub.discard_pending()
+            responseCache.invalidate_pending()
+
+
+def pool_timeout(ex, req, resp, params):
+    raise falcon.HTTPServiceUnavailable('Service Unavailable', str(ex), DEFAULT_POOL_TIMEOUT)
+
+
 if hasattr(__builtin__, 'ledgerman_testing') and __builtin__.ledgerman_testing:
-    init_db(':memory:')
+    init_db(os.environ.get('LEDGERMAN_TEST_DB', ':memory:'))
 else:
     init_db()
 
-api = falcon.API(middleware=[APITokenMiddleware(), ValidateIdsMiddleware()])
+count_queries(sqlhub.processConnection)
+
+# Responses pass back through the middleware in reverse, so metrics record
+# compressed sizes
+api = falcon.API(middleware=[MetricsMiddleware(), CompressionMiddleware(), SharedStateMiddleware(), APITokenMiddleware(),
+                             ValidateIdsMiddleware(), TransactionMiddleware()])
+api.add_error_handler(PoolTimeout, pool_timeout)
 
 events = GameEventResource()
 eventsCollection = GameEventCollection()
+eventsBatch = GameEventBatchCollection()
+eventQueue = EventQueueResource()
 eventsForGame = EventsForGameResource()
+eventFeedForGame = EventFeedForGameResource()
 eventsForPlayer = EventsForPlayerResource()
 games = GameResource()
 gamesCollection = GameCollection()
@@ -68,6 +241,14 @@ achievementTypes = AchievementTypeResource()
 achievementTypesCollection = AchievementTypeCollection()
 achievementsForPlayer = AchievementsForPlayerResource()
 achievementsForGame = AchievementsForGameResource()
+cacheStats = CacheStatsResource()
+metricsResource = MetricsResource()
+analyticsResource = AnalyticsResource()
+exportResource = ExportResource()
+importResource = ImportResource()
+playerStats = PlayerStatsResource()
+gameStats = GameStatsResource()
+leaderboards = LeaderboardResource()
 
 # Routes
 api.add_route('/players', playersCollection)
@@ -75,18 +256,31 @@ api.add_route('/players/{playerId}', players)
 api.add_route('/players/{playerId}/games', gamesForPlayer)
 api.add_route('/players/{playerId}/events', eventsForPlayer)
 api.add_route('/players/{playerId}/achievements', achievementsForPlayer)
+api.add_route('/players/{playerId}/stats', playerStats)
 
 api.add_route('/games', gamesCollection)
 api.add_route('/games/{gameId}', games)
 api.add_route('/games/{gameId}/players', playersForGame)
 api.add_route('/games/{gameId}/events', eventsForGame)
+api.add_route('/games/{gameId}/events/stream', eventFeedForGame)
 api.add_route('/games/{gameId}/achievements', achievementsForGame)
+api.add_route('/games/{gameId}/stats', gameStats)
 
 api.add_route('/events', eventsCollection)
+api.add_route('/events/batch', eventsBatch)
+api.add_route('/events/queue', eventQueue)
 api.add_route('/events/{eventId}', events)
 
 api.add_route('/achievement-types', achievementTypesCollection)
-api.add_route('/achievement-types/{typeId}', achievementTypes)
+api.add_route('/achievement-types/{achievementTypeId}', achievementTypes)
 
 api.add_route('/achievements', achievementsCollection)
 api.add_route('/achievements/{achievementId}', achievements)
+
+api.add_route('/leaderboard', leaderboards)
+api.add_route('/analytics', analyticsResource)
+
+api.add_route('/cache-stats', cacheStats)
+api.add_route('/admin/export/{model}', exportResource)
+api.add_route('/admin/import/{model}', importResource)
+api.add_route('/metrics', metricsResource)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# Creates, lists and revokes API tokens, see tokens.py. For example:
+#
+#   python manage_tokens.py create scoreboard --read-rate 50 --write-quota 10000
+#   python manage_tokens.py create backups --admin
+#   python manage_tokens.py list
+#   python manage_tokens.py revoke 1
+#
+# Rates are requests per second, and quotas requests per day, for each route
+# class; limits that aren't given are unlimited. Only admin tokens can use the
+# /admin routes. The database defaults to LEDGERMAN_DB, as for the server.
+from models import init_db
+from tokens import ROUTE_CLASSES, ApiToken, tokenStore
+import argparse
+import json
+import sys
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage Ledgerman API tokens')
+    parser.add_argument('--db', help='database to use (default: LEDGERMAN_DB)')
+    commands = parser.add_subparsers(dest='command')
+    createParser = commands.add_parser('create', help='add a token and print it')
+    createParser.add_argument('name')
+    for routeClass in ROUTE_CLASSES:
+        createParser.add_argument('--{0}-rate'.format(routeClass), type=float,
+                                  help='{0} requests per second'.format(routeClass))
+        createParser.add_argument('--{0}-quota'.format(routeClass), type=int,
+                                  help='{0} requests per day'.format(routeClass))
+    createParser.add_argument('--admin', action='store_true', help='allow the /admin routes')
+    commands.add_parser('list', help='print every token\'s id, name and limits')
+    revokeParser = commands.add_parser('revoke', help='stop a token from being accepted')
+    revokeParser.add_argument('id', type=int)
+    args = parser.parse_args()
+
+    init_db(args.db)
+    if args.command == 'create':
+        rates = dict((x, getattr(args, x + '_rate')) for x in ROUTE_CLASSES if getattr(args, x + '_rate') is not None)
+        quotas = dict((x, getattr(args, x + '_quota')) for x in ROUTE_CLASSES if getattr(args, x + '_quota') is not None)
+        print tokenStore.create(args.name.decode('utf-8'), rates, quotas, args.admin)
+    elif args.command == 'list':
+        for apiToken in ApiToken.select(orderBy=ApiToken.q.id):
+            limits = dict(('{0}-{1}'.format(x, kind), getattr(apiToken, x + kind.capitalize()))
+                          for x in ROUTE_CLASSES for kind in ('rate', 'quota'))
+            print json.dumps(dict(limits, id=apiToken.id, name=apiToken.name, active=apiToken.active,
+                                  admin=apiToken.admin),
+                             sort_keys=True)
+    else:
+        try:
+            tokenStore.revoke(args.id)
+        except Exception as ex:
+            sys.stderr.write('{0}\n'.format(ex))
+            sys.exit(1)
@@ -0,0 +1,205 @@
+from collections import defaultdict
+import cProfile
+import os
+import random
+import threading
+import time
+
+# Upper bounds of the histogram buckets, see Histogram
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Fraction of requests profiled when LEDGERMAN_PROFILE_DIR is set, and how
+# slow one has to be for its profile to be kept, see RequestMetrics
+DEFAULT_PROFILE_RATE = 0.01
+DEFAULT_PROFILE_SLOW_MS = 250
+
+
+class Histogram(object):
+    """Counts observations into cumulative buckets, Prometheus style"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """Request, SQL and serialization metrics for one process.
+
+    Everything is labelled by resource class and method, e.g.
+    ('PlayerResource', 'GET'), rather than by path, so there's a bounded
+    number of series."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.sizes = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.statuses = defaultdict(int)
+        self.queries = defaultdict(int)
+        self.queryTime = defaultdict(float)
+        self.serializeTime = defaultdict(float)
+
+    def record(self, request, status, size):
+        labels = request.labels
+        with self.lock:
+            self.latency[labels].observe(request.elapsed())
+            if size is not None:
+                self.sizes[labels].observe(size)
+            self.statuses[labels + (status.split(' ', 1)[0],)] += 1
+            self.queries[labels] += request.queries
+            self.queryTime[labels] += request.queryTime
+            self.serializeTime[labels] += request.serializeTime
+
+    def record_query(self, elapsed):
+        """Counts a query made outside of a request, e.g. by the write-behind writer"""
+        with self.lock:
+            self.queries[BACKGROUND] += 1
+            self.queryTime[BACKGROUND] += elapsed
+
+    def render(self, extra=()):
+        """Formats the metrics, and any extra (name, type, help, value)
+        ones, in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            render_histograms(lines, 'ledgerman_request_duration_seconds',
+                              'Time taken to respond to requests, including streaming the body', self.latency)
+            render_histograms(lines, 'ledgerman_response_size_bytes', 'Size of response bodies', self.sizes)
+            render_counters(lines, 'ledgerman_requests_total', 'Requests by response status', self.statuses,
+                            ('resource', 'method', 'status'))
+            render_counters(lines, 'ledgerman_sql_queries_total', 'SQL queries made', self.queries)
+            render_counters(lines, 'ledgerman_sql_seconds_total', 'Time spent in SQL queries', self.queryTime)
+            render_counters(lines, 'ledgerman_serialization_seconds_total',
+                            'Time spent serializing objects to JSON', self.serializeTime)
+
+        for name, metricType, help, value in extra:
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, metricType))
+            lines.append('{0} {1}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Labels for queries made outside of a request
+BACKGROUND = ('none', 'none')
+
+metrics = Metrics()
+
+# The RequestMetrics of the request being handled by each thread
+local = threading.local()
+
+
+class RequestMetrics(object):
+    """Collects the metrics for one request while it's handled.
+
+    If LEDGERMAN_PROFILE_DIR is set, LEDGERMAN_PROFILE_RATE of requests are
+    run under cProfile, and the profiles of those that take longer than
+    LEDGERMAN_PROFILE_SLOW_MS milliseconds are saved there for pstats."""
+
+    profileDir = os.environ.get('LEDGERMAN_PROFILE_DIR')
+    profileRate = float(os.environ.get('LEDGERMAN_PROFILE_RATE', DEFAULT_PROFILE_RATE))
+    profileSlow = float(os.environ.get('LEDGERMAN_PROFILE_SLOW_MS', DEFAULT_PROFILE_SLOW_MS)) / 1000
+
+    def __init__(self, method):
+        self.labels = ('none', method)
+        self.started = time.time()
+        self.queries = 0
+        self.queryTime = 0.0
+        self.serializeTime = 0.0
+        self.profiler = None
+        if self.profileDir and random.random() < self.profileRate:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def finish(self, status, size):
+        if self.profiler is not None:
+            self.profiler.disable()
+            if self.elapsed() >= self.profileSlow:
+                self.profiler.dump_stats(os.path.join(self.profileDir, '{0}-{1}-{2}-{3:.0f}ms.prof'.format(
+                    time.strftime('%Y%m%d%H%M%S'), self.labels[0], self.labels[1], self.elapsed() * 1000)))
+
+        metrics.record(self, status, size)
+
+
+def start_request(method):
+    local.current = RequestMetrics(method)
+    return local.current
+
+
+def end_request(request, status, size):
+    if getattr(local, 'current', None) is request:
+        local.current = None
+    request.finish(status, size)
+
+
+def count_queries(conn):
+    """Times every query made through conn, and its transactions, and adds
+    them to the metrics of the current request"""
+    executeRetry = conn._executeRetry
+
+    def timed_execute_retry(rawConn, cursor, query):
+        started = time.time()
+        try:
+            return executeRetry(rawConn, cursor, query)
+        finally:
+            elapsed = time.time() - started
+            request = getattr(local, 'current', None)
+            if request is not None:
+                request.queries += 1
+                request.queryTime += elapsed
+            else:
+                metrics.record_query(elapsed)
+
+    conn._executeRetry = timed_execute_retry
+
+
+def add_serialize_time(elapsed):
+    request = getattr(local, 'current', None)
+    if request is not None:
+        request.serializeTime += elapsed
+
+
+def iter_counted(stream, request, status):
+    """Passes a response stream through, recording the request's metrics
+    once it's been sent"""
+    size = 0
+    try:
+        for chunk in stream:
+            size += len(chunk)
+            yield chunk
+    finally:
+        end_request(request, status, size)
+
+
+def render_histograms(lines, name, help, histograms):
+    lines.append('# HELP {0} {1}'.format(name, help))
+    lines.append('# TYPE {0} histogram'.format(name))
+    for labels, histogram in sorted(histograms.iteritems()):
+        labelText = format_labels(('resource', 'method'), labels)
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labelText, bound, count))
+        lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(name, labelText, histogram.count))
+        lines.append('{0}_sum{{{1}}} {2}'.format(name, labelText, histogram.sum))
+        lines.append('{0}_count{{{1}}} {2}'.format(name, labelText, histogram.count))
+
+
+def render_counters(lines, name, help, counters, labelNames=('resource', 'method')):
+    lines.append('# HELP {0} {1}'.format(name, help))
+    lines.append('# TYPE {0} counter'.format(name))
+    for labels, value in sorted(counters.iteritems()):
+        lines.append('{0}{{{1}}} {2}'.format(name, format_labels(labelNames, labels), value))
+
+
+def format_labels(names, values):
+    return ','.join('{0}="{1}"'.format(name, value) for name, value in zip(names, values))
@@ -0,0 +1,210 @@
+from archive import GameArchive
+from models import Player, Game, GameEvent, AchievementType, Achievement, sqlbuilder
+from stats import PlayerStats, GameStats
+from tokens import ApiToken, DEFAULT_TOKEN, hash_token
+import re
+
+# Every model table, in the order they should be created
+TABLES = (Player, Game, GameEvent, AchievementType, Achievement)
+
+# Secondary indexes, as (table, columns). Indexes on a foreign key end with
+# the id column so that keyset pagination over a relationship (WHERE game_id =
+# ? AND id > ? ORDER BY id) is a single index range scan on any database.
+INDEXES = (
+    ('game', ('started_at',)),
+    ('game', ('winner_id',)),
+    ('game_event', ('game_id', 'id')),
+    ('game_event', ('player_id', 'id')),
+    ('game_event', ('to_id', 'id')),
+    ('game_event', ('timestamp',)),
+    ('achievement', ('player_id', 'id')),
+    ('achievement', ('game_id', 'id')),
+    ('achievement', ('achievement_type_id', 'id')),
+    ('achievement', ('timestamp',)),
+    ('game_player', ('game_id', 'player_id')),
+    ('game_player', ('player_id', 'game_id')),
+)
+
+
+def create_tables(conn):
+    """Creates any model tables that don't exist yet.
+
+    Databases created before migrations existed already have them."""
+    for table in TABLES:
+        table.createTable(ifNotExists=True, connection=conn)
+
+
+def create_indexes(conn):
+    for table, columns in INDEXES:
+        conn.query('CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})'.format(
+            index_name(table, columns), table, ', '.join(columns)))
+
+
+STATS_INDEXES = (
+    ('player_stats', ('frags', 'id')),
+    ('player_stats', ('deaths', 'id')),
+    ('player_stats', ('wins', 'id')),
+    ('player_stats', ('games_played', 'id')),
+    ('player_stats', ('achievements', 'id')),
+    ('player_stats', ('damage_dealt', 'id')),
+)
+
+
+def create_stats(conn):
+    """Creates the stats tables and counts everything already in the database"""
+    for table in (PlayerStats, GameStats):
+        table.createTable(ifNotExists=True, connection=conn)
+
+    conn.query("""
+        INSERT INTO player_stats
+            (id, achievements, damage_dealt, damage_taken, deaths, frags, games_played, wins)
+        SELECT p.id,
+            (SELECT COUNT(*) FROM achievement a WHERE a.player_id = p.id),
+            (SELECT COUNT(*) FROM game_event e WHERE e.player_id = p.id AND e.event_type = 'damaged'),
+            (SELECT COUNT(*) FROM game_event e WHERE e.to_id = p.id AND e.event_type = 'damaged'),
+            (SELECT COUNT(*) FROM game_event e WHERE e.to_id = p.id AND e.event_type = 'fragged'),
+            (SELECT COUNT(*) FROM game_event e WHERE e.player_id = p.id AND e.event_type = 'fragged'),
+            (SELECT COUNT(*) FROM game_player gp WHERE gp.player_id = p.id),
+            (SELECT COUNT(*) FROM game g WHERE g.winner_id = p.id)
+        FROM player p""")
+
+    conn.query("""
+        INSERT INTO game_stats (id, damage_events, events, frags, players)
+        SELECT g.id,
+            (SELECT COUNT(*) FROM game_event e WHERE e.game_id = g.id AND e.event_type = 'damaged'),
+            (SELECT COUNT(*) FROM game_event e WHERE e.game_id = g.id),
+            (SELECT COUNT(*) FROM game_event e WHERE e.game_id = g.id AND e.event_type = 'fragged'),
+            (SELECT COUNT(*) FROM game_player gp WHERE gp.game_id = g.id)
+        FROM game g""")
+
+    for table, columns in STATS_INDEXES:
+        conn.query('CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})'.format(
+            index_name(table, columns), table, ', '.join(columns)))
+
+
+def create_resource_versions(conn):
+    """Creates the table of versions that conditional GETs are checked against, see versions.py"""
+    conn.query("""
+        CREATE TABLE resource_version (
+            resource VARCHAR(255) NOT NULL PRIMARY KEY,
+            version INTEGER NOT NULL,
+            modified BIGINT NOT NULL
+        )""")
+
+
+def create_game_archives(conn):
+    """Creates the table that finished games' events are archived in, see archive.py"""
+    GameArchive.createTable(connection=conn)
+    conn.query('CREATE INDEX {0} ON game_archive (last_event_id)'.format(
+        index_name('game_archive', ('last_event_id',))))
+    conn.query("""
+        CREATE TABLE game_archive_player (
+            player_id INTEGER NOT NULL,
+            game_id INTEGER NOT NULL,
+            PRIMARY KEY (player_id, game_id)
+        )""")
+
+
+def create_api_tokens(conn):
+    """Creates the API token table, see tokens.py, with the token that was
+    the only one before, without limits"""
+    ApiToken.createTable(connection=conn)
+    conn.query(conn.sqlrepr(sqlbuilder.Insert(ApiToken.sqlmeta.table, values={
+        ApiToken.sqlmeta.columns['tokenHash'].dbName: hash_token(DEFAULT_TOKEN),
+        ApiToken.sqlmeta.columns['name'].dbName: 'default',
+        ApiToken.sqlmeta.columns['active'].dbName: True,
+    })))
+
+
+def autoincrement_event_ids(conn):
+    """Makes sure event ids are never reused, so archive_game() can delete
+    all of a game's events, and deletes the events it used to leave behind.
+
+    SQLObject creates SQLite tables with AUTOINCREMENT, and sequences never
+    go back on other databases, but tables created without it give a new row
+    the largest id + 1. Those are rebuilt, as SQLite can't alter a column."""
+    if conn.dbName == 'sqlite':
+        sql = conn.queryOne("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'game_event'")[0]
+        if 'AUTOINCREMENT' not in sql.upper():
+            conn.query(re.sub(r'(?i)^CREATE TABLE game_event\b', 'CREATE TABLE game_event_new',
+                              re.sub(r'(?i)\bid INTEGER PRIMARY KEY\b', 'id INTEGER PRIMARY KEY AUTOINCREMENT', sql)))
+            conn.query('INSERT INTO game_event_new SELECT * FROM game_event')
+            conn.query('DROP TABLE game_event')
+            conn.query('ALTER TABLE game_event_new RENAME TO game_event')
+            for table, columns in INDEXES:
+                if table == 'game_event':
+                    conn.query('CREATE INDEX {0} ON {1} ({2})'.format(
+                        index_name(table, columns), table, ', '.join(columns)))
+
+    conn.query("""
+        DELETE FROM game_event WHERE EXISTS (
+            SELECT 1 FROM game_archive a WHERE a.id = game_event.game_id AND a.last_event_id >= game_event.id)""")
+
+
+def add_token_admin(conn):
+    """Adds the admin flag to API tokens, see tokens.py. Only the token that
+    was the only one before can use the /admin routes; other tokens have to
+    be made admin tokens again."""
+    column = ApiToken.sqlmeta.columns['admin']
+    if not column_exists(conn, ApiToken.sqlmeta.table, column.dbName):
+        conn.query('ALTER TABLE {0} ADD COLUMN {1}'.format(
+            ApiToken.sqlmeta.table, conn.createColumn(ApiToken, column)))
+
+    conn.query(conn.sqlrepr(sqlbuilder.Update(ApiToken.sqlmeta.table, {column.dbName: False})))
+    conn.query(conn.sqlrepr(sqlbuilder.Update(
+        ApiToken.sqlmeta.table, {column.dbName: True},
+        where=ApiToken.q.tokenHash == hash_token(DEFAULT_TOKEN))))
+
+
+# Migrations in the order they're applied. A database's schema version is the
+# number of migrations that have been applied to it, so only ever append here.
+MIGRATIONS = (
+    create_tables,
+    create_indexes,
+    create_stats,
+    create_resource_versions,
+    create_game_archives,
+    create_api_tokens,
+    autoincrement_event_ids,
+    add_token_admin,
+)
+
+
+def index_name(table, columns):
+    return 'ix_{0}_{1}'.format(table, '_'.join(columns))
+
+
+def column_exists(conn, table, column):
+    if conn.dbName == 'sqlite':
+        return any(row[1] == column for row in conn.queryAll('PRAGMA table_info({0})'.format(table)))
+
+    return conn.queryOne(
+        "SELECT 1 FROM information_schema.columns WHERE table_name = {0} AND column_name = {1}".format(
+            conn.sqlrepr(table), conn.sqlrepr(column))) is not None
+
+
+def schema_version(conn):
+    """Returns the number of migrations that have been applied to conn's database"""
+    if not conn.tableExists('schema_version'):
+        return 0
+
+    row = conn.queryOne('SELECT version FROM schema_version')
+    return row[0] if row else 0
+
+
+def migrate(conn):
+    """Applies any migrations that haven't been applied to conn's database yet"""
+    version = schema_version(conn)
+    if version >= len(MIGRATIONS):
+        return version
+
+    if not conn.tableExists('schema_version'):
+        conn.query('CREATE TABLE schema_version (version INTEGER NOT NULL)')
+        conn.query('INSERT INTO schema_version (version) VALUES (0)')
+
+    for migration in MIGRATIONS[version:]:
+        migration(conn)
+        version += 1
+        conn.query('UPDATE schema_version SET version = {0}'.format(version))
+
+    return version
@@ -1,29 +1,132 @@
 from sqlobject import SQLObjectNotFound
-from models import Achievement, AchievementType, Player, Game, GameEvent, dump_json, dash_to_camel
+from analytics import GROUP_BY, INTERVALS, aggregate, snapshot
+from analytics import parse_filters as parse_analytics_filters
+from archive import archiveGames, archive_game, delete_archive, find_event, select_all_events, select_events, select_player_events
+from models import Achievement, AchievementType, Player, Game, GameEvent, dump_json, iter_json, iter_json_columns, iter_json_rows, camel_to_dash, dash_to_camel, load_json, split_json_columns, transaction
+from cache import responseCache, invalidate_join, invalidate_object
+from versions import etag, get_version, not_modified
+from feed import feedHub, publish_event, watch_game
+from metrics import metrics
+from writebehind import eventWriter, insert_events
+from stats import GameStats, PlayerStats, StatsDelta, LEADERBOARD_COLUMNS, get_stats, leaderboard
+from transfer import CONTENT_TYPES, check_format, export_rows, get_model, import_rows, iter_lines
+from compression import ENCODINGS, WBITS, decompress, parse_qvalues
 import json
 import falcon
+from functools import partial
 import formencode
 import md5
+import time
+import urllib
+
+# Number of objects returned by collection endpoints when ?limit= isn't given
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Number of players on /leaderboard when ?limit= isn't given
+DEFAULT_LEADERBOARD_SIZE = 10
+
+# Media type of collections written as parallel arrays, see
+# RowWriter.to_json_columns(), which clients ask for with Accept and can send
+# batches in
+JSON_COLUMNS_TYPE = 'application/vnd.ledgerman.columns+json'
+
+# Seconds /games/{gameId}/events/stream waits for new events when ?wait= isn't given
+DEFAULT_FEED_WAIT = 25
+MAX_FEED_WAIT = 300
 
 class Resource(object):
     """Base clase for handling resource objects. 
     Handles basic CRUD operations.
     """
 
+    # Relationships that get_one() can sideload with ?include=, mapped to
+    # the type string of the related objects
+    includes = {}
+
+    # Functions that read the rows of included relationships that aren't all
+    # in the related class's table, like archive.select_events()
+    includeSelects = {}
+
     def __init__(self, typeString, sqlObj):
         self.typeString = typeString
         self.sqlObj = sqlObj
 
-    def list_all(self, req, resp):
-        resp.body = dump_json(list(self.sqlObj.select()), self.typeString)
+    def list_all(self, req, resp, select=None):
+        asColumns = negotiate_columns(req, resp)
+        resp.stream = select_page(req, resp, self.sqlObj, [], self.typeString, select, asColumns)
 
     def get_one(self, req, resp, resourceId):
+        group = (self.sqlObj.__name__, resourceId)
+        if check_version(req, resp, group, exists=partial(object_exists, self.sqlObj, resourceId)):
+            return
+
+        cacheKey = responseCache.key(group, req.query_string)
+        if get_cached(cacheKey, req, resp):
+            return
+
+        jsonDict = self.get_json_dict(req, resourceId)
+        include = req.get_param_as_list('include')
+        if not include:
+            resp.body = json.dumps(jsonDict, default=str)
+        else:
+            jsonDict['included'], links = self.get_included(req, jsonDict['id'], include)
+            if links:
+                jsonDict['links'] = links
+
+            resp.body = json.dumps(jsonDict, default=str)
+
+        responseCache.put(cacheKey, resp.body)
+
+    def get_json_dict(self, req, resourceId):
+        """Reads one resource as a JSON dict, with only the attributes asked
+        for by ?fields[typeString]= if there are any"""
         try:
-            resource = self.sqlObj.get(resourceId)
-            resp.body = dump_json(resource, self.typeString)
-        except SQLObjectNotFound:
+            resourceId = int(resourceId)
+        except ValueError:
             raise falcon.HTTPNotFound()
 
+        columns = requested_fields(req, self.sqlObj, self.typeString)
+        row = self.select_one(resourceId, columns)
+        if row is None:
+            raise falcon.HTTPNotFound()
+
+        return self.sqlObj.row_writer(columns, self.typeString).to_json_dict(row)
+
+    def select_one(self, resourceId, columns):
+        rows, nextAfter = self.sqlObj.select_rows(columns, [self.sqlObj.q.id == resourceId])
+        return rows[0] if rows else None
+
+    def get_included(self, req, resourceId, relAttrs):
+        """Fetches the related objects named by ?include= with one select per
+        relationship.
+
+        Relationships with more than a page of objects are cut short, and a
+        link to the next page of the relationship's endpoint is returned for
+        them."""
+        included = {}
+        links = {}
+        for relAttr in relAttrs:
+            if not self.includes.has_key(relAttr):
+                raise falcon.HTTPBadRequest('Bad Request', "'{0}' can't be included, should be one of {1}".format(
+                    relAttr, ', '.join(sorted(self.includes))))
+
+            manySqlObj, joinClause = self.sqlObj.join_clause(relAttr, resourceId)
+            typeString = self.includes[relAttr]
+            columns = requested_fields(req, manySqlObj, typeString)
+            select = self.includeSelects.get(relAttr)
+            if select is not None:
+                rows, nextAfter = select(resourceId, columns, [], None, MAX_PAGE_SIZE)
+            else:
+                rows, nextAfter = manySqlObj.select_rows(columns, [joinClause], None, MAX_PAGE_SIZE)
+            writer = manySqlObj.row_writer(columns, typeString)
+            included[relAttr] = [writer.to_json_dict(row) for row in rows]
+
+            if nextAfter is not None:
+                links[relAttr] = '{0}/{1}?after={2}'.format(req.path, relAttr, nextAfter)
+
+        return included, links
+
     def create_one(self, req, resp):
         resource = None
         try:
@@ -31,6 +134,7 @@ class Resource(object):
         except ValueError as ex:
             raise falcon.HTTPBadRequest('Bad Request', ex.message)
 
+        invalidate_object(resource)
         return resource
 
     def update_one(self, req, resp, resourceId):
@@ -43,10 +147,13 @@ class Resource(object):
         except SQLObjectNotFound:
             raise falcon.HTTPNotFound()
 
+        # Before and after, in case a relationship changed
+        invalidate_object(resource)
         try:
             resource.update_from_json(req.stream.read(), self.typeString)
         except ValueError as ex:
             raise falcon.HTTPBadRequest('Bad Request', ex.message)
+        invalidate_object(resource)
 
         return resource
 
@@ -56,6 +163,7 @@ class Resource(object):
             return
 
         try:
+            invalidate_object(self.sqlObj.get(resourceId))
             self.sqlObj.delete(resourceId)
         except SQLObjectNotFound:
             pass
@@ -70,19 +178,43 @@ class OneToManyResource(object):
         self.typeString = theManyTypeString
         self.sqlObj = theOneSqlObj
 
-    def get_many_for_one(self, req, resp, resourceId, relAttr):
+    def get_many_for_one(self, req, resp, resourceId, relAttr, select=None):
+        """Responds with a page of the objects related to resourceId through
+        relAttr. They're read by select(resourceId, columns, filters, after,
+        limit), if it's given, for relationships that aren't all in the
+        related class's table, like archive.select_events()."""
+        group = (self.sqlObj.__name__, resourceId, relAttr)
+        asColumns = negotiate_columns(req, resp)
+        variant = '-columns' if asColumns else ''
+        if check_version(req, resp, group, variant, partial(object_exists, self.sqlObj, resourceId)):
+            return
+
+        cacheKey = responseCache.key(group, req.query_string + variant)
+        if get_cached(cacheKey, req, resp):
+            return
+
         resource = None
         try:
             resource = self.sqlObj.get(resourceId)
         except SQLObjectNotFound:
             raise falcon.HTTPNotFound()
 
+        manySqlObj, joinClause = self.sqlObj.join_clause(relAttr, resource.id)
+
+        # Pages are bounded, so unlike list_all this can build the whole
+        # body to cache it rather than stream it
         resp.status = falcon.HTTP_200
-        resp.body = dump_json(getattr(resource, relAttr), self.typeString)
+        if select is not None:
+            select = partial(select, resource.id)
+        resp.body = ''.join(select_page(req, resp, manySqlObj, [joinClause], self.typeString, select, asColumns))
+        responseCache.put(cacheKey, resp.body, resp.get_header('Link'))
 
 
 class PlayerResource(Resource):
 
+    includes = {'games': 'game', 'events': 'event', 'achievements': 'achievement'}
+    includeSelects = {'events': select_player_events}
+
     def __init__(self):
         super(PlayerResource, self).__init__('player', Player)
 
@@ -97,8 +229,13 @@ class PlayerResource(Resource):
         resp.body = dump_json(player, self.typeString)
 
     def on_delete(self, req, resp, playerId):
+        gameIds = get_related_ids(Player, playerId, 'games')
         self.delete_one(req, resp, playerId)
 
+        delta = StatsDelta()
+        delta.remove_player(playerId, gameIds)
+        delta.apply()
+
 
 class PlayerCollection(Resource):
 
@@ -127,6 +264,9 @@ class PlayersForGameResource(OneToManyResource):
 
 class GameResource(Resource):
 
+    includes = {'players': 'player', 'events': 'event', 'achievements': 'achievement'}
+    includeSelects = {'events': select_events}
+
     def __init__(self):
         super(GameResource, self).__init__('game', Game)
 
@@ -134,11 +274,30 @@ class GameResource(Resource):
         self.get_one(req, resp, gameId)
 
     def on_patch(self, req, resp, gameId):
+        oldWinnerId = get_attr_or_none(Game, gameId, 'winnerID')
         resource = self.update_one(req, resp, gameId)
+
+        # A finished game's events can't change any more
+        if archiveGames and not resource.active:
+            archive_game(resource.id)
+
+        if resource.winnerID != oldWinnerId:
+            delta = StatsDelta()
+            delta.add_win(oldWinnerId, -1)
+            delta.add_win(resource.winnerID)
+            delta.apply()
+
         resp.body = dump_json(resource, self.typeString)
 
     def on_delete(self, req, resp, gameId):
+        winnerId = get_attr_or_none(Game, gameId, 'winnerID')
+        playerIds = get_related_ids(Game, gameId, 'players')
         self.delete_one(req, resp, gameId)
+        delete_archive(gameId)
+
+        delta = StatsDelta()
+        delta.remove_game(gameId, playerIds, winnerId)
+        delta.apply()
 
 
 class GameCollection(Resource):
@@ -151,6 +310,11 @@ class GameCollection(Resource):
 
     def on_post(self, req, resp):
         newGame = self.create_one(req, resp)
+
+        delta = StatsDelta()
+        delta.add_win(newGame.winnerID)
+        delta.apply()
+
         resp.body = dump_json(newGame, self.typeString)
 
 
@@ -170,6 +334,12 @@ class GameEventResource(Resource):
     def on_get(self, req, resp, eventId):
         self.get_one(req, resp, eventId)
 
+    def select_one(self, resourceId, columns):
+        row = super(GameEventResource, self).select_one(resourceId, columns)
+        if row is None:
+            row = find_event(resourceId, columns)
+        return row
+
     # No PATCH or DELETE for events. 
 
 
@@ -179,20 +349,22 @@ class GameEventCollection(Resource):
         super(GameEventCollection, self).__init__('event', GameEvent)
 
     def on_get(self, req, resp):
-        self.list_all(req, resp)
+        # Archived events included, like a game's or player's events
+        self.list_all(req, resp, select_all_events)
 
     def on_post(self, req, resp):
         newEvent = None
         try:
-            attrs = GameEvent.parse_json_payload(req.stream.read(), self.typeString)
-
-            try:
-                game = Game.get(attrs['gameID'])
-            except KeyError:
-                raise ValueError("Missing 'game-id' attribute")
+            fkCache = {}
+            attrs = GameEvent.parse_json_payload(req.stream.read(), self.typeString, fkCache=fkCache)
+            check_game_active(attrs, fkCache)
 
-            if not game.active:
-                raise ValueError('Events cannot be created for an inactive game')
+            if eventWriter is not None:
+                provisionalId = eventWriter.offer(attrs, GameEvent.to_row(attrs))
+                if provisionalId is not None:
+                    resp.status = falcon.HTTP_202
+                    resp.body = json.dumps({'provisional-id': provisionalId})
+                    return
 
             newEvent = GameEvent(**attrs)
         except ValueError as ex:
@@ -200,6 +372,12 @@ class GameEventCollection(Resource):
         except formencode.api.Invalid as ex:
             raise falcon.HTTPBadRequest('Bad Request', str(ex))
 
+        invalidate_object(newEvent)
+        publish_event(newEvent)
+
+        delta = StatsDelta()
+        delta.add_event(attrs)
+
         # Mark when a player joins a game. Everyone who ever joined the game is
         # part of the game's players, even if they leave.
         if newEvent.eventType == 'joined':
@@ -208,6 +386,64 @@ class GameEventCollection(Resource):
 
             if player not in game.players:
                 game.addPlayer(player)
+                invalidate_join(Game, game.id, 'players', player.id)
+                delta.add_join(game.id, player.id)
+
+        delta.apply()
+
+
+class GameEventBatchCollection(Resource):
+    """Accepts a JSON array of events and writes all of the valid ones in a
+    single transaction. Invalid events are reported by their index in the
+    array rather than failing the whole batch.
+
+    The events can also be sent as parallel arrays, with the Content-Type
+    JSON_COLUMNS_TYPE, and compressed with Content-Encoding."""
+
+    # Limited separately from other writes, see tokens.py
+    routeClass = 'bulk'
+
+    def __init__(self):
+        super(GameEventBatchCollection, self).__init__('event', GameEvent)
+
+    def on_post(self, req, resp):
+        try:
+            jsonObjs = load_json(read_body(req))
+            if (req.content_type or '').startswith(JSON_COLUMNS_TYPE):
+                jsonObjs = split_json_columns(jsonObjs)
+        except ValueError as ex:
+            raise falcon.HTTPBadRequest('Bad Request', ex.message)
+
+        if type(jsonObjs) != list:
+            raise falcon.HTTPBadRequest('Bad Request', 'Not a JSON array')
+
+        parsed = []
+        errors = []
+        for i, jsonObj in enumerate(jsonObjs):
+            try:
+                parsed.append((i, GameEvent.parse_json_object(jsonObj, self.typeString, checkKeys=False)))
+            except (ValueError, AttributeError) as ex:
+                errors.append({'index': i, 'title': 'Bad Request', 'description': str(ex)})
+
+        # Look up every game and player the batch refers to at once
+        fkCache = {}
+        GameEvent.load_foreign_keys([attrs for i, attrs in parsed], fkCache)
+
+        events = []
+        for i, attrs in parsed:
+            try:
+                GameEvent.check_foreign_keys(attrs, fkCache)
+                check_game_active(attrs, fkCache)
+                events.append((attrs, GameEvent.to_row(attrs)))
+            except (ValueError, SQLObjectNotFound) as ex:
+                errors.append({'index': i, 'title': 'Bad Request', 'description': str(ex)})
+
+        errors.sort(key=lambda error: error['index'])
+
+        with transaction() as trans:
+            insert_events(events, trans)
+
+        resp.body = json.dumps({'accepted': len(events), 'errors': errors})
 
 
 class EventsForPlayerResource(OneToManyResource):
@@ -216,7 +452,7 @@ class EventsForPlayerResource(OneToManyResource):
         super(EventsForPlayerResource, self).__init__('event', Player)
 
     def on_get(self, req, resp, playerId):
-        self.get_many_for_one(req, resp, playerId, 'events')
+        self.get_many_for_one(req, resp, playerId, 'events', select_player_events)
 
 
 class EventsForGameResource(OneToManyResource):
@@ -225,7 +461,45 @@ class EventsForGameResource(OneToManyResource):
         super(EventsForGameResource, self).__init__('event', Game)
 
     def on_get(self, req, resp, gameId):
-        self.get_many_for_one(req, resp, gameId, 'events')
+        self.get_many_for_one(req, resp, gameId, 'events', select_events)
+
+
+class EventFeedForGameResource(object):
+    """Pushes a game's events to watchers as they're written.
+
+    With Accept: text/event-stream the events are streamed as server-sent
+    events for ?wait= seconds, after which the client reconnects, sending the
+    last id it saw as Last-Event-ID. Otherwise this is a long poll: the
+    events after ?after= are returned as soon as there are any, or an empty
+    array after ?wait= seconds."""
+
+    def on_get(self, req, resp, gameId):
+        if Game.select(Game.q.id == gameId).count() == 0:
+            raise falcon.HTTPNotFound()
+
+        after = req.get_param_as_int('after', min=0)
+        if after is None:
+            try:
+                after = int(req.get_header('Last-Event-ID') or 0)
+            except ValueError:
+                raise falcon.HTTPBadRequest('Bad Request', 'Last-Event-ID must be an event id')
+        wait = req.get_param_as_int('wait', min=0, max=MAX_FEED_WAIT)
+        if wait is None:
+            wait = DEFAULT_FEED_WAIT
+
+        # Servers that can wait for events without holding a thread, like
+        # serve_async.py, pass a function to tell them when to carry on
+        notify = req.env.get('ledgerman.notify')
+        watch = watch_game(gameId, after, wait, notify=notify)
+
+        resp.cache_control = ['no-cache']
+        if 'text/event-stream' in (req.accept or ''):
+            resp.content_type = 'text/event-stream'
+            resp.stream = iter_sse(watch)
+        elif notify is not None:
+            resp.stream = iter_long_poll(watch)
+        else:
+            resp.body = ''.join(iter_long_poll(watch))
 
 
 class AchievementTypeResource(Resource):
@@ -234,10 +508,10 @@ class AchievementTypeResource(Resource):
         super(AchievementTypeResource, self).__init__('achievement-type', AchievementType)
 
     def on_get(self, req, resp, achievementTypeId):
-        self.get_one(req, resp, playerId)
+        self.get_one(req, resp, achievementTypeId)
 
     def on_patch(self, req, resp, achievementTypeId):
-        achievementType = self.update_one(req, resp, playerId)
+        achievementType = self.update_one(req, resp, achievementTypeId)
         resp.body = dump_json(achievementType, self.typeString)
 
     def on_delete(self, req, resp, achievementTypeId):
@@ -263,27 +537,44 @@ class AchievementResource(Resource):
         super(AchievementResource, self).__init__('achievement', Achievement)
 
     def on_get(self, req, resp, achievementId):
-        self.get_one(req, resp, playerId)
+        self.get_one(req, resp, achievementId)
 
     def on_patch(self, req, resp, achievementId):
-        achievement = self.update_one(req, resp, playerId)
+        oldPlayerId = get_attr_or_none(Achievement, achievementId, 'playerID')
+        achievement = self.update_one(req, resp, achievementId)
+
+        if achievement.playerID != oldPlayerId:
+            delta = StatsDelta()
+            delta.add_achievement(oldPlayerId, -1)
+            delta.add_achievement(achievement.playerID)
+            delta.apply()
 
         resp.body = dump_json(achievement, self.typeString)
 
     def on_delete(self, req, resp, achievementId):
+        playerId = get_attr_or_none(Achievement, achievementId, 'playerID')
         self.delete_one(req, resp, achievementId)
 
+        delta = StatsDelta()
+        delta.add_achievement(playerId, -1)
+        delta.apply()
+
 
 class AchievementCollection(Resource):
 
     def __init__(self):
-        super(AchievementCollection, self).__init__('achievement-type', Achievement)
+        super(AchievementCollection, self).__init__('achievement', Achievement)
 
     def on_get(self, req, resp):
         self.list_all(req, resp)
 
     def on_post(self, req, resp):
         newAchievement = self.create_one(req, resp)
+
+        delta = StatsDelta()
+        delta.add_achievement(newAchievement.playerID)
+        delta.apply()
+
         resp.body = dump_json(newAchievement, self.typeString)
 
 class AchievementsForPlayerResource(OneToManyResource):
@@ -300,10 +591,360 @@ class AchievementsForGameResource(OneToManyResource):
     def __init__(self):
         super(AchievementsForGameResource, self).__init__('achievement', Game)
 
-    def on_get(self, req, resp, playerId):
+    def on_get(self, req, resp, gameId):
         self.get_many_for_one(req, resp, gameId, 'achievements')
 
 
+class EventQueueResource(object):
+    """Reports how many events are waiting to be written in write-behind mode"""
+
+    def on_get(self, req, resp):
+        if eventWriter is None:
+            resp.body = json.dumps({'depth': 0, 'written': 0, 'failed': 0, 'batches': 0})
+        else:
+            resp.body = json.dumps(eventWriter.counters())
+
+
+class MetricsResource(object):
+    """Serves the process's metrics in the Prometheus text format"""
+
+    def on_get(self, req, resp):
+        cacheCounters = responseCache.counters()
+        feedCounters = feedHub.counters()
+        queueCounters = eventWriter.counters() if eventWriter is not None else {'depth': 0, 'failed': 0}
+
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.body = metrics.render([
+            ('ledgerman_cache_hits_total', 'counter', 'Responses served from the response cache',
+             cacheCounters['hits']),
+            ('ledgerman_cache_misses_total', 'counter', 'Responses not found in the response cache',
+             cacheCounters['misses']),
+            ('ledgerman_cache_entries', 'gauge', 'Responses in the response cache', cacheCounters['size']),
+            ('ledgerman_feed_watchers', 'gauge', 'Clients watching a game\'s events', feedCounters['watchers']),
+            ('ledgerman_feed_dropped_total', 'counter', 'Events dropped from the queues of lagging watchers',
+             feedCounters['dropped']),
+            ('ledgerman_write_queue_depth', 'gauge', 'Events waiting to be written in write-behind mode',
+             queueCounters['depth']),
+            ('ledgerman_write_failed_total', 'counter', 'Events dropped by the write-behind writer',
+             queueCounters['failed']),
+        ])
+
+
+class CacheStatsResource(object):
+
+    def on_get(self, req, resp):
+        resp.body = json.dumps(responseCache.counters())
+
+
+class AnalyticsResource(object):
+    """Counts events, grouped and filtered by their game's type, their type,
+    game and players, and bucketed by time, see analytics.py"""
+
+    def on_get(self, req, resp):
+        if snapshot is None:
+            raise falcon.HTTPNotImplemented('Not Implemented', 'Analytics need NumPy to be installed.')
+
+        try:
+            filters = parse_analytics_filters(req.params)
+        except ValueError as ex:
+            raise falcon.HTTPBadRequest('Bad Request', str(ex))
+
+        groupBy = req.get_param_as_list('group-by') or []
+        for name in groupBy:
+            if name not in GROUP_BY:
+                raise falcon.HTTPBadRequest('Bad Request', "Can't group by '{0}', only by {1}".format(
+                    name, ', '.join(GROUP_BY)))
+
+        interval = req.get_param('interval')
+        if interval is not None and interval not in INTERVALS:
+            raise falcon.HTTPBadRequest('Bad Request', "'interval' must be one of {0}".format(
+                ', '.join(sorted(INTERVALS, key=INTERVALS.get))))
+
+        columns = snapshot.refresh()
+        resp.body = json.dumps({
+            'events': snapshot.count,
+            'last-event-id': snapshot.lastEventId,
+            'results': aggregate(columns, filters, groupBy, INTERVALS.get(interval), snapshot.gameTypes),
+        })
+
+
+class ExportResource(object):
+    """Streams every object of a model as NDJSON or CSV, see transfer.py"""
+
+    routeClass = 'bulk'
+    admin = True
+
+    def on_get(self, req, resp, model):
+        fmt = check_transfer(req, model)
+        resp.content_type = CONTENT_TYPES[fmt]
+        resp.stream = export_rows(model, fmt)
+
+
+class ImportResource(object):
+    """Loads objects of a model from NDJSON or CSV, see transfer.py"""
+
+    routeClass = 'bulk'
+    admin = True
+
+    # Commits a chunk at a time, rather than in one transaction
+    transactional = False
+
+    def on_post(self, req, resp, model):
+        fmt = check_transfer(req, model)
+        resp.body = json.dumps(import_rows(model, iter_lines(req.bounded_stream), fmt))
+
+
+def check_transfer(req, model):
+    """Returns the ?format= of an export or import, checking it and the model"""
+    try:
+        get_model(model)
+    except ValueError as ex:
+        raise falcon.HTTPNotFound(title='Not Found', description=str(ex))
+
+    try:
+        return check_format(req.get_param('format') or 'ndjson')
+    except ValueError as ex:
+        raise falcon.HTTPBadRequest('Bad Request', str(ex))
+
+
+class StatsResource(object):
+    """Serves the running totals kept by the stats module for one object"""
+
+    def __init__(self, typeString, sqlObj, statsClass):
+        self.typeString = typeString
+        self.sqlObj = sqlObj
+        self.statsClass = statsClass
+
+    def get_stats(self, req, resp, resourceId):
+        try:
+            self.sqlObj.get(resourceId)
+        except SQLObjectNotFound:
+            raise falcon.HTTPNotFound()
+
+        resp.body = json.dumps(get_stats(self.statsClass, resourceId, self.typeString))
+
+
+class PlayerStatsResource(StatsResource):
+
+    def __init__(self):
+        super(PlayerStatsResource, self).__init__('player-stats', Player, PlayerStats)
+
+    def on_get(self, req, resp, playerId):
+        self.get_stats(req, resp, playerId)
+
+
+class GameStatsResource(StatsResource):
+
+    def __init__(self):
+        super(GameStatsResource, self).__init__('game-stats', Game, GameStats)
+
+    def on_get(self, req, resp, gameId):
+        self.get_stats(req, resp, gameId)
+
+
+class LeaderboardResource(object):
+
+    def on_get(self, req, resp):
+        orderBy = dash_to_camel(req.get_param('by') or 'frags')
+        if orderBy not in LEADERBOARD_COLUMNS:
+            raise falcon.HTTPBadRequest('Bad Request', "'by' should be one of {0}".format(
+                ', '.join(camel_to_dash(x) for x in LEADERBOARD_COLUMNS)))
+
+        limit = req.get_param_as_int('limit', min=1, max=MAX_PAGE_SIZE) or DEFAULT_LEADERBOARD_SIZE
+        resp.stream = iter_json(leaderboard(orderBy, limit).lazyIter(), 'player-stats')
+
+
+def select_page(req, resp, sqlObj, clauses, typeString, select=None, asColumns=False):
+    """Selects one page of sqlObj rows as requested by the ?after=, ?limit=,
+    ?fields[typeString]= and filter parameters on req, and returns a
+    generator of the page as a JSON array, written straight from the rows,
+    or with asColumns as an object of parallel arrays.
+
+    The rows are read by sqlObj.select_rows(), or select(columns, filters,
+    after, limit) if it's given, for rows that aren't all in sqlObj's table.
+
+    Pages are keyed on id rather than offset, so every page costs the same to
+    fetch. If there are more rows a Link header pointing at the next page is
+    added to resp."""
+    after = req.get_param_as_int('after', min=0)
+    limit = req.get_param_as_int('limit', min=1, max=MAX_PAGE_SIZE)
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+
+    try:
+        filters = sqlObj.parse_filters(req.params)
+    except ValueError as ex:
+        raise falcon.HTTPBadRequest('Bad Request', ex.message)
+
+    columns = requested_fields(req, sqlObj, typeString)
+    if select is None:
+        rows, nextAfter = sqlObj.select_rows(columns, clauses + sqlObj.filter_clauses(filters), after, limit)
+    else:
+        rows, nextAfter = select(columns, filters, after, limit)
+    if nextAfter is not None:
+        params = dict(req.params)
+        params['after'] = nextAfter
+        resp.add_link('{0}?{1}'.format(req.path, urllib.urlencode(params, True)), 'next')
+
+    writer = sqlObj.row_writer(columns, typeString)
+    if asColumns:
+        return iter_json_columns(rows, writer)
+    return iter_json_rows(rows, writer)
+
+
+def negotiate_columns(req, resp):
+    """Returns whether the client asked for a collection as parallel arrays,
+    setting the response's Content-Type to match. They have to be asked for
+    by name, with a q-value at least that of plain JSON."""
+    resp.append_header('Vary', 'Accept')
+    accepted = parse_qvalues(req.get_header('Accept'))
+    columnsQ = accepted.get(JSON_COLUMNS_TYPE, 0)
+    jsonQ = accepted.get('application/json', accepted.get('application/*', accepted.get('*/*', 0)))
+    if columnsQ <= 0 or columnsQ < jsonQ:
+        return False
+
+    resp.content_type = JSON_COLUMNS_TYPE
+    return True
+
+
+def read_body(req):
+    """Reads the request's body, decompressing it if it has a Content-Encoding"""
+    body = req.stream.read()
+    encoding = (req.get_header('Content-Encoding') or 'identity').strip().lower()
+    if encoding == 'identity':
+        return body
+
+    if encoding not in WBITS:
+        raise falcon.HTTPUnsupportedMediaType("Content-Encoding must be one of {0}".format(
+            ', '.join(coding for coding, wbits in ENCODINGS)))
+    return decompress(body, encoding)
+
+
+def requested_fields(req, sqlObj, typeString):
+    """Returns the columns named by ?fields[typeString]=, or None to send
+    every attribute"""
+    names = req.get_param_as_list('fields[{0}]'.format(typeString))
+    if not names:
+        return None
+
+    try:
+        return sqlObj.field_columns(names)
+    except ValueError as ex:
+        raise falcon.HTTPBadRequest('Bad Request', ex.message)
+
+
+def check_version(req, resp, group, variant='', exists=None):
+    """Answers a conditional GET for the responses in group with 304 Not
+    Modified if the client's copy is current, and returns whether it did.
+
+    Otherwise sets the ETag and Last-Modified headers for the response.
+    variant tells representations of the same version apart, see etag().
+    exists, if given, is called before answering 304, and the answer is 404
+    Not Found instead if it returns False."""
+    version, modified = get_version(group)
+    if not_modified(req, version, modified, variant):
+        if exists is not None and not exists():
+            raise falcon.HTTPNotFound()
+
+        resp.status = falcon.HTTP_304
+        return True
+
+    resp.etag = etag(version, modified, variant)
+    if modified is not None:
+        resp.last_modified = modified
+
+    return False
+
+
+def get_cached(cacheKey, req, resp):
+    """Sets the response from the cache if cacheKey has an entry, and
+    returns whether it did. Either way the key is kept in the request's
+    context, so CompressionMiddleware can cache the compressed body too."""
+    req.context['cacheKey'] = cacheKey
+    cached = responseCache.get(cacheKey)
+    if cached is None:
+        resp.set_header('X-Cache', 'MISS')
+        return False
+
+    resp.body, link = cached
+    if link is not None:
+        resp.set_header('Link', link)
+    resp.set_header('X-Cache', 'HIT')
+
+    return True
+
+
+def object_exists(sqlObj, resourceId):
+    rows, nextAfter = sqlObj.select_rows([], [sqlObj.q.id == resourceId])
+    return bool(rows)
+
+
+def get_attr_or_none(sqlObj, resourceId, attrName):
+    """Returns an attribute of the object with id resourceId, or None if
+    there is no such object"""
+    try:
+        return getattr(sqlObj.get(resourceId), attrName)
+    except SQLObjectNotFound:
+        return None
+
+
+def get_related_ids(sqlObj, resourceId, relAttr):
+    """Returns the ids of the objects related to resourceId through relAttr"""
+    otherClass, clause = sqlObj.join_clause(relAttr, resourceId)
+    rows, nextAfter = otherClass.select_rows([], [clause])
+    return [row[0] for row in rows]
+
+
+def check_game_active(attrs, fkCache=None):
+    """Raises ValueError unless the event attributes point to an active game.
+
+    fkCache, if given, is the one passed to parse_json_object(), and the
+    game is taken from it if it was loaded there."""
+    gameId = attrs.get('gameID')
+    if gameId is None:
+        raise ValueError("Missing 'game-id' attribute")
+
+    game = fkCache.get(('Game', gameId)) if fkCache is not None else None
+    if not isinstance(game, Game):
+        game = Game.get(gameId)
+        if fkCache is not None:
+            fkCache[('Game', gameId)] = game
+
+    if not game.active:
+        raise ValueError('Events cannot be created for an inactive game')
+
+    return game
+
+
+def iter_sse(watch):
+    """Formats the lists of events generated by watch_game() as server-sent
+    events, with a comment for each empty list to keep the connection alive"""
+    for events in watch:
+        if events is None:
+            # Not ready, see watch_game()
+            yield ''
+        elif not events:
+            yield ': {0}\n\n'.format(int(time.time()))
+        for eventId, body in events or ():
+            yield 'id: {0}\ndata: {1}\n\n'.format(eventId, body)
+
+
+def iter_long_poll(watch):
+    """Generates the first non-empty list of events generated by
+    watch_game() as a JSON array, or an empty one once it's done waiting"""
+    events = []
+    try:
+        for events in watch:
+            if events is None:
+                yield ''
+            elif events:
+                break
+    finally:
+        watch.close()
+
+    yield '[{0}]'.format(','.join(body for eventId, body in events or ()))
+
+
 def gen_gravatar_url(email):
     email = email.strip().lower()
     return 'https://www.gravatar.com/avatar/' + md5.md5(email).hexdigest() 
@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+# Serves the API from one process with an event loop, rather than a WSGI
+# server's thread or process per connection:
+#
+#   python serve_async.py --port 8000 --db-threads 8
+#
+# Connections are read and written by the loop, so idle keep-alive clients
+# and clients watching a game cost no threads. Each request, and each chunk
+# of a streamed response, is run through the same falcon app on a pool of
+# --db-threads threads, which bounds the database connections and work in
+# flight. The database defaults to LEDGERMAN_DB, as for the server.
+from collections import deque
+from StringIO import StringIO
+import argparse
+import asyncore
+import email.utils
+import errno
+import logging
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+import urllib
+
+# Threads that run requests, and so hold database connections
+DEFAULT_DB_THREADS = 8
+
+# Seconds an idle keep-alive connection is kept open
+DEFAULT_KEEPALIVE_TIMEOUT = 75
+
+# Largest request head, and body, that's read; bodies are read whole, so
+# import large files with transfer_data.py
+MAX_HEADER_SIZE = 65536
+DEFAULT_MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# Bytes of a streamed response read from the app at once, and the most that
+# are buffered for a slow client before waiting for it to catch up
+PULL_SIZE = 65536
+OUTPUT_BUFFER_SIZE = 262144
+
+# Statuses, besides 1xx, whose responses have no body
+BODILESS = ('204', '304')
+
+log = logging.getLogger(__name__)
+
+
+class ThreadPool(object):
+    """A fixed number of threads running the functions passed to submit().
+
+    Each thread has its own queue, so that a task can be run on the same
+    thread as an earlier one, see submit_to(): the rest of a streamed
+    response may need e.g. a database cursor, which can only be used from
+    the thread that opened it. Other tasks go to the least busy thread."""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.queues = [Queue.Queue() for i in xrange(size)]
+        self.loads = [0] * size
+        self.threads = []
+        for i in xrange(size):
+            thread = threading.Thread(target=self.run, args=(i,), name='db-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        with self.lock:
+            index = self.loads.index(min(self.loads))
+        self.submit_to(index, func, *args)
+
+    def submit_to(self, index, func, *args):
+        """Runs func(*args) on the thread numbered index, see current()"""
+        with self.lock:
+            self.loads[index] += 1
+        self.queues[index].put((func, args))
+
+    def current(self):
+        """Returns the number of the pool thread calling it"""
+        return self.local.index
+
+    def run(self, index):
+        self.local.index = index
+        while True:
+            func, args = self.queues[index].get()
+            if func is None:
+                return
+            try:
+                func(*args)
+            except Exception:
+                log.exception('Task failed')
+            finally:
+                with self.lock:
+                    self.loads[index] -= 1
+
+    def stop(self):
+        for tasks in self.queues:
+            tasks.put((None, None))
+
+
+class Waker(asyncore.file_dispatcher):
+    """Runs functions passed to call_soon() from other threads on the loop,
+    waking it through a pipe"""
+
+    def __init__(self, socketMap):
+        self.readFd, self.writeFd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.readFd, socketMap)
+        self.lock = threading.Lock()
+        self.calls = deque()
+
+    def call_soon(self, func, *args):
+        with self.lock:
+            wake = not self.calls
+            self.calls.append((func, args))
+        if wake:
+            try:
+                os.write(self.writeFd, 'x')
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        with self.lock:
+            calls, self.calls = self.calls, deque()
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception:
+                log.exception('Callback failed')
+
+    def handle_close(self):
+        pass
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.writeFd)
+
+
+class Response(object):
+    """The state of the response to one request: the app's iterable, and
+    whether more of it is being, or waiting to be, read"""
+
+    def __init__(self, channel, environ):
+        self.channel = channel
+        self.environ = environ
+        self.status = None
+        self.headers = None
+        self.iterable = None
+        self.iterator = None
+        self.thread = None
+        self.headersSent = False
+        self.chunked = False
+        self.running = False
+        self.waiting = False
+        self.notified = False
+        self.done = False
+
+    def notify(self):
+        # Called from any thread, see feed.watch_game()
+        self.channel.server.waker.call_soon(self.channel.notified, self)
+
+
+class HTTPChannel(asyncore.dispatcher):
+    """One client connection, reading HTTP/1.1 requests and writing their
+    responses without blocking. Requests are answered one at a time, in the
+    order they're read."""
+
+    def __init__(self, server, sock, addr):
+        asyncore.dispatcher.__init__(self, sock, server.socketMap)
+        self.server = server
+        self.addr = addr
+        self.inBuffer = ''
+        self.request = None
+        self.bodyLength = 0
+        self.bodyChunks = []
+        self.bodySize = 0
+        self.outBuffer = deque()
+        self.outSize = 0
+        self.response = None
+        self.keepAlive = True
+        self.closing = False
+        self.lastActive = time.time()
+
+    def readable(self):
+        return self.response is None and not self.closing
+
+    def writable(self):
+        return self.outSize > 0 or (self.closing and self.connected)
+
+    def handle_read(self):
+        try:
+            data = self.recv(65536)
+        except socket.error:
+            self.close()
+            return
+
+        self.lastActive = time.time()
+        if not data:
+            return
+
+        # Bodies are kept in pieces until they're complete, rather than
+        # copied every time more arrives
+        if self.request is None:
+            self.inBuffer += data
+        else:
+            self.bodyChunks.append(data)
+            self.bodySize += len(data)
+        self.read_request()
+
+    def read_request(self):
+        """Starts the next request once it's all been read"""
+        if self.response is not None or self.closing:
+            return
+
+        if self.request is None:
+            end = self.inBuffer.find('\r\n\r\n')
+            if end < 0:
+                if len(self.inBuffer) > MAX_HEADER_SIZE:
+                    self.respond_error('431 Request Header Fields Too Large')
+                return
+
+            try:
+                environ = self.parse_head(self.inBuffer[:end])
+            except ValueError as ex:
+                self.respond_error('400 Bad Request', str(ex))
+                return
+
+            if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+                self.respond_error('411 Length Required')
+                return
+
+            self.bodyLength = int(environ.get('CONTENT_LENGTH') or 0)
+            if self.bodyLength > self.server.maxBodySize:
+                self.respond_error('413 Payload Too Large')
+                return
+
+            self.request = environ
+            self.bodyChunks = [self.inBuffer[end + 4:]]
+            self.bodySize = len(self.bodyChunks[0])
+            self.inBuffer = ''
+            if self.bodySize < self.bodyLength and environ.get('HTTP_EXPECT', '').lower() == '100-continue':
+                self.write('HTTP/1.1 100 Continue\r\n\r\n')
+
+        if self.bodySize < self.bodyLength:
+            return
+
+        data = ''.join(self.bodyChunks)
+        environ, self.request = self.request, None
+        self.inBuffer = data[self.bodyLength:]
+        self.bodyChunks = []
+        self.bodySize = 0
+        environ['wsgi.input'] = StringIO(data[:self.bodyLength])
+
+        self.response = Response(self, environ)
+        self.response.running = True
+        environ['ledgerman.notify'] = self.response.notify
+        self.server.pool.submit(self.server.start_response, self.response)
+
+    def parse_head(self, head):
+        lines = head.split('\r\n')
+        try:
+            method, target, protocol = lines[0].split(' ')
+        except ValueError:
+            raise ValueError('Bad request line')
+        if not protocol.startswith('HTTP/1.'):
+            raise ValueError('Unsupported protocol {0}'.format(protocol))
+
+        path, sep, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.host,
+            'SERVER_PORT': str(self.server.port),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': self.addr[0] if isinstance(self.addr, tuple) else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise ValueError('Bad header line')
+            name = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ',' + value if key in environ else value
+
+        if environ.get('CONTENT_LENGTH') and not environ['CONTENT_LENGTH'].isdigit():
+            raise ValueError('Bad Content-Length')
+
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if protocol == 'HTTP/1.0':
+            self.keepAlive = 'keep-alive' in connection
+        else:
+            self.keepAlive = 'close' not in connection
+
+        return environ
+
+    def respond_error(self, status, description=''):
+        self.write('HTTP/1.1 {0}\r\nContent-Length: {1}\r\nConnection: close\r\n\r\n{2}'.format(
+            status, len(description), description))
+        self.closing = True
+
+    def write(self, data):
+        if data:
+            self.outBuffer.append(data)
+            self.outSize += len(data)
+
+    def handle_write(self):
+        data = ''.join(self.outBuffer)
+        try:
+            sent = self.send(data) if data else 0
+        except socket.error:
+            self.close()
+            return
+
+        self.lastActive = time.time()
+        self.outBuffer.clear()
+        self.outSize = len(data) - sent
+        if self.outSize:
+            self.outBuffer.append(data[sent:])
+        elif self.closing:
+            self.close()
+            return
+
+        response = self.response
+        if response is not None and not response.running and not response.waiting and not response.done and \
+                self.outSize < OUTPUT_BUFFER_SIZE:
+            self.pull(response)
+
+    def pulled(self, response, data, done, failed):
+        """Writes what a pool thread read from the app, see AsyncServer.pull()"""
+        response.running = False
+        if response is not self.response:
+            # The connection was closed while this was read
+            self.close_iterable(response)
+            return
+
+        if not response.headersSent:
+            if failed:
+                self.respond_error('500 Internal Server Error')
+                self.response = None
+                return
+            self.write_head(response)
+
+        if data and not self.bodiless(response):
+            self.write('{0:x}\r\n{1}\r\n'.format(len(data), data) if response.chunked else data)
+
+        if failed:
+            # The response can't be finished properly, so the client
+            # should notice that it's been cut short
+            self.closing = True
+            self.response = None
+        elif done:
+            response.done = True
+            if response.chunked:
+                self.write('0\r\n\r\n')
+            self.response = None
+            if not self.keepAlive:
+                self.closing = True
+            else:
+                self.read_request()
+        elif not data:
+            # Not ready, see feed.watch_game()
+            if response.notified:
+                self.pull(response)
+            else:
+                response.waiting = True
+        elif self.outSize < OUTPUT_BUFFER_SIZE:
+            self.pull(response)
+
+    def notified(self, response):
+        if response is not self.response or response.done:
+            return
+
+        if response.waiting:
+            self.pull(response)
+        elif response.running:
+            response.notified = True
+
+    def pull(self, response):
+        response.running = True
+        response.waiting = False
+        response.notified = False
+        # On the thread the response was started on, see ThreadPool
+        self.server.pool.submit_to(response.thread, self.server.pull, response)
+
+    def bodiless(self, response):
+        return response.environ['REQUEST_METHOD'] == 'HEAD' or response.status.startswith('1') or \
+            response.status.split(' ', 1)[0] in BODILESS
+
+    def write_head(self, response):
+        response.headersSent = True
+        names = set(name.lower() for name, value in response.headers)
+        headers = list(response.headers)
+        if 'date' not in names:
+            headers.append(('Date', email.utils.formatdate(usegmt=True)))
+
+        if 'content-length' not in names and not self.bodiless(response):
+            if response.environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                response.chunked = True
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                self.keepAlive = False
+
+        if not self.keepAlive:
+            headers.append(('Connection', 'close'))
+        elif response.environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+            headers.append(('Connection', 'keep-alive'))
+
+        self.write('HTTP/1.1 {0}\r\n{1}\r\n'.format(
+            response.status, ''.join('{0}: {1}\r\n'.format(name, value) for name, value in headers)))
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        response, self.response = self.response, None
+        asyncore.dispatcher.close(self)
+        self.server.channels.discard(self)
+        if response is not None and not response.running:
+            # Let go of e.g. a feed subscription now, rather than when it
+            # would next have been read; a running read does it in pulled()
+            self.close_iterable(response)
+
+    def close_iterable(self, response):
+        if response.thread is not None:
+            self.server.pool.submit_to(response.thread, self.server.close_iterable, response)
+
+    def handle_error(self):
+        log.exception('Connection from %s failed', self.addr)
+        self.close()
+
+
+class Listener(asyncore.dispatcher):
+
+    def __init__(self, server, host, port):
+        asyncore.dispatcher.__init__(self, map=server.socketMap)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(1024)
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is not None:
+            sock, addr = pair
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.server.channels.add(HTTPChannel(self.server, sock, addr))
+
+
+class AsyncServer(object):
+    """Serves a WSGI app from an event loop, running the app on a bounded
+    pool of threads.
+
+    A streamed response is read from the app a piece at a time as the client
+    takes it, always on the pool thread that called the app. A piece that's
+    empty means it isn't ready: the server waits for the app to call
+    environ['ledgerman.notify']() before reading on, so watchers of a game
+    hold no thread while they wait."""
+
+    def __init__(self, app, host='127.0.0.1', port=8000, dbThreads=DEFAULT_DB_THREADS,
+                 keepAliveTimeout=DEFAULT_KEEPALIVE_TIMEOUT, maxBodySize=DEFAULT_MAX_BODY_SIZE):
+        self.app = app
+        self.socketMap = {}
+        self.channels = set()
+        self.keepAliveTimeout = keepAliveTimeout
+        self.maxBodySize = maxBodySize
+        self.listener = Listener(self, host, port)
+        self.host, self.port = self.listener.socket.getsockname()[:2]
+        self.waker = Waker(self.socketMap)
+        self.pool = ThreadPool(dbThreads)
+        self.running = False
+
+    def serve_forever(self):
+        self.running = True
+        checked = time.time()
+        while self.running:
+            asyncore.loop(timeout=1, use_poll=True, map=self.socketMap, count=1)
+            if time.time() - checked >= 1:
+                checked = time.time()
+                self.close_idle()
+
+        for channel in list(self.channels):
+            channel.close()
+        self.listener.close()
+        self.waker.close()
+        self.pool.stop()
+
+    def stop(self):
+        """Stops serve_forever(), from any thread"""
+        self.waker.call_soon(setattr, self, 'running', False)
+
+    def close_idle(self):
+        deadline = time.time() - self.keepAliveTimeout
+        for channel in list(self.channels):
+            if channel.response is None and channel.outSize == 0 and channel.lastActive < deadline:
+                channel.close()
+
+    # Run on the pool
+
+    def start_response(self, response):
+        """Calls the app, then reads the first piece of its response"""
+        response.thread = self.pool.current()
+
+        def start(status, headers, exc_info=None):
+            if exc_info is not None and response.headersSent:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            response.status = status
+            response.headers = headers
+
+        try:
+            response.iterable = self.app(response.environ, start)
+        except Exception:
+            log.exception('Request failed')
+            self.waker.call_soon(response.channel.pulled, response, '', True, True)
+            return
+
+        self.pull(response)
+
+    def pull(self, response):
+        """Reads up to PULL_SIZE bytes of the response, stopping early at an
+        empty piece, and passes them to the loop"""
+        chunks = []
+        size = 0
+        done = failed = False
+        try:
+            if response.iterator is None:
+                response.iterator = iter(response.iterable)
+            while size < PULL_SIZE:
+                chunk = next(response.iterator)
+                if not chunk:
+                    break
+                chunks.append(chunk if isinstance(chunk, str) else chunk.encode('utf-8'))
+                size += len(chunk)
+        except StopIteration:
+            done = True
+        except Exception:
+            log.exception('Streaming a response failed')
+            failed = True
+
+        if done or failed:
+            self.close_iterable(response)
+        self.waker.call_soon(response.channel.pulled, response, ''.join(chunks), done, failed)
+
+    def close_iterable(self, response):
+        response.done = True
+        close = getattr(response.iterable, 'close', None)
+        response.iterable = response.iterator = None
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                log.exception('Closing a response failed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the Ledgerman API from an event loop')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--db', help='database to use (default: LEDGERMAN_DB)')
+    parser.add_argument('--db-threads', type=int,
+                        default=int(os.environ.get('LEDGERMAN_DB_THREADS', DEFAULT_DB_THREADS)),
+                        help='threads running requests (default: LEDGERMAN_DB_THREADS, or 8)')
+    parser.add_argument('--keepalive', type=float, default=DEFAULT_KEEPALIVE_TIMEOUT,
+                        help='seconds idle connections are kept open')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    if args.db:
+        os.environ['LEDGERMAN_DB'] = args.db
+    # ledgerman connects to LEDGERMAN_DB when it's imported
+    from ledgerman import api
+
+    server = AsyncServer(api, args.host, args.port, args.db_threads, args.keepalive)
+    print 'Listening on http://{0}:{1}/ with {2} database threads'.format(server.host, server.port, args.db_threads)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+from collections import defaultdict
+import json
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import time
+import urlparse
+
+# Channels that workers publish on: the groups of cached responses that
+# changed, see cache.py, the events written to games, see feed.py, and the
+# API tokens that changed, see tokens.py
+INVALIDATE_CHANNEL = 'invalidate'
+FEED_CHANNEL = 'feed'
+TOKEN_CHANNEL = 'tokens'
+
+# Prefix of the Redis keys and channels used, so one server can be shared
+DEFAULT_REDIS_PREFIX = 'ledgerman:'
+
+# Seconds between attempts to reconnect to Redis to listen for messages
+REDIS_RETRY_INTERVAL = 1
+
+# Seconds to wait for Redis to accept a connection or answer a command
+DEFAULT_REDIS_TIMEOUT = 5
+
+# TCP keepalive for the connection messages are read from, which is idle
+# between messages so can't have a read timeout: probes start after it's been
+# idle this many seconds, and it's dropped if this many go unanswered
+REDIS_KEEPALIVE_IDLE = 30
+REDIS_KEEPALIVE_PROBES = 3
+
+log = logging.getLogger(__name__)
+
+
+class SharedState(object):
+    """State shared by every worker process of every node: counters, and
+    messages published to the other workers.
+
+    Messages are JSON values, published on a channel to every subscriber of
+    it in every other worker; a worker applies its own changes as it makes
+    them. Delivery is best effort, so subscribers should only use messages to
+    find out about changes sooner, e.g. to invalidate caches that expire
+    anyway."""
+
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+        self.pid = None
+        self.originId = None
+
+    @property
+    def origin(self):
+        """Identifies this worker in the messages it publishes"""
+        self.check_fork()
+        return self.originId
+
+    def check_fork(self):
+        """Gives a forked worker its own origin, even if the state was
+        created before forking, e.g. by gunicorn --preload"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.originId = '{0}-{1}-{2:x}'.format(socket.gethostname(), self.pid, random.getrandbits(32))
+            self.forked()
+
+    def forked(self):
+        pass
+
+    def subscribe(self, channel, callback):
+        """Calls callback(message) for each message other workers publish on channel"""
+        self.subscribers[channel].append(callback)
+
+    def receive(self, channel, payload):
+        origin, message = json.loads(payload)
+        if origin == self.origin:
+            return
+
+        for callback in self.subscribers.get(channel, ()):
+            try:
+                callback(message)
+            except Exception:
+                log.exception('Handling a message on %s failed', channel)
+
+    def encode(self, message):
+        return json.dumps([self.origin, message], separators=(',', ':'))
+
+
+class LocalBroker(object):
+    """Stands in for a Redis server within one process, for LocalState"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = []
+        self.counters = {}
+
+    def publish(self, channel, payload):
+        with self.lock:
+            states = list(self.states)
+
+        for state in states:
+            state.receive(channel, payload)
+
+    def incr(self, key, amount, ttl):
+        with self.lock:
+            value, expiry = self.counters.get(key, (0, None))
+            if expiry is not None and expiry <= time.time():
+                value, expiry = 0, None
+            if expiry is None and ttl:
+                expiry = time.time() + ttl
+
+            value += amount
+            self.counters[key] = (value, expiry)
+            return value
+
+    def get(self, key):
+        with self.lock:
+            value, expiry = self.counters.get(key, (0, None))
+            return value if expiry is None or expiry > time.time() else 0
+
+
+class LocalState(SharedState):
+    """Shared state for a single worker process, or several SharedStates in
+    one process connected to the same LocalBroker. Messages are delivered
+    synchronously, in the publishing thread."""
+
+    def __init__(self, broker=None):
+        super(LocalState, self).__init__()
+        self.broker = broker or LocalBroker()
+        with self.broker.lock:
+            self.broker.states.append(self)
+
+    def publish(self, channel, message):
+        self.broker.publish(channel, self.encode(message))
+
+    def incr(self, key, amount=1, ttl=None):
+        """Adds amount to the counter key, which is reset ttl seconds after
+        it's created if ttl is given, and returns its new value"""
+        return self.broker.incr(key, amount, ttl)
+
+    def get(self, key):
+        """Returns the value of the counter key, or 0 if it doesn't exist"""
+        return self.broker.get(key)
+
+
+class RedisError(Exception):
+    """An error reply from Redis"""
+
+
+class RedisState(SharedState):
+    """Shared state kept in a Redis server, or anything that speaks its
+    protocol. Needs no client library.
+
+    Commands are sent over one connection per process, and messages read by
+    a thread with its own connection, which reconnects if it's lost.
+    Connecting and commands time out after timeout seconds, so a server that
+    stops answering can't hold up requests; the listening connection is
+    checked with TCP keepalives instead."""
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, prefix=DEFAULT_REDIS_PREFIX,
+                 timeout=DEFAULT_REDIS_TIMEOUT):
+        super(RedisState, self).__init__()
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.conn = None
+        self.listener = None
+        self.listenConn = None
+
+    @classmethod
+    def from_url(cls, url):
+        """Creates a RedisState for a URL like redis://:password@host:6379/0,
+        optionally with ?prefix= and ?timeout= in seconds"""
+        parts = urlparse.urlparse(url)
+        query = urlparse.parse_qs(parts.query)
+        return cls(parts.hostname or 'localhost', parts.port or 6379, int(parts.path.strip('/') or 0),
+                   parts.password, query.get('prefix', [DEFAULT_REDIS_PREFIX])[0],
+                   float(query.get('timeout', [DEFAULT_REDIS_TIMEOUT])[0]))
+
+    def forked(self):
+        # Connections and threads belong to the parent process
+        self.conn = None
+        self.listenConn = None
+        self.listener = None
+        if self.subscribers:
+            self.start_listener()
+
+    def start_listener(self):
+        self.listener = threading.Thread(target=self.listen, name='redis-listener')
+        self.listener.daemon = True
+        self.listener.start()
+
+    def connect(self, listening=False):
+        conn = RedisConnection(self.host, self.port, self.timeout)
+        if self.password:
+            conn.command('AUTH', self.password)
+        if self.db:
+            conn.command('SELECT', self.db)
+        if listening:
+            conn.listen()
+        return conn
+
+    def command(self, *args):
+        self.check_fork()
+        with self.lock:
+            # Retry once, in case the server closed an idle connection
+            for attempt in (0, 1):
+                try:
+                    if self.conn is None:
+                        self.conn = self.connect()
+                    return self.conn.command(*args)
+                except (socket.error, EOFError):
+                    if self.conn is not None:
+                        self.conn.close()
+                        self.conn = None
+                    if attempt:
+                        raise
+
+    def publish(self, channel, message):
+        try:
+            self.command('PUBLISH', self.prefix + channel, self.encode(message))
+        except (socket.error, EOFError) as ex:
+            log.warning('Publishing on %s failed: %s', channel, ex)
+
+    def incr(self, key, amount=1, ttl=None):
+        """Adds amount to the counter key, which expires ttl seconds after
+        it's created if ttl is given, and returns its new value"""
+        value = self.command('INCRBY', self.prefix + key, amount)
+        if ttl and value == amount:
+            self.command('PEXPIRE', self.prefix + key, int(math.ceil(ttl * 1000)))
+        return value
+
+    def get(self, key):
+        """Returns the value of the counter key, or 0 if it doesn't exist"""
+        return int(self.command('GET', self.prefix + key) or 0)
+
+    def subscribe(self, channel, callback):
+        self.check_fork()
+        with self.lock:
+            super(RedisState, self).subscribe(channel, callback)
+            if self.listener is None:
+                self.start_listener()
+            elif self.listenConn is not None:
+                try:
+                    self.listenConn.send('SUBSCRIBE', self.prefix + channel)
+                except socket.error:
+                    pass
+
+    def listen(self, sleep=time.sleep):
+        # sleep is bound early as module globals are cleared when Python exits
+        while True:
+            try:
+                conn = self.connect(listening=True)
+                with self.lock:
+                    self.listenConn = conn
+                    channels = [self.prefix + channel for channel in self.subscribers]
+                conn.send('SUBSCRIBE', *channels)
+
+                while True:
+                    reply = conn.read_reply()
+                    if reply[0] == 'message':
+                        self.receive(reply[1][len(self.prefix):], reply[2])
+            except (socket.error, EOFError, RedisError) as ex:
+                log.warning('Listening to Redis failed, reconnecting: %s', ex)
+                with self.lock:
+                    self.listenConn = None
+                sleep(REDIS_RETRY_INTERVAL)
+
+
+class RedisConnection(object):
+    """A connection speaking the Redis protocol, RESP.
+
+    Connecting, and reading replies, raise socket.timeout after timeout
+    seconds. A reply that times out may have been partly read, so the
+    connection should be closed."""
+
+    def __init__(self, host, port, timeout=DEFAULT_REDIS_TIMEOUT):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def listen(self):
+        """Waits for replies without a timeout, for reading published
+        messages, relying on TCP keepalive to notice a dead connection"""
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Linux only; elsewhere the system's keepalive settings apply
+        for option, value in (('TCP_KEEPIDLE', REDIS_KEEPALIVE_IDLE),
+                              ('TCP_KEEPINTVL', REDIS_KEEPALIVE_IDLE // REDIS_KEEPALIVE_PROBES),
+                              ('TCP_KEEPCNT', REDIS_KEEPALIVE_PROBES)):
+            if hasattr(socket, option):
+                self.sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def command(self, *args):
+        self.send(*args)
+        return self.read_reply()
+
+    def send(self, *args):
+        self.sock.sendall(encode_command(args))
+
+    def read_reply(self):
+        return read_reply(self.reader)
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+def encode_command(args):
+    """Encodes a command as a RESP array of bulk strings"""
+    parts = ['*{0}\r\n'.format(len(args))]
+    for arg in args:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        elif not isinstance(arg, str):
+            arg = str(arg)
+        parts.append('${0}\r\n{1}\r\n'.format(len(arg), arg))
+
+    return ''.join(parts)
+
+
+def read_reply(reader):
+    """Reads one RESP reply from the file-like reader"""
+    line = reader.readline()
+    if not line.endswith('\r\n'):
+        raise EOFError('Connection closed')
+
+    kind, rest = line[0], line[1:-2]
+    if kind == '+':
+        return rest
+    elif kind == '-':
+        raise RedisError(rest)
+    elif kind == ':':
+        return int(rest)
+    elif kind == '$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) < length + 2:
+            raise EOFError('Connection closed')
+        return data[:-2]
+    elif kind == '*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [read_reply(reader) for i in xrange(length)]
+
+    raise RedisError('Unexpected reply {0!r}'.format(line))
+
+
+def init_shared_state():
+    """Returns a RedisState if LEDGERMAN_SHARED_STATE is set to a redis:// URL,
+    or a LocalState that's only shared within this process"""
+    url = os.environ.get('LEDGERMAN_SHARED_STATE')
+    if not url:
+        return LocalState()
+
+    if not url.startswith('redis://'):
+        raise ValueError("LEDGERMAN_SHARED_STATE must be a redis:// URL, not '{0}'".format(url))
+
+    return RedisState.from_url(url)
+
+
+sharedState = init_shared_state()
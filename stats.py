@@ -0,0 +1,162 @@
+from collections import Counter, defaultdict
+from models import LedgermanModel, sqlbuilder, sqlhub
+from sqlobject import IntCol
+
+
+class PlayerStats(LedgermanModel):
+    """Running totals for a player, kept up to date as events, games and
+    achievements are written. Shares its id with the Player."""
+    achievements = IntCol(default=0)
+    damageDealt = IntCol(default=0)
+    damageTaken = IntCol(default=0)
+    deaths = IntCol(default=0)
+    frags = IntCol(default=0)
+    gamesPlayed = IntCol(default=0)
+    wins = IntCol(default=0)
+
+    def to_json_dict(self, typeString):
+        jsonDict = super(PlayerStats, self).to_json_dict(typeString)
+        self.add_derived(jsonDict['attributes'])
+        return jsonDict
+
+    @staticmethod
+    def add_derived(attributes):
+        attributes['kd-ratio'] = kd_ratio(attributes['frags'], attributes['deaths'])
+
+
+class GameStats(LedgermanModel):
+    """Running totals for a game. Shares its id with the Game."""
+    damageEvents = IntCol(default=0)
+    events = IntCol(default=0)
+    frags = IntCol(default=0)
+    players = IntCol(default=0)
+
+
+# Attributes /leaderboard can be ordered by, each of which is indexed by migrations
+LEADERBOARD_COLUMNS = ('frags', 'deaths', 'wins', 'gamesPlayed', 'achievements', 'damageDealt')
+
+
+class StatsDelta(object):
+    """Counter increments for players and games, accumulated while writing
+    one or more objects and then applied with one UPDATE per player and game.
+
+    UPDATEs add to the stored counts rather than overwriting them, so
+    concurrent writers don't lose each other's increments."""
+
+    def __init__(self):
+        self.players = defaultdict(Counter)
+        self.games = defaultdict(Counter)
+        self.removed = []
+
+    def add_event(self, attrs):
+        """Counts an event, given its attributes as parsed by parse_json_payload()"""
+        eventType = attrs.get('eventType')
+        playerId = attrs.get('playerID')
+        toId = attrs.get('toID')
+
+        self.games[attrs['gameID']]['events'] += 1
+        if eventType == 'fragged':
+            self.games[attrs['gameID']]['frags'] += 1
+            if playerId is not None:
+                self.players[playerId]['frags'] += 1
+            if toId is not None:
+                self.players[toId]['deaths'] += 1
+        elif eventType == 'damaged':
+            self.games[attrs['gameID']]['damageEvents'] += 1
+            if playerId is not None:
+                self.players[playerId]['damageDealt'] += 1
+            if toId is not None:
+                self.players[toId]['damageTaken'] += 1
+
+    def add_join(self, gameId, playerId, count=1):
+        """Counts a player being added to a game's players"""
+        self.games[gameId]['players'] += count
+        self.players[playerId]['gamesPlayed'] += count
+
+    def add_win(self, playerId, count=1):
+        if playerId is not None:
+            self.players[playerId]['wins'] += count
+
+    def add_achievement(self, playerId, count=1):
+        if playerId is not None:
+            self.players[playerId]['achievements'] += count
+
+    def remove_player(self, playerId, gameIds):
+        """Drops the stats of a deleted player, who's no longer one of the
+        players of gameIds. Their events are kept, and still counted."""
+        for gameId in gameIds:
+            self.add_join(gameId, playerId, -1)
+        self.removed.append((PlayerStats, playerId))
+
+    def remove_game(self, gameId, playerIds, winnerId):
+        """Drops the stats of a deleted game, which playerIds no longer played"""
+        for playerId in playerIds:
+            self.add_join(gameId, playerId, -1)
+        self.add_win(winnerId, -1)
+        self.removed.append((GameStats, gameId))
+
+    def apply(self, conn=None):
+        if conn is None:
+            conn = sqlhub.getConnection()
+
+        for statsClass, statsId in self.removed:
+            conn.query(conn.sqlrepr(sqlbuilder.Delete(statsClass.sqlmeta.table, where=statsClass.q.id == statsId)))
+
+        removed = set(self.removed)
+        for statsClass, deltas in ((PlayerStats, self.players), (GameStats, self.games)):
+            deltas = dict((k, v) for k, v in deltas.iteritems()
+                          if any(v.itervalues()) and (statsClass, k) not in removed)
+            if not deltas:
+                continue
+
+            ensure_rows(statsClass, deltas.keys(), conn)
+
+            for statsId, counts in deltas.iteritems():
+                values = {}
+                for attrName, count in counts.iteritems():
+                    if count:
+                        dbName = statsClass.sqlmeta.columns[attrName].dbName
+                        values[dbName] = sqlbuilder.SQLConstant(dbName) + count
+
+                conn.query(conn.sqlrepr(sqlbuilder.Update(
+                    statsClass.sqlmeta.table, values, where=statsClass.q.id == statsId)))
+
+
+def ensure_rows(statsClass, ids, conn):
+    """Inserts zeroed rows for any of ids that statsClass doesn't have yet.
+
+    Rows are inserted directly rather than through SQLObject so no instances
+    are cached; the counts are only ever changed by UPDATEs. Rows that exist,
+    or that a concurrent request inserts first, are left alone."""
+    names = [statsClass.sqlmeta.idName] + [col.dbName for col in statsClass.sqlmeta.columnList]
+    zeroes = ', '.join(['0'] * len(statsClass.sqlmeta.columnList))
+    conn.query('INSERT INTO {0} ({1}) VALUES {2} ON CONFLICT ({3}) DO NOTHING'.format(
+        statsClass.sqlmeta.table, ', '.join(names),
+        ', '.join('({0}, {1})'.format(conn.sqlrepr(int(statsId)), zeroes) for statsId in ids),
+        statsClass.sqlmeta.idName))
+
+
+def get_stats(statsClass, statsId, typeString):
+    """Returns the stats for one player or game as a JSON dict, zeroed if
+    nothing has been counted for it yet. Nothing is written.
+
+    Reads through select() so that the values are never stale cached ones."""
+    rows = list(statsClass.select(statsClass.q.id == statsId))
+    if rows:
+        return rows[0].to_json_dict(typeString)
+
+    attributes = dict((name, 0) for name, convert, encode in statsClass.rowFormats.itervalues())
+    if hasattr(statsClass, 'add_derived'):
+        statsClass.add_derived(attributes)
+    return {'id': statsId, 'type': typeString, 'attributes': attributes}
+
+
+def leaderboard(attrName, limit):
+    """The players with the highest attrName counts, highest first"""
+    column = getattr(PlayerStats.q, attrName)
+    return PlayerStats.select(orderBy=[sqlbuilder.DESC(column), sqlbuilder.DESC(PlayerStats.q.id)], limit=limit)
+
+
+def kd_ratio(frags, deaths):
+    return round(frags / float(max(deaths, 1)), 2)
+
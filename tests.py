@@ -2,15 +2,47 @@
 # Some basic CRUD functionality tests for our endpoints. No testing of edge cases yet.
 import __builtin__
 __builtin__.ledgerman_testing = True
+import analytics
+import archive
+import csv
 import datetime 
 import faker
+import feed
 import falcon
 import falcon.testing as testing
+import httplib
 import json
+import metrics
+import cache
+import compression
 import ledgerman
+import migrations
+import models
+import os
+import pstats
 import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import restfuls
+import serve_async
+import socket
+import SocketServer
+import sqlite3
+import transfer
+import shared
+import stats
+import tokens
+import StringIO
 import unittest
-from models import dash_to_camel, camel_to_dash
+import versions
+import writebehind
+import zlib
+from models import dash_to_camel, camel_to_dash, dump_json, iter_json
+from sqlobject.dbconnection import DBAPI
+from sqlobject.sqlite.sqliteconnection import SQLiteConnection
 
 fake = faker.Factory.create()
 
@@ -51,6 +83,18 @@ class LedgermanTest(testing.TestCase):
             }
         }
 
+    def fake_event(self, game, player, eventType, to=None):
+        return {
+            'type': 'event',
+            'attributes': {
+                'player-id': player['id'],
+                'timestamp': str(datetime.datetime.now()),
+                'to-id': to['id'] if to else None,
+                'event-type': eventType,
+                'game-id': game['id']
+            }
+        }
+
 class UtilTest(LedgermanTest):
     def test_camel_dash(self):
         self.assertEqual(dash_to_camel('one-two-three-four'), 'oneTwoThreeFour')
@@ -64,6 +108,1593 @@ class UtilTest(LedgermanTest):
         # id suffix edge case
         self.assertEqual(dash_to_camel('param-mid'), 'paramMid')
 
+    def test_parse_datetime(self):
+        parse = models.LedgermanModel.parse_datetime
+        for value in ('2016-09-05 12:01:02', '2016-09-05 12:01:02.5', '2016-09-05 12:01:02.123456', '2016-9-5 12:1:2'):
+            fmt = models.LedgermanModel.isofmt_ms if '.' in value else models.LedgermanModel.isofmt
+            self.assertEqual(parse('at', value), datetime.datetime.strptime(value, fmt))
+
+        for value in ('2016-13-05 12:01:02', '2016-09-05T12:01:02', '2016-09-05 12:01:02.1234567', 5, None):
+            self.assertRaises(ValueError, parse, 'at', value)
+
+    def test_attr_parsers(self):
+        self.assertEqual(models.GameEvent.attrParsers['event-type'], ('eventType', None))
+        self.assertEqual(models.GameEvent.attrParsers['player-id'][0], 'playerID')
+
+        # Spellings that only dash_to_camel() understands still work
+        attrs = models.GameEvent.parse_json_object(
+            {'type': 'event', 'attributes': {'event-TYPE': 'joined', 'game-ID': 1, 'player-ID': '2',
+                                             'timestamp': None, 'nope': 1}}, 'event', checkKeys=False)
+        self.assertEqual(attrs, {'eventType': 'joined', 'gameID': 1, 'playerID': 2, 'timestamp': None})
+
+    def test_parse_id_value(self):
+        parse = models.GameEvent.parse_id_value
+        for value, expected in ((5, 5), (5L, 5), ('5', 5), (u'5', 5)):
+            self.assertEqual(parse('game-id', value), expected)
+
+        for value in (1.5, 1.0, True, '1.5', '-1', ' 5', '', [5]):
+            self.assertRaises(ValueError, parse, 'game-id', value)
+
+    def test_foreign_keys(self):
+        fkCache = {}
+        attrs = {'gameID': 999998, 'playerID': None, 'toID': 999999}
+        models.GameEvent.load_foreign_keys([attrs], fkCache)
+        self.assertEqual(fkCache, {('Game', 999998): None, ('Player', 999999): None})
+        self.assertRaises(ValueError, models.GameEvent.check_foreign_keys, attrs, fkCache)
+
+        # Rows known to exist aren't looked up, until they're invalidated
+        models.existingIds.add(('Game', 999998))
+        models.existingIds.add(('Player', 999999))
+        models.GameEvent.check_foreign_keys(attrs, {})
+        cache.invalidate(('Player', 999999))
+        self.assertRaises(ValueError, models.GameEvent.check_foreign_keys, attrs, {})
+        models.existingIds.discard(('Game', 999998))
+
+    def test_iter_json(self):
+        class FakeObject(object):
+            def __init__(self, id):
+                self.id = id
+
+            def to_json_dict(self, typeString):
+                return {'id': self.id, 'type': typeString, 'attributes': {'at': datetime.datetime(2016, 9, 5, 12, 0, 0)}}
+
+        for count in (0, 1, 50):
+            objs = [FakeObject(i) for i in range(count)]
+            chunks = list(iter_json(iter(objs), 'fake', chunkSize=256))
+            self.assertEqual(json.loads(''.join(chunks)), json.loads(dump_json(objs, 'fake')))
+            if count == 50:
+                self.assertTrue(len(chunks) > 1)
+
+    def test_row_writer(self):
+        games = [models.Game(gameType='duel', startedAt=datetime.datetime(2016, 9, 5, 12, 0, 0),
+                             endedAt=datetime.datetime(2016, 9, 5, 12, 30, 0, 5000), winner=None, active=False),
+                 models.Game(gameType='ffa', startedAt=datetime.datetime.now(), endedAt=None, winner=None,
+                             active=True)]
+        rows, nextAfter = models.Game.select_rows(None, [models.IN(models.Game.q.id, [g.id for g in games])])
+        writer = models.Game.row_writer(None, 'game')
+        for game, row in zip(games, rows):
+            expected = json.loads(dump_json(game, 'game'))
+            self.assertEqual(json.loads(writer.to_json(row)), expected)
+            self.assertEqual(json.loads(json.dumps(writer.to_json_dict(row))), expected)
+
+        chunks = list(models.iter_json_rows(rows, writer))
+        self.assertEqual(json.loads(''.join(chunks)), json.loads(dump_json(games, 'game')))
+
+    def test_db_uri(self):
+        self.assertEqual(models.db_uri(':memory:'), 'sqlite:/:memory:')
+        self.assertEqual(models.db_uri('/tmp/ledgerman.db'), 'sqlite:/tmp/ledgerman.db')
+        self.assertEqual(models.db_uri('postgres://localhost/ledgerman'), 'postgres://localhost/ledgerman')
+
+    def test_limit_connections(self):
+        class FakeConnection(object):
+            def __init__(self):
+                self.pool = []
+
+            def getConnection(self):
+                return self.pool.pop() if self.pool else object()
+
+            def releaseConnection(self, rawConn, explicit=False):
+                if rawConn not in self.pool:
+                    self.pool.insert(0, rawConn)
+
+        conn = FakeConnection()
+        limit = models.limit_connections(conn, 2, 0.05)
+        rawConns = [conn.getConnection(), conn.getConnection()]
+        self.assertRaises(models.PoolTimeout, conn.getConnection)
+
+        # A waiting request gets the connection released by another
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(conn.getConnection()))
+        limit.timeout = 5
+        waiter.start()
+        conn.releaseConnection(rawConns[0])
+        conn.releaseConnection(rawConns[0])
+        waiter.join()
+        self.assertEqual(got, [rawConns[0]])
+        self.assertEqual(limit.inUse, 2)
+
+        for rawConn in (rawConns[1], got[0]):
+            conn.releaseConnection(rawConn)
+        self.assertEqual((limit.inUse, len(conn.pool)), (0, 2))
+
+    def test_limit_connections_concurrently(self):
+        # SQLObject's own pooling, as used for every database but SQLite,
+        # over a fake DB-API module so it doesn't need a database server
+        class FakeModule(object):
+            Binary = str
+
+        class FakeRawConnection(object):
+            def __init__(self, opened):
+                self.busy = False
+                opened.append(self)
+
+            def use(self):
+                self.busy = True
+                time.sleep(0.002)
+                self.busy = False
+
+            def commit(self):
+                pass
+
+            def rollback(self):
+                pass
+
+            def close(self):
+                pass
+
+        class PoolingConnection(DBAPI):
+            module = FakeModule
+            supportTransactions = True
+
+            def __init__(self):
+                self.opened = []
+                DBAPI.__init__(self)
+
+            def makeConnection(self):
+                return FakeRawConnection(self.opened)
+
+            def _setAutoCommit(self, rawConn, auto):
+                pass
+
+        conn = PoolingConnection()
+        limit = models.limit_connections(conn, 3, 5)
+        peak = [0]
+        errors = []
+        lock = threading.Lock()
+
+        def work(i):
+            try:
+                for j in range(20):
+                    if (i + j) % 3:
+                        trans = conn.transaction()
+                        rawConn = trans._connection
+                    else:
+                        rawConn = conn.getConnection()
+                    with lock:
+                        self.assertFalse(rawConn.busy)
+                        peak[0] = max(peak[0], limit.inUse)
+                    rawConn.use()
+                    if (i + j) % 3 == 1:
+                        trans.commit(close=True)
+                    elif (i + j) % 3 == 2:
+                        trans.rollback()
+                    else:
+                        conn.releaseConnection(rawConn)
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Never more than 3 connections opened or in use, and all returned
+        self.assertEqual(errors, [])
+        self.assertTrue(1 < peak[0] <= 3)
+        self.assertTrue(len(conn.opened) <= 3)
+        self.assertEqual((limit.inUse, limit.checkedOut), (0, {}))
+        self.assertEqual(sorted(map(id, conn._pool)), sorted(map(id, conn.opened)))
+
+        # Requests that time out waiting don't leak a connection
+        held = [conn.getConnection() for i in range(3)]
+        limit.timeout = 0.01
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([type(ex) for ex in errors], [models.PoolTimeout] * 5)
+        for rawConn in held:
+            conn.releaseConnection(rawConn)
+        self.assertEqual((limit.inUse, limit.checkedOut, len(conn.opened)), (0, {}, 3))
+
+    def test_sqlite_profile(self):
+        dbDir = tempfile.mkdtemp()
+        try:
+            conn = models.connectionForURI(models.db_uri(os.path.join(dbDir, 'profile.db')))
+            models.use_sqlite_profile(conn, 'fast')
+            self.assertEqual(conn.queryOne('PRAGMA journal_mode')[0], 'wal')
+            self.assertEqual(conn.queryOne('PRAGMA synchronous')[0], 1)
+            conn.close()
+        finally:
+            shutil.rmtree(dbDir)
+
+        self.assertRaises(ValueError, models.use_sqlite_profile, conn, 'reckless')
+
+
+def using_sqlite():
+    return models.sqlhub.processConnection.dbName == 'sqlite'
+
+
+@unittest.skipIf(analytics.numpy is None, 'NumPy is not installed')
+class AnalyticsTest(LedgermanTest):
+
+    def setUp(self):
+        super(AnalyticsTest, self).setUp()
+        analytics.snapshot.refreshInterval = 0
+
+        self.p1 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.p2 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.games = []
+        for gameType in ('ffa', 'duel'):
+            game = self.fake_game()
+            game['attributes']['game-type'] = gameType
+            self.games.append(self.simulate_post('/games', headers=self.headers, body=json.dumps(game)).json)
+
+        batch = []
+        for game in self.games:
+            for minute, eventType in enumerate(('joined', 'fragged', 'fragged', 'damaged')):
+                event = self.fake_event(game, self.p1 if minute % 2 else self.p2, eventType, self.p2)
+                event['attributes']['timestamp'] = '2016-09-05 12:0{0}:30'.format(minute // 2)
+                batch.append(event)
+        self.simulate_post('/events/batch', headers=self.headers, body=json.dumps(batch))
+        self.query = 'game-id={0},{1}'.format(self.games[0]['id'], self.games[1]['id'])
+
+    def tearDown(self):
+        analytics.snapshot.refreshInterval = analytics.DEFAULT_ANALYTICS_REFRESH
+        super(AnalyticsTest, self).tearDown()
+
+    def get(self, query):
+        res = self.simulate_get('/analytics', headers=self.headers, query_string=self.query + '&' + query)
+        self.assertEqual(res.status_code, 200)
+        return res.json['results']
+
+    def test_aggregate(self):
+        self.assertEqual(self.get(''), [{'count': 8}])
+        self.assertEqual(self.get('event-type=fragged&group-by=game-type'),
+                         [{'game-type': 'ffa', 'count': 2}, {'game-type': 'duel', 'count': 2}])
+        self.assertEqual(self.get('event-type=fragged&game-type=duel&interval=minute'),
+                         [{'time': '2016-09-05 12:00:00', 'count': 1}, {'time': '2016-09-05 12:01:00', 'count': 1}])
+        self.assertEqual(self.get('group-by=player-id,to-id&since=2016-09-05 12:01:00'),
+                         [{'player-id': self.p1['id'], 'to-id': self.p2['id'], 'count': 2},
+                          {'player-id': self.p2['id'], 'to-id': self.p2['id'], 'count': 2}])
+
+        # Events written since are added, and those of deleted games left out
+        self.simulate_post('/events', headers=self.headers,
+                           body=json.dumps(self.fake_event(self.games[0], self.p2, 'left')))
+        self.assertEqual(self.get('event-type=left'), [{'count': 1}])
+        self.simulate_delete('/games/{0}'.format(self.games[1]['id']), headers=self.headers)
+        self.assertEqual(self.get('group-by=game-id'), [{'game-id': self.games[0]['id'], 'count': 5}])
+
+    def test_bad_query(self):
+        for query in ('group-by=name', 'interval=fortnight', 'event-type=hugged', 'since=yesterday'):
+            res = self.simulate_get('/analytics', headers=self.headers, query_string=query)
+            self.assertEqual(res.status_code, 400)
+
+    def test_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            snapshot = analytics.EventSnapshot(directory, 0)
+            columns = snapshot.refresh()
+            count = snapshot.count
+            self.assertEqual(list(columns['id']), sorted(columns['id']))
+
+            # An append that didn't finish is dropped, and a directory can be shared
+            with open(os.path.join(directory, 'game'), 'ab') as f:
+                f.write('\0' * 6)
+            self.simulate_post('/events', headers=self.headers,
+                               body=json.dumps(self.fake_event(self.games[0], self.p1, 'left')))
+            other = analytics.EventSnapshot(directory, 0)
+            self.assertEqual(len(other.refresh()['game']), count + 1)
+            self.assertEqual(len(snapshot.refresh()['game']), count + 1)
+            self.assertEqual(other.refresh()['game'][-1], self.games[0]['id'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_late_commit(self):
+        # An event that commits after one with a larger id, as can happen on
+        # Postgres, is picked up by the next refresh
+        directory = tempfile.mkdtemp()
+        conn = models.sqlhub.processConnection
+        try:
+            for eventType in ('joined', 'left'):
+                self.simulate_post('/events', headers=self.headers,
+                                   body=json.dumps(self.fake_event(self.games[0], self.p1, eventType)))
+            late = conn.queryOne('SELECT MAX(id) FROM game_event')[0] - 1
+            row = conn.queryOne('SELECT * FROM game_event WHERE id = {0}'.format(late))
+            conn.query('DELETE FROM game_event WHERE id = {0}'.format(late))
+
+            snapshot = analytics.EventSnapshot(directory, 0, recheckIds=10)
+            count = len(snapshot.refresh()['id'])
+            conn.query('INSERT INTO game_event VALUES ({0})'.format(', '.join(conn.sqlrepr(x) for x in row)))
+            columns = snapshot.refresh()
+            self.assertEqual(len(columns['id']), count + 1)
+            self.assertEqual(columns['id'][-1], late)
+            self.assertEqual(len(snapshot.refresh()['id']), count + 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+class ArchiveTest(LedgermanTest):
+
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        restfuls.archiveGames = True
+
+        self.p1 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.p2 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+
+        batch = [self.fake_event(self.game, self.p1, 'joined'), self.fake_event(self.game, self.p2, 'joined')]
+        for i in range(4):
+            event = self.fake_event(self.game, self.p1, 'fragged' if i % 2 else 'damaged', self.p2)
+            event['attributes']['timestamp'] = '2016-09-05 12:0{0}:00'.format(i)
+            batch.append(event)
+        self.simulate_post('/events/batch', headers=self.headers, body=json.dumps(batch))
+
+    def tearDown(self):
+        restfuls.archiveGames = archive.archiveGames
+        super(ArchiveTest, self).tearDown()
+
+    def set_active(self, active):
+        self.game['attributes']['active'] = active
+        res = self.simulate_patch('/games/{0}'.format(self.game['id']), headers=self.headers,
+                                  body=json.dumps(self.game))
+        self.assertEqual(res.status_code, 200)
+
+    def get_events(self, query=''):
+        path = '/games/{0}/events'.format(self.game['id'])
+        res = self.simulate_get(path, headers=self.headers, query_string=query)
+        self.assertEqual(res.status_code, 200)
+        return res.json, res.headers.get('link')
+
+    def test_archive(self):
+        queries = ('', 'limit=2', 'after=0&limit=6', 'event-type=fragged', 'since=2016-09-05 12:01:00&limit=1',
+                   'until=2016-09-05 12:02:00', 'fields[event]=timestamp,to-id')
+        before = [self.get_events(query) for query in queries]
+        eventId = before[0][0][3]['id']
+        event = self.simulate_get('/events/{0}'.format(eventId), headers=self.headers).json
+        included = self.simulate_get('/games/{0}'.format(self.game['id']), headers=self.headers,
+                                     query_string='include=events').json['included']
+        playerEvents = self.simulate_get('/players/{0}/events'.format(self.p1['id']), headers=self.headers,
+                                         query_string='event-type=fragged,damaged').json
+        after = before[0][0][0]['id'] - 1
+        allQueries = ['after={0}&limit=2'.format(after), 'after={0}&to-id={1}'.format(after, self.p2['id']),
+                      'game-id={0}&event-type=fragged'.format(self.game['id']),
+                      'player-id={0}&after={1}'.format(self.p2['id'], after)]
+        allBefore = [self.get_all_events(query) for query in allQueries]
+
+        self.set_active(False)
+        hot = models.GameEvent.select(models.GameEvent.q.gameID == self.game['id']).count()
+        self.assertEqual(hot, 0)
+        self.assertEqual(archive.GameArchive.get(self.game['id']).events, 6)
+
+        # GET /events merges archived events in, decoding each archive once for all the pages
+        archive.archiveCache.entries.clear()
+        decompress = zlib.decompress
+        decoded = []
+        archive.zlib.decompress = lambda data: decoded.append(1) or decompress(data)
+        try:
+            self.assertEqual([self.get_all_events(query) for query in allQueries], allBefore)
+        finally:
+            archive.zlib.decompress = decompress
+        self.assertEqual(len(decoded), 1)
+        self.assertEqual(len(allBefore[0]), 6)
+
+        self.assertEqual([self.get_events(query) for query in queries], before)
+        self.assertEqual(self.simulate_get('/events/{0}'.format(eventId), headers=self.headers).json, event)
+        self.assertEqual(self.simulate_get('/games/{0}'.format(self.game['id']), headers=self.headers,
+                                           query_string='include=events').json['included'], included)
+        self.assertEqual(self.simulate_get('/players/{0}/events'.format(self.p1['id']), headers=self.headers,
+                                           query_string='event-type=fragged,damaged').json, playerEvents)
+        self.assertEqual(len(playerEvents), 4)
+
+        events, more = feed.read_events(self.game['id'], 0)
+        self.assertEqual([json.loads(body) for eventId, body in events], before[0][0])
+
+    def get_all_events(self, query):
+        # Every page of GET /events
+        events = []
+        while query is not None:
+            res = self.simulate_get('/events', headers=self.headers, query_string=query)
+            self.assertEqual(res.status_code, 200)
+            events.extend(res.json)
+            link = res.headers.get('link')
+            query = link[link.index('?') + 1:link.index('>')] if link else None
+        return events
+
+    def test_reactivate(self):
+        self.set_active(False)
+        self.set_active(True)
+        res = self.simulate_post('/events', headers=self.headers,
+                                 body=json.dumps(self.fake_event(self.game, self.p2, 'left')))
+        self.assertEqual(res.status_code, 200)
+
+        events, link = self.get_events()
+        self.assertEqual(len(events), 7)
+        self.assertEqual(events[-1]['attributes']['event-type'], 'left')
+        self.assertEqual(self.get_events('limit=6')[0], events[:6])
+        self.assertEqual(self.get_events('after={0}'.format(events[5]['id']))[0], events[6:])
+
+        self.set_active(False)
+        self.assertEqual(self.get_events(), (events, None))
+        self.assertEqual(archive.GameArchive.get(self.game['id']).events, 7)
+
+    def test_export(self):
+        before = ''.join(transfer.export_rows('events', 'ndjson'))
+        self.set_active(False)
+        after = ''.join(transfer.export_rows('events', 'ndjson'))
+        self.assertEqual(after, before)
+
+        eventIds = [json.loads(line)['id'] for line in after.splitlines()]
+        self.assertEqual(eventIds, sorted(eventIds))
+
+    def test_archive_finished_games(self):
+        restfuls.archiveGames = False
+        self.set_active(False)
+        events, link = self.get_events()
+
+        self.assertTrue(archive.archive_finished_games() >= 1)
+        self.assertEqual(archive.archive_finished_games(), 0)
+        self.assertEqual(self.get_events(), (events, None))
+
+
+class AsyncServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ready = threading.Event()
+        self.notifies = []
+        self.server = serve_async.AsyncServer(self.app, port=0, dbThreads=2, maxBodySize=1024)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.ready.set()
+        self.server.stop()
+        self.thread.join(5)
+
+    def app(self, environ, start_response):
+        path = environ['PATH_INFO']
+        if path == '/echo':
+            body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+        elif path == '/chunks':
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return iter(['one', 'two', 'three'])
+        elif path == '/wait':
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return self.wait(environ['ledgerman.notify'])
+        elif path == '/rows':
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return self.rows(int(environ['QUERY_STRING']))
+        start_response('404 Not Found', [('Content-Length', '0')])
+        return []
+
+    def rows(self, count):
+        # Yields rows from a cursor, which SQLite only lets the thread that
+        # opened it use, as SelectResults.lazyIter() does
+        cursor = sqlite3.connect(':memory:').execute(
+            'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) SELECT i FROM n', (count,))
+        for row in cursor:
+            yield '{0:>1023}\n'.format(row[0])
+
+    def wait(self, notify):
+        # Yields '' until ready, as feed.watch_game() does, and waits holding no thread
+        self.notifies.append(notify)
+        while not self.ready.is_set():
+            yield ''
+        yield 'ready'
+
+    def connect(self):
+        return httplib.HTTPConnection(self.server.host, self.server.port, timeout=5)
+
+    def test_keep_alive(self):
+        conn = self.connect()
+        for body in ('first', 'second'):
+            conn.request('POST', '/echo', body)
+            res = conn.getresponse()
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.read(), body)
+
+        conn.request('GET', '/chunks')
+        res = conn.getresponse()
+        self.assertEqual(res.getheader('transfer-encoding'), 'chunked')
+        self.assertEqual(res.read(), 'onetwothree')
+
+        conn.request('GET', '/missing')
+        self.assertEqual(conn.getresponse().status, 404)
+        conn.close()
+
+    def test_large_stream(self):
+        # Read in several pieces, while other requests keep the pool busy
+        conns = [self.connect() for i in range(3)]
+        conns[0].request('GET', '/rows?1000')
+        for i in range(20):
+            conns[1].request('POST', '/echo', 'x')
+            self.assertEqual(conns[1].getresponse().read(), 'x')
+        res = conns[0].getresponse()
+        body = res.read()
+        self.assertEqual(res.status, 200)
+        self.assertTrue(len(body) > serve_async.PULL_SIZE)
+        self.assertEqual([int(line) for line in body.splitlines()], range(1, 1001))
+        for conn in conns:
+            conn.close()
+
+    def test_pipelining(self):
+        sock = socket.create_connection((self.server.host, self.server.port), 5)
+        sock.sendall('POST /echo HTTP/1.1\r\nHost: x\r\nContent-Length: 1\r\n\r\na'
+                     'POST /echo HTTP/1.1\r\nHost: x\r\nContent-Length: 1\r\nConnection: close\r\n\r\nb')
+        data = ''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        sock.close()
+        self.assertEqual(data.count('HTTP/1.1 200 OK'), 2)
+        self.assertTrue(data.endswith('\r\n\r\nb'))
+
+    def test_errors(self):
+        conn = self.connect()
+        conn.request('POST', '/echo', 'x' * 2048)
+        self.assertEqual(conn.getresponse().status, 413)
+        conn.close()
+
+        sock = socket.create_connection((self.server.host, self.server.port), 5)
+        sock.sendall('nonsense\r\n\r\n')
+        self.assertIn(' 400 ', sock.recv(4096))
+        sock.close()
+
+    def test_notify(self):
+        conns = [self.connect() for i in range(4)]
+        for conn in conns:
+            conn.request('GET', '/wait')
+        time.sleep(0.2)
+
+        # More requests waiting than threads, and the server still answers
+        conn = self.connect()
+        conn.request('POST', '/echo', 'hi')
+        self.assertEqual(conn.getresponse().read(), 'hi')
+
+        self.ready.set()
+        for notify in self.notifies:
+            notify()
+        for conn in conns:
+            self.assertEqual(conn.getresponse().read(), 'ready')
+
+
+class CompressionTest(LedgermanTest):
+
+    def setUp(self):
+        super(CompressionTest, self).setUp()
+        self.p1 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.p2 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        self.path = '/games/{0}/events'.format(self.game['id'])
+
+        batch = [self.fake_event(self.game, self.p1, 'joined'), self.fake_event(self.game, self.p2, 'joined')]
+        batch += [self.fake_event(self.game, self.p1, 'fragged', self.p2) for i in range(20)]
+        self.simulate_post('/events/batch', headers=self.headers, body=json.dumps(batch))
+
+    def test_compression(self):
+        plain = self.simulate_get(self.path, headers=self.headers)
+        self.assertEqual(plain.headers.get('content-encoding'), None)
+        self.assertIn('Accept-Encoding', plain.headers['vary'])
+
+        for acceptEncoding, encoding, wbits in (('gzip, deflate', 'gzip', 31), ('gzip;q=0, deflate', 'deflate', 15)):
+            headers = dict(self.headers, **{'Accept-Encoding': acceptEncoding})
+            res = self.simulate_get(self.path, headers=headers)
+            self.assertEqual(res.headers['content-encoding'], encoding)
+            self.assertEqual(zlib.decompress(res.content, wbits), plain.content)
+            self.assertEqual(res.headers['etag'], 'W/' + plain.headers['etag'])
+
+        headers = dict(self.headers, **{'Accept-Encoding': 'gzip', 'If-None-Match': res.headers['etag']})
+        self.assertEqual(self.simulate_get(self.path, headers=headers).status_code, 304)
+
+        # Streams are compressed too, small bodies aren't
+        headers = dict(self.headers, **{'Accept-Encoding': 'gzip'})
+        res = self.simulate_get('/events', headers=headers, query_string='limit=5')
+        self.assertEqual(len(json.loads(zlib.decompress(res.content, 31))), 5)
+        res = self.simulate_get('/cache-stats', headers=headers)
+        self.assertEqual(res.headers.get('content-encoding'), None)
+
+        # Cache hits are compressed once per content coding
+        compressed = []
+        compress = ledgerman.compress
+        ledgerman.compress = lambda *args: compressed.append(args[1]) or compress(*args)
+        try:
+            for acceptEncoding in ('gzip', 'gzip', 'deflate', 'deflate'):
+                headers = dict(self.headers, **{'Accept-Encoding': acceptEncoding})
+                res = self.simulate_get(self.path, headers=headers, query_string='limit=10')
+                self.assertEqual(len(json.loads(zlib.decompress(res.content, compression.WBITS[acceptEncoding]))), 10)
+        finally:
+            ledgerman.compress = compress
+        self.assertEqual(compressed, ['gzip', 'deflate'])
+
+        self.assertEqual(compression.choose_encoding('br, *;q=0.5'), 'gzip')
+        self.assertEqual(compression.choose_encoding('identity, *;q=0'), None)
+        self.assertEqual(compression.choose_encoding(None), None)
+
+    def test_columns(self):
+        rows = self.simulate_get(self.path, headers=self.headers, query_string='limit=5').json
+        headers = dict(self.headers, Accept=restfuls.JSON_COLUMNS_TYPE)
+        for i in range(2):
+            res = self.simulate_get(self.path, headers=headers, query_string='limit=5')
+            self.assertEqual(res.headers['content-type'], restfuls.JSON_COLUMNS_TYPE)
+            self.assertEqual(res.headers['x-cache'], ['MISS', 'HIT'][i])
+            self.assertEqual(res.json['type'], 'event')
+            self.assertEqual(res.json['id'], [row['id'] for row in rows])
+            self.assertEqual(models.split_json_columns(res.json), [
+                {'type': 'event', 'attributes': row['attributes']} for row in rows])
+
+        self.assertNotEqual(res.headers['etag'], self.simulate_get(self.path, headers=self.headers).headers['etag'])
+
+        res = self.simulate_get('/players', headers=headers, query_string='fields[player]=handle&limit=2')
+        self.assertEqual(res.json['attributes'].keys(), ['handle'])
+        self.assertEqual(len(res.json['id']), 2)
+
+        # Columns have to be asked for by name, and preferred over plain JSON
+        for accept, asColumns in ((restfuls.JSON_COLUMNS_TYPE + ';q=0, application/json', False),
+                                  (restfuls.JSON_COLUMNS_TYPE + 'x', False),
+                                  ('*/*', False),
+                                  ('application/json;q=0.9, {0};q=0.5'.format(restfuls.JSON_COLUMNS_TYPE), False),
+                                  ('application/json;q=0.5, {0}'.format(restfuls.JSON_COLUMNS_TYPE), True),
+                                  ('text/html, {0}; q=0.8, */*;q=0.1'.format(restfuls.JSON_COLUMNS_TYPE), True)):
+            res = self.simulate_get('/players', headers=dict(self.headers, Accept=accept), query_string='limit=2')
+            self.assertEqual(res.headers['content-type'] == restfuls.JSON_COLUMNS_TYPE, asColumns)
+
+    def test_batch(self):
+        events = [self.fake_event(self.game, self.p1, 'fragged', self.p2) for i in range(3)]
+        events[1]['attributes']['event-type'] = 'dunked'
+        names = events[0]['attributes'].keys()
+        body = json.dumps({'type': 'event', 'attributes': dict(
+            (name, [event['attributes'][name] for event in events]) for name in names)})
+        headers = dict(self.headers, **{'Content-Type': restfuls.JSON_COLUMNS_TYPE, 'Content-Encoding': 'gzip'})
+
+        res = self.simulate_post('/events/batch', headers=headers, body=compression.compress(body, 'gzip'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['accepted'], 2)
+        self.assertEqual([error['index'] for error in res.json['errors']], [1])
+
+        body = json.dumps({'type': 'event', 'attributes': {'player-id': [1, 2], 'event-type': ['joined']}})
+        res = self.simulate_post('/events/batch', headers=dict(headers, **{'Content-Encoding': 'identity'}), body=body)
+        self.assertEqual(res.status_code, 400)
+        res = self.simulate_post('/events/batch', headers=dict(headers, **{'Content-Encoding': 'br'}), body=body)
+        self.assertEqual(res.status_code, 415)
+        res = self.simulate_post('/events/batch', headers=headers, body='not gzip')
+        self.assertEqual(res.status_code, 400)
+
+
+class GameIncludeTest(LedgermanTest):
+
+    def test_include(self):
+        player = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        self.simulate_post('/events', headers=self.headers, body=json.dumps(self.fake_event(game, player, 'joined')))
+
+        achievementType = models.AchievementType(name='First Blood', description='First frag of the game')
+        models.Achievement(achievementType=achievementType, gameID=game['id'], playerID=player['id'],
+                           timestamp=datetime.datetime.now())
+
+        res = self.simulate_get('/games/{0}'.format(game['id']), headers=self.headers,
+                                query_string='include=players,events,achievements')
+        self.assertEqual(res.status_code, 200)
+        included = res.json['included']
+        self.assertEqual(included['players'], [player])
+        self.assertEqual(len(included['events']), 1)
+        self.assertEqual(included['events'][0]['attributes']['event-type'], 'joined')
+        self.assertEqual(len(included['achievements']), 1)
+
+        res = self.simulate_get('/games/{0}/achievements'.format(game['id']), headers=self.headers)
+        self.assertEqual(res.json, included['achievements'])
+
+        res = self.simulate_get('/players/{0}'.format(player['id']), headers=self.headers, query_string='include=games')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([g['id'] for g in res.json['included']['games']], [game['id']])
+
+    def test_bad_include(self):
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        res = self.simulate_get('/games/{0}'.format(game['id']), headers=self.headers, query_string='include=spectators')
+        self.assertEqual(res.status_code, 400)
+
+
+class MetricsTest(LedgermanTest):
+
+    def test_metrics(self):
+        self.simulate_get('/games', headers=self.headers)
+        self.simulate_get('/games/999999', headers=self.headers)
+
+        res = self.simulate_get('/metrics', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.headers['content-type'].startswith('text/plain'))
+
+        lines = dict(line.rsplit(' ', 1) for line in res.content.splitlines() if not line.startswith('#'))
+        labels = '{resource="GameCollection",method="GET"}'
+        self.assertTrue(int(lines['ledgerman_request_duration_seconds_count' + labels]) >= 1)
+        self.assertTrue(int(lines['ledgerman_response_size_bytes_count' + labels]) >= 1)
+        self.assertTrue(int(lines['ledgerman_sql_queries_total' + labels]) >= 1)
+        self.assertTrue('ledgerman_serialization_seconds_total' + labels in lines)
+        self.assertTrue(int(lines['ledgerman_requests_total{resource="GameResource",method="GET",status="404"}']) >= 1)
+        self.assertTrue('ledgerman_cache_hits_total' in lines)
+
+    def test_profile_slow_requests(self):
+        profileDir = tempfile.mkdtemp()
+        try:
+            metrics.RequestMetrics.profileDir = profileDir
+            metrics.RequestMetrics.profileRate = 1
+            metrics.RequestMetrics.profileSlow = 0
+            self.simulate_get('/games', headers=self.headers)
+        finally:
+            metrics.RequestMetrics.profileDir = None
+
+        profiles = os.listdir(profileDir)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue('-GameCollection-GET-' in profiles[0])
+        pstats.Stats(os.path.join(profileDir, profiles[0]))
+        shutil.rmtree(profileDir)
+
+
+class MigrationTest(LedgermanTest):
+
+    def test_migrated(self):
+        conn = models.sqlhub.processConnection
+        self.assertEqual(migrations.schema_version(conn), len(migrations.MIGRATIONS))
+
+        # Migrating again is a no-op
+        self.assertEqual(migrations.migrate(conn), len(migrations.MIGRATIONS))
+
+    @unittest.skipUnless(using_sqlite(), 'SQLite only')
+    def test_indexes_created(self):
+        conn = models.sqlhub.processConnection
+        indexes = set(row[0] for row in conn.queryAll("SELECT name FROM sqlite_master WHERE type = 'index'"))
+        for table, columns in migrations.INDEXES:
+            self.assertTrue(migrations.index_name(table, columns) in indexes)
+
+    @unittest.skipUnless(using_sqlite(), 'SQLite only')
+    def test_query_plan_uses_index(self):
+        conn = models.sqlhub.processConnection
+        plan = conn.queryAll('EXPLAIN QUERY PLAN SELECT id FROM game_event WHERE game_id = 1 AND id > 10 ORDER BY id')
+        self.assertTrue('ix_game_event_game_id_id' in ' '.join(str(row) for row in plan))
+
+    @unittest.skipUnless(using_sqlite(), 'SQLite only')
+    def test_autoincrement_event_ids(self):
+        # Tables created without AUTOINCREMENT are rebuilt, and the events
+        # archive_game() used to leave behind deleted
+        conn = SQLiteConnection(':memory:')
+        conn.query('CREATE TABLE game_event (id INTEGER PRIMARY KEY, game_id INT, event_type VARCHAR(7), '
+                   'player_id INT, timestamp TIMESTAMP, to_id INT)')
+        conn.query('CREATE TABLE game_archive (id INTEGER PRIMARY KEY, events INT, first_event_id INT, '
+                   'last_event_id INT, data TEXT)')
+        conn.query("INSERT INTO game_event (id, game_id, event_type) VALUES (1, 1, 'joined'), (2, 2, 'joined'), "
+                   "(3, 1, 'left'), (4, 1, 'joined')")
+        conn.query("INSERT INTO game_archive VALUES (1, 2, 1, 3, '')")
+        migrations.autoincrement_event_ids(conn)
+
+        sql = conn.queryOne("SELECT sql FROM sqlite_master WHERE name = 'game_event'")[0]
+        self.assertTrue('AUTOINCREMENT' in sql)
+        self.assertEqual(conn.queryAll('SELECT id FROM game_event ORDER BY id'), [(2,), (4,)])
+        conn.query('DELETE FROM game_event WHERE id = 4')
+        conn.query("INSERT INTO game_event (game_id, event_type) VALUES (2, 'left')")
+        self.assertEqual(conn.queryAll('SELECT MAX(id) FROM game_event'), [(5,)])
+
+    @unittest.skipUnless(using_sqlite(), 'SQLite only')
+    def test_add_token_admin(self):
+        # Only the token that was the only one before becomes an admin token
+        conn = SQLiteConnection(':memory:')
+        conn.query('CREATE TABLE api_token (id INTEGER PRIMARY KEY, token_hash VARCHAR(64), name TEXT)')
+        conn.query("INSERT INTO api_token VALUES (1, '{0}', 'default'), (2, 'other', 'other')".format(
+            tokens.hash_token(tokens.DEFAULT_TOKEN)))
+        migrations.add_token_admin(conn)
+        migrations.add_token_admin(conn)
+        self.assertEqual(conn.queryAll('SELECT id, admin FROM api_token ORDER BY id'), [(1, 1), (2, 0)])
+
+
+class ResponseCacheTest(LedgermanTest):
+
+    def test_lru(self):
+        responseCache = cache.ResponseCache(maxSize=2, ttl=60)
+        for i in range(3):
+            responseCache.put(responseCache.key(('Player', i)), str(i))
+
+        self.assertEqual(responseCache.get(responseCache.key(('Player', 0))), None)
+        self.assertEqual(responseCache.get(responseCache.key(('Player', 1))), ('1', None))
+
+        # 1 was used more recently than 2, so 2 goes first
+        responseCache.put(responseCache.key(('Player', 3)), '3')
+        self.assertEqual(responseCache.get(responseCache.key(('Player', 2))), None)
+        self.assertEqual(responseCache.get(responseCache.key(('Player', 1))), ('1', None))
+        self.assertEqual(responseCache.counters(), {'hits': 2, 'misses': 2, 'size': 2})
+
+    def test_ttl_and_invalidate(self):
+        responseCache = cache.ResponseCache(maxSize=10, ttl=0)
+        responseCache.put(responseCache.key(('Player', 1)), '1')
+        time.sleep(0.01)
+        self.assertEqual(responseCache.get(responseCache.key(('Player', 1))), None)
+
+        responseCache.ttl = 60
+        responseCache.put(responseCache.key(('Player', 1)), '1')
+        responseCache.invalidate(('Player', 1))
+        self.assertEqual(responseCache.get(responseCache.key(('Player', 1))), None)
+
+    def test_invalidation(self):
+        player = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        playerPath = '/players/{0}'.format(player['id'])
+
+        self.assertEqual(self.simulate_get(playerPath, headers=self.headers).headers['x-cache'], 'MISS')
+        self.assertEqual(self.simulate_get(playerPath, headers=self.headers).headers['x-cache'], 'HIT')
+
+        player['attributes']['handle'] = 'renamed'
+        self.simulate_patch(playerPath, headers=self.headers, body=json.dumps(player))
+        res = self.simulate_get(playerPath, headers=self.headers)
+        self.assertEqual(res.headers['x-cache'], 'MISS')
+        self.assertEqual(res.json, player)
+
+        for path in ('/games/{0}/events', '/games/{0}/players'):
+            self.assertEqual(self.simulate_get(path.format(game['id']), headers=self.headers).json, [])
+            res = self.simulate_get(path.format(game['id']), headers=self.headers)
+            self.assertEqual(res.headers['x-cache'], 'HIT')
+
+        self.simulate_post('/events', headers=self.headers, body=json.dumps(self.fake_event(game, player, 'joined')))
+        self.assertEqual(len(self.simulate_get('/games/{0}/events'.format(game['id']), headers=self.headers).json), 1)
+        self.assertEqual(self.simulate_get('/games/{0}/players'.format(game['id']), headers=self.headers).json, [player])
+
+        # Renaming the player changes the game's players
+        player['attributes']['handle'] = 'renamed again'
+        self.simulate_patch(playerPath, headers=self.headers, body=json.dumps(player))
+        self.assertEqual(self.simulate_get('/games/{0}/players'.format(game['id']), headers=self.headers).json, [player])
+
+
+class FakeRedis(SocketServer.ThreadingTCPServer):
+    """Speaks enough of the Redis protocol for RedisState, so it can be
+    tested without a Redis server. With hang set it stops answering."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeRedisHandler)
+        self.lock = threading.Lock()
+        self.values = {}
+        self.subscribers = {}
+        self.commands = []
+        self.hang = False
+
+
+class FakeRedisHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        self.writeLock = threading.Lock()
+        server = self.server
+        while True:
+            try:
+                args = shared.read_reply(self.rfile)
+            except EOFError:
+                return
+
+            command = args[0].upper()
+            with server.lock:
+                server.commands.append(command)
+                if server.hang:
+                    continue
+                elif command == 'INCRBY':
+                    value = server.values[args[1]] = int(server.values.get(args[1], 0)) + int(args[2])
+                    reply = ':{0}\r\n'.format(value)
+                elif command == 'GET':
+                    value = server.values.get(args[1])
+                    reply = '$-1\r\n' if value is None else '${0}\r\n{1}\r\n'.format(len(str(value)), value)
+                elif command == 'PUBLISH':
+                    handlers = server.subscribers.get(args[1], [])
+                    for handler in handlers:
+                        handler.write(shared.encode_command(('message', args[1], args[2])))
+                    reply = ':{0}\r\n'.format(len(handlers))
+                elif command == 'SUBSCRIBE':
+                    reply = ''
+                    for channel in args[1:]:
+                        server.subscribers.setdefault(channel, []).append(self)
+                        reply += '*3\r\n$9\r\nsubscribe\r\n${0}\r\n{1}\r\n:1\r\n'.format(len(channel), channel)
+                else:
+                    reply = '+OK\r\n'
+            self.write(reply)
+
+    def write(self, data):
+        with self.writeLock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+
+class SharedStateTest(LedgermanTest):
+
+    def test_propagation(self):
+        broker = shared.LocalBroker()
+        states = [shared.LocalState(broker), shared.LocalState(broker)]
+        caches = [cache.ResponseCache(state=state) for state in states]
+        hubs = [feed.FeedHub(state=state) for state in states]
+
+        caches[1].put(caches[1].key(('Player', 1)), '1')
+        caches[0].invalidate(('Player', 1))
+        self.assertEqual(caches[1].get(caches[1].key(('Player', 1))), None)
+
+        # Invalidations made in a transaction are only published once it ends
+        caches[1].put(caches[1].key(('Player', 1)), '1')
+        caches[0].track_pending()
+        caches[0].invalidate(('Player', 1))
+        self.assertEqual(caches[1].get(caches[1].key(('Player', 1))), ('1', None))
+        caches[0].invalidate_pending()
+        self.assertEqual(caches[1].get(caches[1].key(('Player', 1))), None)
+
+        subs = [hub.subscribe(1) for hub in hubs]
+        hubs[0].publish(1, 5, '{"id": 5}')
+        hubs[0].publish(1)
+        self.assertEqual(subs[1].wait(), [(5, '{"id": 5}'), (None, feed.RESYNC)])
+        self.assertEqual(subs[0].wait(), [(5, '{"id": 5}'), (None, feed.RESYNC)])
+
+    def test_counters(self):
+        state = shared.LocalState()
+        self.assertEqual(state.incr('requests'), 1)
+        self.assertEqual(state.incr('requests', 2), 3)
+        self.assertEqual(state.get('requests'), 3)
+
+        state.incr('window', ttl=0.01)
+        time.sleep(0.02)
+        self.assertEqual(state.get('window'), 0)
+        self.assertEqual(state.incr('window', ttl=60), 1)
+
+    def test_resp(self):
+        command = shared.encode_command(('SET', 'key', u'caf\xe9', 5))
+        self.assertEqual(command, '*4\r\n$3\r\nSET\r\n$3\r\nkey\r\n$5\r\ncaf\xc3\xa9\r\n$1\r\n5\r\n')
+
+        reader = StringIO.StringIO('+OK\r\n:42\r\n$-1\r\n*3\r\n$7\r\nmessage\r\n$1\r\na\r\n$2\r\n{}\r\n'
+                                   '-ERR wrong type\r\n$10\r\ntruncated')
+        self.assertEqual(shared.read_reply(reader), 'OK')
+        self.assertEqual(shared.read_reply(reader), 42)
+        self.assertEqual(shared.read_reply(reader), None)
+        self.assertEqual(shared.read_reply(reader), ['message', 'a', '{}'])
+        self.assertRaises(shared.RedisError, shared.read_reply, reader)
+        self.assertRaises(EOFError, shared.read_reply, reader)
+
+    @unittest.skipUnless(os.environ.get('LEDGERMAN_TEST_REDIS'), 'LEDGERMAN_TEST_REDIS not set')
+    def test_redis(self):
+        self.check_redis(os.environ['LEDGERMAN_TEST_REDIS'])
+
+    def test_fake_redis(self):
+        server = FakeRedis()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'redis://:secret@127.0.0.1:{0}/1?timeout=0.2'.format(server.server_address[1])
+            self.check_redis(url)
+            self.assertEqual(server.commands[:2], ['AUTH', 'SELECT'])
+
+            # A server that stops answering times out rather than holding up the worker
+            state = shared.RedisState.from_url(url)
+            self.assertEqual(state.timeout, 0.2)
+            server.hang = True
+            started = time.time()
+            self.assertRaises(socket.timeout, state.get, 'key')
+            self.assertTrue(time.time() - started < 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def check_redis(self, url):
+        states = [shared.RedisState.from_url(url) for i in range(2)]
+        received = threading.Event()
+        states[1].subscribe('test', lambda message: received.set())
+        time.sleep(0.1)
+        states[0].publish('test', ['hello'])
+        self.assertTrue(received.wait(5))
+
+        key = 'test-{0}'.format(random.getrandbits(32))
+        self.assertEqual(states[0].incr(key, ttl=60), 1)
+        self.assertEqual(states[1].incr(key, 2), 3)
+        self.assertEqual(states[0].get(key), 3)
+
+
+class StatsTest(LedgermanTest):
+
+    def get_attributes(self, path):
+        res = self.simulate_get(path, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return res.json['attributes']
+
+    def test_stats(self):
+        p1 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        p2 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+
+        batch = [
+            self.fake_event(game, p1, 'joined'),
+            self.fake_event(game, p2, 'joined'),
+            self.fake_event(game, p1, 'fragged', p2),
+            self.fake_event(game, p1, 'fragged', p2),
+            self.fake_event(game, p2, 'damaged', p1),
+        ]
+        self.simulate_post('/events/batch', headers=self.headers, body=json.dumps(batch))
+        self.simulate_post('/events', headers=self.headers, body=json.dumps(self.fake_event(game, p2, 'fragged', p1)))
+
+        game['attributes']['winner-id'] = p1['id']
+        game['attributes']['active'] = False
+        self.simulate_patch('/games/{0}'.format(game['id']), headers=self.headers, body=json.dumps(game))
+
+        achievementType = self.simulate_post('/achievement-types', headers=self.headers, body=json.dumps({
+            'type': 'achievement-type',
+            'attributes': {'name': 'Flawless', 'description': 'Won without dying'}
+        })).json
+        self.simulate_post('/achievements', headers=self.headers, body=json.dumps({
+            'type': 'achievement',
+            'attributes': {
+                'achievement-type-id': achievementType['id'],
+                'game-id': game['id'],
+                'player-id': p1['id'],
+                'timestamp': str(datetime.datetime.now())
+            }
+        }))
+
+        p1Stats = self.get_attributes('/players/{0}/stats'.format(p1['id']))
+        self.assertEqual(p1Stats, {
+            'frags': 2, 'deaths': 1, 'damage-dealt': 0, 'damage-taken': 1, 'games-played': 1,
+            'wins': 1, 'achievements': 1, 'kd-ratio': 2.0
+        })
+
+        p2Stats = self.get_attributes('/players/{0}/stats'.format(p2['id']))
+        self.assertEqual((p2Stats['frags'], p2Stats['deaths'], p2Stats['damage-dealt'], p2Stats['wins']), (1, 2, 1, 0))
+
+        gameStats = self.get_attributes('/games/{0}/stats'.format(game['id']))
+        self.assertEqual(gameStats, {'events': 6, 'frags': 3, 'damage-events': 1, 'players': 2})
+
+        res = self.simulate_get('/leaderboard', headers=self.headers, query_string='by=wins&limit=1')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([p['id'] for p in res.json], [p1['id']])
+
+        # Recounting everything from scratch gives the same totals
+        conn = models.sqlhub.processConnection
+        conn.query('DELETE FROM player_stats')
+        conn.query('DELETE FROM game_stats')
+        migrations.create_stats(conn)
+        self.assertEqual(self.get_attributes('/players/{0}/stats'.format(p1['id'])), p1Stats)
+        self.assertEqual(self.get_attributes('/games/{0}/stats'.format(game['id'])), gameStats)
+
+    def test_stats_not_found(self):
+        res = self.simulate_get('/players/999999/stats', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_stats_rows(self):
+        conn = models.sqlhub.processConnection
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        conn.query('DELETE FROM game_stats WHERE id = {0}'.format(game['id']))
+
+        # Reads don't write rows, and rows another request inserted first are kept
+        gameStats = self.get_attributes('/games/{0}/stats'.format(game['id']))
+        self.assertEqual(gameStats, {'events': 0, 'frags': 0, 'damage-events': 0, 'players': 0})
+        self.assertEqual(conn.queryAll('SELECT id FROM game_stats WHERE id = {0}'.format(game['id'])), [])
+
+        stats.ensure_rows(stats.GameStats, [game['id']], conn)
+        conn.query('UPDATE game_stats SET events = 5 WHERE id = {0}'.format(game['id']))
+        stats.ensure_rows(stats.GameStats, [game['id']], conn)
+        self.assertEqual(self.get_attributes('/games/{0}/stats'.format(game['id']))['events'], 5)
+
+    def test_stats_delete(self):
+        p1 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        p2 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        games = [self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+                 for i in range(2)]
+        batch = [self.fake_event(game, p, 'joined') for game in games for p in (p1, p2)]
+        self.simulate_post('/events/batch', headers=self.headers, body=json.dumps(batch))
+
+        games[0]['attributes']['winner-id'] = p1['id']
+        self.simulate_patch('/games/{0}'.format(games[0]['id']), headers=self.headers, body=json.dumps(games[0]))
+        self.simulate_delete('/games/{0}'.format(games[0]['id']), headers=self.headers)
+
+        p1Stats = self.get_attributes('/players/{0}/stats'.format(p1['id']))
+        self.assertEqual((p1Stats['games-played'], p1Stats['wins']), (1, 0))
+        conn = models.sqlhub.processConnection
+        self.assertEqual(conn.queryAll('SELECT id FROM game_stats WHERE id = {0}'.format(games[0]['id'])), [])
+
+        self.simulate_delete('/players/{0}'.format(p2['id']), headers=self.headers)
+        self.assertEqual(self.get_attributes('/games/{0}/stats'.format(games[1]['id']))['players'], 1)
+        res = self.simulate_get('/leaderboard', headers=self.headers, query_string='by=games-played&limit=100')
+        self.assertNotIn(p2['id'], [p['id'] for p in res.json])
+
+    def test_bad_leaderboard(self):
+        res = self.simulate_get('/leaderboard', headers=self.headers, query_string='by=handle')
+        self.assertEqual(res.status_code, 400)
+
+
+class StreamTest(LedgermanTest):
+
+    def setUp(self):
+        super(StreamTest, self).setUp()
+        self.player = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        self.streamPath = '/games/{0}/events/stream'.format(self.game['id'])
+
+    def post_event(self, eventType='joined'):
+        self.simulate_post('/events', headers=self.headers,
+                           body=json.dumps(self.fake_event(self.game, self.player, eventType)))
+
+    def test_long_poll(self):
+        self.post_event()
+        self.post_event('fragged')
+
+        res = self.simulate_get(self.streamPath, headers=self.headers, query_string='wait=0')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([e['attributes']['event-type'] for e in res.json], ['joined', 'fragged'])
+
+        after = res.json[-1]['id']
+        res = self.simulate_get(self.streamPath, headers=self.headers, query_string='after={0}&wait=0'.format(after))
+        self.assertEqual(res.json, [])
+
+        res = self.simulate_get('/games/999999/events/stream', headers=self.headers, query_string='wait=0')
+        self.assertEqual(res.status_code, 404)
+
+    def test_server_sent_events(self):
+        self.post_event()
+        headers = dict(self.headers, Accept='text/event-stream')
+        res = self.simulate_get(self.streamPath, headers=headers, query_string='wait=0')
+        self.assertEqual(res.headers['content-type'], 'text/event-stream')
+
+        eventId = self.simulate_get(self.streamPath, headers=self.headers, query_string='wait=0').json[0]['id']
+        self.assertTrue(res.content.startswith('id: {0}\ndata: {{'.format(eventId)))
+
+        headers['Last-Event-ID'] = str(eventId)
+        res = self.simulate_get(self.streamPath, headers=headers, query_string='wait=0')
+        self.assertTrue(res.content.startswith(': '))
+
+    def test_watch(self):
+        hub = feed.FeedHub(queueSize=16, tick=0.05)
+        watch = feed.watch_game(self.game['id'], 0, 60, hub)
+        self.assertEqual(next(watch), [])
+        self.assertEqual(hub.counters()['watchers'], 1)
+
+        # Events are only published once their transaction commits
+        hub.track_pending()
+        hub.publish(self.game['id'], 1, '{"id": 1}')
+        hub.discard_pending()
+        hub.track_pending()
+        hub.publish(self.game['id'], 2, '{"id": 2}')
+        hub.publish_pending()
+        self.assertEqual(next(watch), [(2, '{"id": 2}')])
+
+        # Ticks and resyncs read from the database
+        self.post_event()
+        self.assertEqual(len(next(watch)), 1)
+        hub.publish(self.game['id'])
+        self.assertEqual(next(watch), [])
+
+        watch.close()
+        self.assertEqual(hub.counters()['watchers'], 0)
+
+    def test_catch_up(self):
+        hub = feed.FeedHub(tick=3600)
+        watches = [feed.watch_game(self.game['id'], 0, 60, hub, notify=lambda: None) for i in range(3)]
+        for watch in watches:
+            self.assertEqual(next(watch), [])
+
+        # A tick reads the game's events once, for all its watchers
+        self.post_event()
+        reads = []
+        read_events = feed.read_events
+        feed.read_events = lambda *args: reads.append(args) or read_events(*args)
+        try:
+            hub.tick_games()
+            results = [next(watch) for watch in watches]
+            results = [events if events is not None else next(watch) for events, watch in zip(results, watches)]
+        finally:
+            feed.read_events = read_events
+        self.assertEqual(len(reads), 1)
+        self.assertEqual([len(events) for events in results], [1, 1, 1])
+
+        # Watchers that have waited long enough are woken, the others aren't
+        self.assertEqual([next(watch) for watch in watches], [None, None, None])
+        hub.tick_games(time.time() + 30)
+        self.assertEqual([next(watch) for watch in watches], [[], [], []])
+        for watch in watches:
+            watch.close()
+
+    def test_backpressure(self):
+        hub = feed.FeedHub(queueSize=2)
+        sub = hub.subscribe(self.game['id'])
+        for eventId in range(3):
+            hub.publish(self.game['id'], eventId, '{}')
+
+        self.assertTrue(sub.lagged)
+        self.assertEqual(len(sub.wait()), 2)
+        self.assertEqual((hub.counters()['published'], hub.counters()['dropped']), (2, 1))
+
+        # A watcher that lags behind catches up from the database instead
+        hub = feed.FeedHub(queueSize=1)
+        watch = feed.watch_game(self.game['id'], 0, 60, hub)
+        self.assertEqual(next(watch), [])
+        self.post_event()
+        for eventId in range(2):
+            hub.publish(self.game['id'], eventId, '{}')
+        events = [json.loads(body) for eventId, body in next(watch)]
+        self.assertEqual([e['attributes']['event-type'] for e in events], ['joined'])
+        watch.close()
+
+    def test_notify(self):
+        hub = feed.FeedHub()
+        notified = []
+        watch = feed.watch_game(self.game['id'], 0, 60, hub, notify=lambda: notified.append(1))
+        self.assertEqual(next(watch), [])
+
+        # Rather than block, the watcher yields None until it's notified
+        self.assertEqual(next(watch), None)
+        hub.publish(self.game['id'], 1, '{}')
+        self.assertEqual(notified, [1])
+        self.assertEqual(next(watch), [(1, '{}')])
+        watch.close()
+
+
+class TokenTest(LedgermanTest):
+
+    def token_headers(self, admin=False, **limits):
+        rates = dict((k[:-5], v) for k, v in limits.iteritems() if k.endswith('_rate'))
+        quotas = dict((k[:-6], v) for k, v in limits.iteritems() if k.endswith('_quota'))
+        token = tokens.tokenStore.create(u'test', rates, quotas, admin)
+        return dict(self.headers, **{'X-API-Token': token})
+
+    def test_bad_token(self):
+        res = self.simulate_get('/cache-stats', headers=dict(self.headers, **{'X-API-Token': 'nope'}))
+        self.assertEqual(res.status_code, 400)
+
+        headers = self.token_headers()
+        self.assertEqual(self.simulate_get('/cache-stats', headers=headers).status_code, 200)
+
+        limits = tokens.tokenStore.lookup(headers['X-API-Token'])
+        tokens.tokenStore.revoke(limits.tokenId)
+        self.assertEqual(self.simulate_get('/cache-stats', headers=headers).status_code, 400)
+
+    def test_admin(self):
+        headers = self.token_headers()
+        self.assertEqual(self.simulate_get('/admin/export/players', headers=headers).status_code, 403)
+        res = self.simulate_post('/admin/import/players', headers=headers, body=json.dumps(self.fake_player()))
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(self.simulate_get('/players', headers=headers).status_code, 200)
+
+        headers = self.token_headers(admin=True)
+        self.assertEqual(self.simulate_get('/admin/export/players', headers=headers).status_code, 200)
+
+    def test_unknown_tokens(self):
+        store = tokens.TokenStore(maxSize=2, failedRate=1, burst=3)
+        valid = store.create(u'test')
+        self.assertNotEqual(store.lookup(valid), None)
+
+        # Unknown tokens are only looked up once, and don't push out valid ones
+        loads = []
+        load = store.load
+        store.load = lambda tokenHash: loads.append(tokenHash) or load(tokenHash)
+        for token in ('a', 'b', 'c', 'c'):
+            self.assertEqual(store.lookup(token), None)
+        self.assertEqual(len(loads), 3)
+        self.assertEqual(len(store.unknown), 2)
+        self.assertNotEqual(store.lookup(valid), None)
+        self.assertEqual(len(loads), 3)
+
+        # Each address can only try so many unknown tokens
+        for token in ('d', 'e', 'f'):
+            self.assertEqual(store.lookup(token, '10.0.0.1'), None)
+        self.assertRaises(tokens.TooManyFailures, store.lookup, 'g', '10.0.0.1')
+        self.assertEqual(store.lookup('f', '10.0.0.1'), None)
+        self.assertNotEqual(store.lookup(valid, '10.0.0.1'), None)
+        self.assertEqual(store.lookup('g', '10.0.0.2'), None)
+
+    def test_rate_limit(self):
+        headers = self.token_headers(admin=True, read_rate=0.1, bulk_rate=0.1)
+        self.assertEqual(self.simulate_get('/cache-stats', headers=headers).status_code, 200)
+        res = self.simulate_get('/cache-stats', headers=headers)
+        self.assertEqual(res.status_code, 429)
+        self.assertTrue(0 < int(res.headers['retry-after']) <= 10)
+
+        # Bulk routes and writes are limited separately
+        self.assertEqual(self.simulate_get('/admin/export/players', headers=headers).status_code, 200)
+        self.assertEqual(self.simulate_get('/admin/export/players', headers=headers).status_code, 429)
+        res = self.simulate_post('/players', headers=headers, body=json.dumps(self.fake_player()))
+        self.assertEqual(res.status_code, 200)
+
+        limiter = tokens.RateLimiter(burst=2)
+        self.assertEqual([limiter.take('key', 1, 100) for i in range(3)], [0, 0, 1])
+        self.assertEqual(limiter.take('key', 1, 100.5), 0.5)
+        self.assertEqual(limiter.take('key', 1, 101), 0)
+
+    def test_quota(self):
+        headers = self.token_headers(write_quota=2)
+        for status in (200, 200, 429):
+            res = self.simulate_post('/players', headers=headers, body=json.dumps(self.fake_player()))
+            self.assertEqual(res.status_code, status)
+        self.assertEqual(self.simulate_get('/cache-stats', headers=headers).status_code, 200)
+
+        # Workers share their counts when they sync
+        state = shared.LocalState()
+        counters = [tokens.QuotaCounter(0, state), tokens.QuotaCounter(0, state)]
+        now = tokens.QUOTA_WINDOW * 100 + 10
+        self.assertEqual([counters[0].take('key', 3, now) for i in range(3)], [0, 0, 0])
+        self.assertEqual(counters[1].take('key', 3, now), tokens.QUOTA_WINDOW - 10)
+        self.assertEqual(counters[1].take('key', 3, now + tokens.QUOTA_WINDOW), 0)
+
+
+class TransferTest(LedgermanTest):
+
+    def export(self, model, fmt='ndjson'):
+        res = self.simulate_get('/admin/export/' + model, headers=self.headers, query_string='format=' + fmt)
+        self.assertEqual(res.status_code, 200)
+        return res.content
+
+    def import_(self, model, body, fmt='ndjson'):
+        res = self.simulate_post('/admin/import/' + model, headers=self.headers, body=body,
+                                 query_string='format=' + fmt)
+        self.assertEqual(res.status_code, 200)
+        return res.json
+
+    def test_export(self):
+        player = self.fake_player()
+        player['attributes']['name'] = u'Zo\xeb, "Z"'
+        player = self.simulate_post('/players', headers=self.headers, body=json.dumps(player)).json
+
+        lines = self.export('players').splitlines()
+        self.assertEqual(len(lines), int(models.Player.select().count()))
+        self.assertEqual(json.loads(lines[-1]), player)
+
+        rows = list(csv.reader(StringIO.StringIO(self.export('players', 'csv'))))
+        self.assertEqual(rows[0], ['id', 'avatar-url', 'email', 'handle', 'name'])
+        self.assertEqual(rows[-1][0], str(player['id']))
+        self.assertEqual(rows[-1][4].decode('utf-8'), player['attributes']['name'])
+
+        self.assertEqual(self.simulate_get('/admin/export/nothing', headers=self.headers).status_code, 404)
+        res = self.simulate_get('/admin/export/players', headers=self.headers, query_string='format=xml')
+        self.assertEqual(res.status_code, 400)
+
+    def test_import(self):
+        players = [self.fake_player() for i in range(2)]
+        result = self.import_('players', '\n'.join([json.dumps(players[0]), 'not json', '',
+                                                    json.dumps(players[1])]))
+        self.assertEqual((result['imported'], result['failed']), (2, 1))
+        self.assertEqual(result['errors'][0]['line'], 2)
+
+        # Exported CSV can be imported, as can objects without ids
+        exported = list(csv.reader(StringIO.StringIO(self.export('players', 'csv'))))
+        p1, p2 = [dict(zip(exported[0], row)) for row in exported[-2:]]
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+
+        out = StringIO.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(['game-id', 'event-type', 'player-id', 'timestamp', 'to-id'])
+        writer.writerow([game['id'], 'joined', p1['id'], '2016-09-05 12:00:00', ''])
+        writer.writerow([game['id'], 'fragged', p1['id'], '2016-09-05 12:01:00', p2['id']])
+        writer.writerow([999999, 'joined', p1['id'], '2016-09-05 12:02:00', ''])
+        writer.writerow([game['id'], 'exploded', p1['id'], '2016-09-05 12:03:00', ''])
+        result = self.import_('events', out.getvalue(), 'csv')
+        self.assertEqual((result['imported'], result['failed']), (2, 2))
+        self.assertEqual([error['line'] for error in result['errors']], [4, 5])
+
+        # Imported objects count the same as posted ones
+        res = self.simulate_get('/games/{0}/players'.format(game['id']), headers=self.headers)
+        self.assertEqual([player['id'] for player in res.json], [int(p1['id'])])
+        stats = self.simulate_get('/games/{0}/stats'.format(game['id']), headers=self.headers).json
+        self.assertEqual((stats['attributes']['events'], stats['attributes']['frags']), (2, 1))
+        stats = self.simulate_get('/players/{0}/stats'.format(p2['id']), headers=self.headers).json
+        self.assertEqual(stats['attributes']['deaths'], 1)
+
+    def test_import_ids(self):
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        newGame = dict(game, id=game['id'] + 100)
+
+        result = self.import_('games', json.dumps(newGame))
+        self.assertEqual(result['imported'], 1)
+        res = self.simulate_get('/games/{0}'.format(newGame['id']), headers=self.headers)
+        self.assertEqual(res.json, newGame)
+
+        # Ids that are taken fail the whole chunk
+        result = transfer.import_rows('games', [json.dumps(self.fake_game()), json.dumps(game)], 'ndjson')
+        self.assertEqual((result['imported'], result['failed']), (0, 2))
+        self.assertTrue(result['errors'][0]['description'].startswith('Lines 1-2 were not imported'))
+
+
+class TransactionTest(LedgermanTest):
+
+    def request(self, method):
+        return falcon.Request(testing.create_environ('/players', method=method))
+
+    def test_rollback(self):
+        middleware = ledgerman.TransactionMiddleware()
+        req = self.request('POST')
+        middleware.process_request(req, None)
+        player = models.Player(name='Rolled Back', handle='rb', email=None, avatarUrl=None)
+        middleware.process_response(req, None, None, False)
+
+        self.assertRaises(models.SQLObjectNotFound, models.Player.get, player.id)
+
+    def test_commit(self):
+        middleware = ledgerman.TransactionMiddleware()
+        req = self.request('POST')
+        middleware.process_request(req, None)
+        player = models.Player(name='Committed', handle='c', email=None, avatarUrl=None)
+        middleware.process_response(req, None, None, True)
+
+        self.assertEqual(models.Player.get(player.id).name, 'Committed')
+        models.Player.delete(player.id)
+
+    def test_get_not_in_transaction(self):
+        middleware = ledgerman.TransactionMiddleware()
+        req = self.request('GET')
+        middleware.process_request(req, None)
+        self.assertFalse(isinstance(models.sqlhub.getConnection(), models.Transaction))
+        middleware.process_response(req, None, None, True)
+
+
+class VersionTest(LedgermanTest):
+
+    def conditional_get(self, path, **headers):
+        headers.update(self.headers)
+        return self.simulate_get(path, headers=headers)
+
+    def test_if_none_match(self):
+        player = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        eventsPath = '/games/{0}/events'.format(game['id'])
+
+        res = self.conditional_get(eventsPath)
+        tag = res.headers['etag']
+        self.assertEqual(res.status_code, 200)
+        res = self.conditional_get(eventsPath, **{'If-None-Match': tag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.content, '')
+
+        self.simulate_post('/events', headers=self.headers, body=json.dumps(self.fake_event(game, player, 'joined')))
+        res = self.conditional_get(eventsPath, **{'If-None-Match': tag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.json), 1)
+        self.assertNotEqual(res.headers['etag'], tag)
+
+        # The player's events changed too, but not other players'
+        playerPath = '/players/{0}'.format(player['id'])
+        tag = self.conditional_get(playerPath).headers['etag']
+        self.assertEqual(self.conditional_get(playerPath, **{'If-None-Match': 'W/' + tag}).status_code, 304)
+
+    def test_not_found(self):
+        for path in ('/players/999999', '/games/999999/events'):
+            for tag in ('"0"', '*'):
+                self.assertEqual(self.conditional_get(path, **{'If-None-Match': tag}).status_code, 404)
+
+    def test_if_modified_since(self):
+        player = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        playerPath = '/players/{0}'.format(player['id'])
+
+        lastModified = self.conditional_get(playerPath).headers['last-modified']
+        res = self.conditional_get(playerPath, **{'If-Modified-Since': lastModified})
+        self.assertEqual(res.status_code, 304)
+
+        res = self.conditional_get(playerPath, **{'If-Modified-Since': 'Thu, 01 Jan 2015 00:00:00 GMT'})
+        self.assertEqual(res.status_code, 200)
+
+    def test_rollback_keeps_version(self):
+        player = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        group = ('Player', player['id'])
+        version = versions.get_version(group)
+
+        middleware = ledgerman.TransactionMiddleware()
+        req = falcon.Request(testing.create_environ('/players', method='PATCH'))
+        middleware.process_request(req, None)
+        cache.invalidate(group)
+        middleware.process_response(req, None, None, False)
+        self.assertEqual(versions.get_version(group), version)
+
+        middleware.process_request(req, None)
+        cache.invalidate(group)
+        middleware.process_response(req, None, None, True)
+        self.assertEqual(versions.get_version(group)[0], version[0] + 1)
+
+
+def using_memory_db():
+    return using_sqlite() and models.sqlhub.processConnection.filename == ':memory:'
+
+
+class WriteBehindTest(LedgermanTest):
+
+    def setUp(self):
+        super(WriteBehindTest, self).setUp()
+        self.writer = writebehind.EventWriter(0.01)
+        restfuls.eventWriter = self.writer
+        self.player = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+
+    def tearDown(self):
+        restfuls.eventWriter = None
+        self.writer.drain()
+
+    def get_event_types(self):
+        events = self.simulate_get('/games/{0}/events'.format(self.game['id']), headers=self.headers).json
+        return [e['attributes']['event-type'] for e in events]
+
+    def test_group_commit(self):
+        events = []
+        for eventType in ('joined', 'spawned'):
+            attrs = models.GameEvent.parse_json_object(self.fake_event(self.game, self.player, eventType), 'event')
+            events.append((attrs, models.GameEvent.to_row(attrs)))
+
+        self.writer.write(events)
+        self.assertEqual(self.writer.counters(), {'depth': 0, 'written': 2, 'failed': 0, 'batches': 1})
+        self.assertEqual(self.get_event_types(), ['joined', 'spawned'])
+        self.assertEqual(self.simulate_get('/games/{0}/players'.format(self.game['id']), headers=self.headers).json,
+                         [self.player])
+
+    def test_no_longer_valid(self):
+        # Events whose game ended after they were queued are dropped, and the rest written
+        ended = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        events = []
+        for game in (self.game, ended, ended):
+            attrs = models.GameEvent.parse_json_object(self.fake_event(game, self.player, 'joined'), 'event')
+            events.append((attrs, models.GameEvent.to_row(attrs)))
+        models.Game.get(ended['id']).active = False
+
+        self.writer.write(events)
+        self.assertEqual(self.writer.counters(), {'depth': 0, 'written': 1, 'failed': 2, 'batches': 1})
+        self.assertEqual(self.get_event_types(), ['joined'])
+
+    def use_file_db(self):
+        """Switches to a new SQLite database file until the test ends. The
+        writer thread can't use the test thread's in-memory database."""
+        dbDir = tempfile.mkdtemp()
+        memoryConn = models.sqlhub.processConnection
+
+        def restore():
+            models.sqlhub.processConnection.close()
+            models.sqlhub.processConnection = memoryConn
+            forget_cached()
+            shutil.rmtree(dbDir)
+
+        def forget_cached():
+            cache.responseCache.clear()
+            models.existingIds.clear()
+
+        self.addCleanup(restore)
+        models.init_db(os.path.join(dbDir, 'writebehind.db'))
+        forget_cached()
+        self.player = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+
+    def test_write_behind(self):
+        if using_memory_db():
+            self.use_file_db()
+
+        for eventType in ('joined', 'spawned'):
+            res = self.simulate_post('/events', headers=self.headers,
+                                     body=json.dumps(self.fake_event(self.game, self.player, eventType)))
+            self.assertEqual(res.status_code, 202)
+            self.assertTrue(res.json['provisional-id'].startswith('{0}-'.format(os.getpid())))
+
+        self.writer.drain()
+        self.assertEqual(self.simulate_get('/events/queue', headers=self.headers).json['depth'], 0)
+        self.assertEqual(self.get_event_types(), ['joined', 'spawned'])
+
+    def test_drained(self):
+        # Once drained, events are written as they're posted again
+        self.writer.drain()
+        res = self.simulate_post('/events', headers=self.headers,
+                                 body=json.dumps(self.fake_event(self.game, self.player, 'joined')))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.get_event_types(), ['joined'])
+
+    def test_invalid_event(self):
+        res = self.simulate_post('/events', headers=self.headers, body=json.dumps({
+            'type': 'event', 'attributes': {'game-id': 999999, 'event-type': 'joined'}}))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.writer.counters()['depth'], 0)
+
 
 class PlayerTest(LedgermanTest):
 
@@ -238,6 +1869,157 @@ class GameEventTest(LedgermanTest):
         self.assertEquals(errorObj['description'], 'Events cannot be created for an inactive game')
 
 
+class GameEventBatchTest(LedgermanTest):
+
+    def test_create_batch(self):
+        p1 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        p2 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+
+        batch = [
+            self.fake_event(game, p1, 'joined'),
+            self.fake_event(game, p2, 'joined'),
+            self.fake_event(game, p1, 'fragged', p2),
+            self.fake_event(game, p1, 'teabagged', p2),
+            self.fake_event(game, p2, 'damaged', p1),
+        ]
+        del batch[4]['attributes']['game-id']
+
+        res = self.simulate_post('/events/batch', headers=self.headers, body=json.dumps(batch))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['accepted'], 3)
+        self.assertEqual([e['index'] for e in res.json['errors']], [3, 4])
+
+        res = self.simulate_get('/games/{0}/events'.format(game['id']), headers=self.headers)
+        self.assertEqual(len(res.json), 3)
+
+        res = self.simulate_get('/games/{0}/players'.format(game['id']), headers=self.headers)
+        self.assertEqual(sorted(p['id'] for p in res.json), sorted([p1['id'], p2['id']]))
+
+    def test_create_batch_null_ids(self):
+        p1 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+
+        batch = [
+            self.fake_event(game, p1, 'joined'),
+            self.fake_event(game, p1, 'spawned'),
+            self.fake_event(game, p1, 'joined'),
+            self.fake_event(game, p1, 'left'),
+            self.fake_event(game, p1, 'spawned'),
+        ]
+        batch[1]['attributes']['game-id'] = None
+        batch[2]['attributes']['player-id'] = None
+        batch[3]['attributes']['player-id'] = None
+
+        # Each is a per-item error, rather than failing the whole batch
+        res = self.simulate_post('/events/batch', headers=self.headers, body=json.dumps(batch))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['accepted'], 2)
+        self.assertEqual([e['index'] for e in res.json['errors']], [1, 2, 3])
+
+        res = self.simulate_get('/games/{0}/events'.format(game['id']), headers=self.headers)
+        self.assertEqual([e['attributes']['event-type'] for e in res.json], ['joined', 'spawned'])
+
+        res = self.simulate_post('/events', headers=self.headers, body=json.dumps(batch[2]))
+        self.assertEqual(res.status_code, 400)
+        result = transfer.import_rows('events', [json.dumps(event) for event in batch], 'ndjson')
+        self.assertEqual((result['imported'], result['failed']), (2, 3))
+
+    def test_create_batch_timestamps(self):
+        p1 = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+        event = self.fake_event(game, p1, 'joined')
+        event['attributes']['timestamp'] = '2016-03-01 12:30:45'
+        self.simulate_post('/events/batch', headers=self.headers, body=json.dumps([event]))
+        self.simulate_post('/events', headers=self.headers, body=json.dumps(event))
+
+        # Rows inserted in bulk are stored like ones SQLObject inserted, so
+        # they read back and compare the same
+        since = datetime.datetime(2016, 3, 1, 12, 30, 45)
+        events = list(models.GameEvent.select(models.AND(models.GameEvent.q.gameID == game['id'],
+                                                         models.GameEvent.q.timestamp >= since)))
+        self.assertEqual([e.timestamp for e in events], [since, since])
+
+    def test_create_batch_not_array(self):
+        res = self.simulate_post('/events/batch', headers=self.headers, body=json.dumps({'type': 'event'}))
+        self.assertEqual(res.status_code, 400)
+
+
+class GameEventPaginationTest(LedgermanTest):
+
+    def setUp(self):
+        super(GameEventPaginationTest, self).setUp()
+
+        self.player = self.simulate_post('/players', headers=self.headers, body=json.dumps(self.fake_player())).json
+        self.game = self.simulate_post('/games', headers=self.headers, body=json.dumps(self.fake_game())).json
+
+        batch = [self.fake_event(self.game, self.player, 'joined')]
+        for i in range(6):
+            event = self.fake_event(self.game, self.player, 'spawned')
+            event['attributes']['timestamp'] = '2016-09-05 12:0{0}:00'.format(i)
+            batch.append(event)
+        self.simulate_post('/events/batch', headers=self.headers, body=json.dumps(batch))
+
+    def get_pages(self, path, query):
+        events = []
+        pages = 0
+        while path is not None:
+            res = self.simulate_get(path, headers=self.headers, query_string=query)
+            self.assertEqual(res.status_code, 200)
+            events.extend(res.json)
+            pages += 1
+
+            path = None
+            link = res.headers.get('link')
+            if link is not None:
+                path, query = re.match(r'<([^?]*)\?([^>]*)>; rel=next', link).groups()
+
+        return events, pages
+
+    def test_paginate_relationship(self):
+        events, pages = self.get_pages('/games/{0}/events'.format(self.game['id']), 'limit=3')
+        self.assertEqual(len(events), 7)
+        self.assertEqual(pages, 3)
+        ids = [e['id'] for e in events]
+        self.assertEqual(ids, sorted(ids))
+
+    def test_filter(self):
+        query = 'game-id={0}&event-type=spawned&since=2016-09-05 12:02:00&limit=2'.format(self.game['id'])
+        events, pages = self.get_pages('/events', query)
+        self.assertEqual(len(events), 4)
+        self.assertEqual(pages, 2)
+        for e in events:
+            self.assertEqual(e['attributes']['event-type'], 'spawned')
+
+    def test_bad_filter(self):
+        res = self.simulate_get('/events', headers=self.headers, query_string='event-type=teabagged')
+        self.assertEqual(res.status_code, 400)
+
+    def test_sparse_fieldset(self):
+        path = '/games/{0}/events'.format(self.game['id'])
+        full, pages = self.get_pages(path, 'limit=3')
+        events, pages = self.get_pages(path, 'limit=3&fields[event]=event-type,timestamp')
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(events), len(full))
+        for event, fullEvent in zip(events, full):
+            self.assertEqual(event['id'], fullEvent['id'])
+            self.assertEqual(event['attributes'], {'event-type': fullEvent['attributes']['event-type'],
+                                                   'timestamp': fullEvent['attributes']['timestamp']})
+
+        res = self.simulate_get('/events/{0}'.format(full[0]['id']), headers=self.headers,
+                                query_string='fields[event]=game-id')
+        self.assertEqual(res.json['attributes'], {'game-id': self.game['id']})
+
+        res = self.simulate_get('/games/{0}'.format(self.game['id']), headers=self.headers,
+                                query_string='include=events&fields[game]=active&fields[event]=player-id')
+        self.assertEqual(res.json['attributes'], {'active': True})
+        self.assertEqual([e['attributes'] for e in res.json['included']['events']],
+                         [{'player-id': self.player['id']}] * len(full))
+
+    def test_bad_fieldset(self):
+        res = self.simulate_get('/events', headers=self.headers, query_string='fields[event]=score')
+        self.assertEqual(res.status_code, 400)
+
 
 if __name__ == '__main__':
     unittest.main()
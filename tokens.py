@@ -0,0 +1,311 @@
+from collections import OrderedDict
+from models import LedgermanModel, sqlbuilder, sqlhub
+from shared import TOKEN_CHANNEL, sharedState
+from sqlobject import BoolCol, FloatCol, IntCol, StringCol, UnicodeCol
+import binascii
+import hashlib
+import logging
+import md5
+import os
+import threading
+import time
+
+# The token that every database starts with, which has no limits. Revoke it
+# once clients have their own tokens, see manage_tokens.py.
+DEFAULT_TOKEN = md5.md5(
+    'In real life we would generate random api tokens for clients and store them in a table').hexdigest()
+
+# Seconds that tokens, and tokens that don't exist, are remembered for
+# without looking them up again, see TokenStore
+DEFAULT_TOKEN_CACHE_TTL = 60
+DEFAULT_TOKEN_CACHE_SIZE = 10000
+
+# Seconds' worth of requests at its rate that a token can make at once, see RateLimiter
+DEFAULT_RATE_BURST = 10
+
+# Lookups of tokens that don't exist allowed per second from each client
+# address, after a burst of DEFAULT_RATE_BURST seconds' worth, see TokenStore
+DEFAULT_FAILED_LOOKUP_RATE = 1
+
+# Quotas are for the number of requests per QUOTA_WINDOW seconds, a UTC day.
+# Each worker adds its counts to the shared ones at most every
+# LEDGERMAN_QUOTA_SYNC seconds, see QuotaCounter.
+QUOTA_WINDOW = 86400
+DEFAULT_QUOTA_SYNC = 1
+
+# Routes are limited separately for reading, writing and bulk operations
+ROUTE_CLASSES = ('read', 'write', 'bulk')
+
+log = logging.getLogger(__name__)
+
+
+class ApiToken(LedgermanModel):
+    """A client's API token and its limits. Only a hash of the token is kept.
+
+    Each route class has a rate, in requests per second, and a quota of
+    requests per day; null means unlimited. Only admin tokens can use the
+    /admin routes, which export and import the whole database."""
+    tokenHash = StringCol(length=64, unique=True)
+    name = UnicodeCol()
+    active = BoolCol(default=True)
+    admin = BoolCol(default=False)
+    readRate = FloatCol(default=None)
+    writeRate = FloatCol(default=None)
+    bulkRate = FloatCol(default=None)
+    readQuota = IntCol(default=None)
+    writeQuota = IntCol(default=None)
+    bulkQuota = IntCol(default=None)
+
+
+class TokenLimits(object):
+    """The limits of a token, by route class, and whether it's an admin token"""
+
+    def __init__(self, tokenId, rates, quotas, admin=False):
+        self.tokenId = tokenId
+        self.rates = rates
+        self.quotas = quotas
+        self.admin = admin
+
+
+class TooManyFailures(Exception):
+    """Raised by TokenStore.lookup() when a client has tried too many tokens
+    that don't exist, with the seconds until it can try again"""
+
+    def __init__(self, wait):
+        super(TooManyFailures, self).__init__(wait)
+        self.wait = wait
+
+
+def hash_token(token):
+    return hashlib.sha256(token).hexdigest()
+
+
+class TokenStore(object):
+    """Looks up the limits of API tokens, remembering them for ttl seconds so
+    most requests don't have to read the api_token table.
+
+    Valid tokens, and tokens that don't exist or were revoked, are kept in
+    separate LRUs of up to maxSize each, so clients trying made up tokens
+    can't push out the ones in use. Each client address can only look up
+    failedRate tokens that don't exist per second, after a burst; beyond
+    that lookup() raises TooManyFailures without reading the table.
+
+    Changes to tokens are published to every worker, which forget them, see
+    revoke(). Without shared state, other workers keep using their cached
+    copy until it expires."""
+
+    def __init__(self, ttl=DEFAULT_TOKEN_CACHE_TTL, maxSize=DEFAULT_TOKEN_CACHE_SIZE, state=None,
+                 failedRate=DEFAULT_FAILED_LOOKUP_RATE, burst=DEFAULT_RATE_BURST):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.state = state
+        self.failedRate = failedRate
+        self.entries = OrderedDict()
+        self.unknown = OrderedDict()
+        self.failures = RateLimiter(burst)
+        self.lock = threading.Lock()
+        if state is not None:
+            state.subscribe(TOKEN_CHANNEL, self.changed_elsewhere)
+
+    def lookup(self, token, address=None):
+        """Returns the TokenLimits of an active token, or None. address is
+        the client's, whose failed lookups are limited."""
+        tokenHash = hash_token(token)
+        now = time.time()
+        with self.lock:
+            for entries in (self.entries, self.unknown):
+                entry = entries.pop(tokenHash, None)
+                if entry is not None and entry[0] > now:
+                    # Re-inserted to mark as most recently used
+                    entries[tokenHash] = entry
+                    return entry[1]
+
+            if address is not None:
+                wait = self.failures.wait(address, self.failedRate, now)
+                if wait:
+                    raise TooManyFailures(wait)
+
+        limits = self.load(tokenHash)
+        with self.lock:
+            entries = self.entries if limits is not None else self.unknown
+            entries[tokenHash] = (now + self.ttl, limits)
+            while len(entries) > self.maxSize:
+                entries.popitem(last=False)
+
+            if limits is None and address is not None:
+                self.failures.take(address, self.failedRate, now)
+                if len(self.failures.buckets) > self.maxSize:
+                    self.failures.prune(self.failedRate, now)
+
+        return limits
+
+    def load(self, tokenHash):
+        conn = sqlhub.getConnection()
+        columns = ['id', 'active', 'admin'] + ['{0}Rate'.format(x) for x in ROUTE_CLASSES] + \
+            ['{0}Quota'.format(x) for x in ROUTE_CLASSES]
+        row = conn.queryOne(conn.sqlrepr(sqlbuilder.Select(
+            [getattr(ApiToken.q, name) for name in columns], where=ApiToken.q.tokenHash == tokenHash)))
+        if row is None or not row[1]:
+            return None
+
+        count = len(ROUTE_CLASSES)
+        return TokenLimits(row[0], dict(zip(ROUTE_CLASSES, row[3:3 + count])),
+                           dict(zip(ROUTE_CLASSES, row[3 + count:])), bool(row[2]))
+
+    def discard(self, tokenHash):
+        with self.lock:
+            self.entries.pop(tokenHash, None)
+            self.unknown.pop(tokenHash, None)
+
+    def changed_elsewhere(self, tokenHashes):
+        for tokenHash in tokenHashes:
+            self.discard(str(tokenHash))
+
+    def create(self, name, rates=None, quotas=None, admin=False):
+        """Adds a token with the given rates and quotas, by route class, and
+        returns it. It can't be found out again."""
+        token = binascii.hexlify(os.urandom(16))
+        attrs = dict(('{0}Rate'.format(k), v) for k, v in (rates or {}).iteritems())
+        attrs.update(('{0}Quota'.format(k), v) for k, v in (quotas or {}).iteritems())
+        ApiToken(tokenHash=hash_token(token), name=name, admin=admin, **attrs)
+        return token
+
+    def update(self, tokenId, **attrs):
+        """Changes a token, e.g. active=False to revoke it, or its limits"""
+        apiToken = ApiToken.get(tokenId)
+        apiToken.set(**attrs)
+        self.discard(apiToken.tokenHash)
+        if self.state is not None:
+            self.state.publish(TOKEN_CHANNEL, [apiToken.tokenHash])
+
+    def revoke(self, tokenId):
+        self.update(tokenId, active=False)
+
+
+class RateLimiter(object):
+    """A token bucket for each token and route class in this worker.
+
+    A bucket holds up to burst seconds' worth of requests at the rate, and
+    refills continuously. Buckets are updated without a lock: the worst a
+    race between threads can do is let an extra request through."""
+
+    def __init__(self, burst=DEFAULT_RATE_BURST):
+        self.burst = burst
+        self.buckets = {}
+
+    def take(self, key, rate, now):
+        """Takes a request from key's bucket and returns 0, or returns the
+        seconds until there's one to take"""
+        capacity = max(1.0, rate * self.burst)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets.setdefault(key, [capacity, now])
+
+        available = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        if available < 1:
+            return (1 - available) / rate
+
+        bucket[0] = available - 1
+        bucket[1] = now
+        return 0
+
+    def wait(self, key, rate, now):
+        """Returns the seconds until there's a request in key's bucket, or 0
+        if there's one now, without taking it"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return 0
+
+        available = bucket[0] + (now - bucket[1]) * rate
+        return 0 if available >= 1 else (1 - available) / rate
+
+    def prune(self, rate, now):
+        """Forgets the buckets that have filled up again, which are the same
+        as having none"""
+        capacity = max(1.0, rate * self.burst)
+        self.buckets = dict((key, bucket) for key, bucket in self.buckets.iteritems()
+                            if bucket[0] + (now - bucket[1]) * rate < capacity)
+
+
+class QuotaCounter(object):
+    """Counts each token's requests by route class in the current quota
+    window, across every worker.
+
+    Counting is local and unlocked; every syncInterval seconds a worker adds
+    what it's counted to the shared count, and learns the total. So with
+    several workers a quota can be exceeded by what they count in between."""
+
+    def __init__(self, syncInterval=DEFAULT_QUOTA_SYNC, state=None):
+        self.syncInterval = syncInterval
+        self.state = state
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, quota, now):
+        """Counts a request against key's quota and returns 0, or returns the
+        seconds until the quota is reset"""
+        window = int(now // QUOTA_WINDOW)
+        entry = self.counts.get(key)
+        if entry is None or entry[0] != window:
+            # [window, total when last synced, counted since, last synced]
+            entry = self.counts[key] = [window, self.shared_count(key, window), 0, 0]
+
+        if entry[1] + entry[2] >= quota:
+            return (window + 1) * QUOTA_WINDOW - now
+
+        entry[2] += 1
+        if now - entry[3] >= self.syncInterval:
+            self.sync(key, entry, now)
+        return 0
+
+    def shared_count(self, key, window):
+        """Returns what every worker has counted so far in window"""
+        try:
+            return self.state.get(self.shared_key(key, window))
+        except Exception as ex:
+            log.warning('Reading quotas failed: %s', ex)
+            return 0
+
+    def shared_key(self, key, window):
+        return 'quota:{0}:{1}:{2}'.format(key[0], key[1], window)
+
+    def sync(self, key, entry, now):
+        with self.lock:
+            counted, entry[2] = entry[2], 0
+            entry[3] = now
+            try:
+                entry[1] = self.state.incr(self.shared_key(key, entry[0]), counted, QUOTA_WINDOW * 2)
+            except Exception as ex:
+                log.warning('Counting quotas failed: %s', ex)
+                entry[2] += counted
+
+
+def check_limits(limits, routeClass, now=None):
+    """Counts a request by the token with limits to a route of routeClass.
+    Returns None if it's allowed, or a description of the limit it exceeds
+    and the seconds until it can be retried."""
+    if now is None:
+        now = time.time()
+
+    key = (limits.tokenId, routeClass)
+    rate = limits.rates.get(routeClass)
+    if rate is not None:
+        wait = rateLimiter.take(key, rate, now) if rate > 0 else QUOTA_WINDOW
+        if wait:
+            return 'Rate limit of {0:g} {1} requests per second exceeded'.format(rate, routeClass), wait
+
+    quota = limits.quotas.get(routeClass)
+    if quota is not None:
+        wait = quotaCounter.take(key, quota, now)
+        if wait:
+            return 'Daily quota of {0} {1} requests used up'.format(quota, routeClass), wait
+
+    return None
+
+
+tokenStore = TokenStore(
+    float(os.environ.get('LEDGERMAN_TOKEN_CACHE_TTL', DEFAULT_TOKEN_CACHE_TTL)), state=sharedState,
+    failedRate=float(os.environ.get('LEDGERMAN_FAILED_TOKEN_RATE', DEFAULT_FAILED_LOOKUP_RATE)),
+    burst=float(os.environ.get('LEDGERMAN_RATE_BURST', DEFAULT_RATE_BURST)))
+rateLimiter = RateLimiter(float(os.environ.get('LEDGERMAN_RATE_BURST', DEFAULT_RATE_BURST)))
+quotaCounter = QuotaCounter(float(os.environ.get('LEDGERMAN_QUOTA_SYNC', DEFAULT_QUOTA_SYNC)), sharedState)
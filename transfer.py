@@ -0,0 +1,334 @@
+from archive import iter_events
+from cache import invalidate_row, responseCache
+from collections import OrderedDict
+from feed import feedHub
+from metrics import add_serialize_time
+from models import Achievement, AchievementType, Game, GameEvent, Player, load_json, sqlhub, transaction
+from sqlobject import SOBoolCol, SOForeignKey, SOStringLikeCol
+from stats import StatsDelta
+from writebehind import insert_events
+import csv
+import logging
+import StringIO
+import time
+import versions
+
+# The models that can be exported and imported, by the name used for them on
+# the command line and in /admin/export/{model}, with their JSON type. In the
+# order to import them in, so foreign keys point at rows that already exist.
+MODELS = OrderedDict([
+    ('players', (Player, 'player')),
+    ('games', (Game, 'game')),
+    ('achievement-types', (AchievementType, 'achievement-type')),
+    ('events', (GameEvent, 'event')),
+    ('achievements', (Achievement, 'achievement')),
+])
+
+FORMATS = ('ndjson', 'csv')
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv; charset=utf-8'}
+
+# Rows read from the database at once when exporting, and written in one
+# transaction when importing
+EXPORT_PAGE_SIZE = 1000
+DEFAULT_IMPORT_CHUNK_SIZE = 1000
+
+# Errors reported by import_rows(), the rest are only counted
+MAX_IMPORT_ERRORS = 100
+
+log = logging.getLogger(__name__)
+
+
+def get_model(name):
+    if not MODELS.has_key(name):
+        raise ValueError("Unknown model '{0}', should be one of {1}".format(name, ', '.join(MODELS)))
+    return MODELS[name]
+
+
+def check_format(fmt):
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format '{0}', should be one of {1}".format(fmt, ', '.join(FORMATS)))
+    return fmt
+
+
+def export_rows(name, fmt, chunkSize=16384):
+    """Generates every object of the model name in id order, in chunks of
+    roughly chunkSize bytes, as NDJSON (one object per line, as the API
+    returns them) or CSV (a header of 'id' and the dashed attribute names).
+
+    Rows are read a page at a time, so memory use doesn't grow with the
+    number of objects. Archived events are included."""
+    sqlObj, typeString = get_model(name)
+    rows = iter_events(EXPORT_PAGE_SIZE) if sqlObj is GameEvent else sqlObj.iter_rows(pageSize=EXPORT_PAGE_SIZE)
+    writer = sqlObj.row_writer(None, typeString)
+
+    if check_format(fmt) == 'ndjson':
+        encode = lambda row: writer.to_json(row) + '\n'
+    else:
+        encode = csv_encoder(sqlObj)
+        yield csv_line(['id'] + writer.names)
+
+    chunk = []
+    size = 0
+    elapsed = 0
+    for row in rows:
+        started = time.time()
+        encoded = encode(row)
+        elapsed += time.time() - started
+        chunk.append(encoded)
+        size += len(encoded)
+
+        if size >= chunkSize:
+            add_serialize_time(elapsed)
+            elapsed = 0
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+
+    add_serialize_time(elapsed)
+    if chunk:
+        yield ''.join(chunk)
+
+
+def csv_encoder(sqlObj):
+    """Returns a function that formats a row as a line of CSV. Nulls are
+    empty cells, and booleans 'true' or 'false'."""
+    converters = [None] + [sqlObj.rowFormats[col.name][1] for col in sqlObj.sqlmeta.columnList]
+
+    def encode(row):
+        values = []
+        for convert, value in zip(converters, row):
+            if value is None:
+                value = ''
+            elif convert is not None:
+                value = convert(value)
+
+            if value is True or value is False:
+                value = 'true' if value else 'false'
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            values.append(value)
+
+        return csv_line(values)
+
+    return encode
+
+
+def csv_line(values):
+    buf = StringIO.StringIO()
+    csv.writer(buf, lineterminator='\n').writerow(values)
+    return buf.getvalue()
+
+
+def iter_lines(stream, blockSize=65536):
+    """Generates the lines of a file-like stream, reading it in blocks. WSGI
+    input can't always be iterated over, or read a line at a time."""
+    rest = ''
+    while True:
+        block = stream.read(blockSize)
+        if not block:
+            break
+
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    if rest:
+        yield rest
+
+
+def read_ndjson(lines):
+    """Generates the (line number, JSON object) of each non-blank line"""
+    for lineNo, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield lineNo, load_json(line)
+            except ValueError as ex:
+                yield lineNo, ex
+
+
+def read_csv(lines, sqlObj, typeString):
+    """Generates the (line number, JSON object) of each row of CSV written by
+    export_rows(), or a ValueError for rows that can't be converted"""
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+
+    parsers = [column_parser(sqlObj, name) for name in header]
+    for row in reader:
+        if not row:
+            continue
+
+        if len(row) != len(header):
+            yield reader.line_num, ValueError('Expected {0} values, not {1}'.format(len(header), len(row)))
+            continue
+
+        jsonObj = {'type': typeString, 'attributes': {}}
+        try:
+            for (name, parse), value in zip(parsers, row):
+                value = None if value == '' else parse(name, value)
+                if name == 'id':
+                    jsonObj['id'] = value
+                else:
+                    jsonObj['attributes'][name] = value
+        except ValueError as ex:
+            yield reader.line_num, ex
+            continue
+
+        yield reader.line_num, jsonObj
+
+
+def column_parser(sqlObj, name):
+    """Returns the name of a CSV column and the function that converts its
+    non-empty cells to the JSON value parse_json_object() expects"""
+    parser = sqlObj.attrParsers.get(name)
+    col = sqlObj.sqlmeta.columns[parser[0]] if parser is not None else None
+    if name == 'id' or isinstance(col, SOForeignKey):
+        return name, sqlObj.parse_id_value
+    elif isinstance(col, SOBoolCol):
+        return name, parse_bool
+    elif isinstance(col, SOStringLikeCol):
+        return name, lambda attrName, value: value.decode('utf-8')
+    return name, lambda attrName, value: value
+
+
+def parse_bool(attrName, value):
+    if value not in ('true', 'false'):
+        raise ValueError("'{0}' must be true or false".format(attrName))
+    return value == 'true'
+
+
+def import_rows(name, lines, fmt, chunkSize=DEFAULT_IMPORT_CHUNK_SIZE):
+    """Loads objects of the model name from lines of NDJSON or CSV, as
+    written by export_rows(), in transactions of chunkSize objects.
+
+    Objects keep their id if they have one. The foreign keys of each chunk
+    are looked up together, rather than one object at a time; objects that
+    are invalid or point at missing rows are skipped and reported, the rest
+    are written with stats and caches updated as if they'd been posted.
+    Returns a dict of the number imported, the number that failed, and the
+    first MAX_IMPORT_ERRORS errors by line number."""
+    sqlObj, typeString = get_model(name)
+    if check_format(fmt) == 'ndjson':
+        objs = read_ndjson(lines)
+    else:
+        objs = read_csv(lines, sqlObj, typeString)
+
+    result = {'imported': 0, 'failed': 0, 'errors': []}
+    withIds = False
+    chunk = []
+    for lineNo, jsonObj in objs:
+        chunk.append((lineNo, jsonObj))
+        if len(chunk) >= chunkSize:
+            withIds = import_chunk(sqlObj, typeString, chunk, result) or withIds
+            chunk = []
+
+    if chunk:
+        withIds = import_chunk(sqlObj, typeString, chunk, result) or withIds
+
+    if withIds:
+        reset_id_sequence(sqlObj)
+
+    return result
+
+
+def import_chunk(sqlObj, typeString, chunk, result):
+    """Validates and writes one chunk of import_rows(), and returns whether
+    any of it was written with ids"""
+    parsed = []
+    for lineNo, jsonObj in chunk:
+        try:
+            if isinstance(jsonObj, Exception):
+                raise jsonObj
+            resourceId = jsonObj.get('id')
+            if resourceId is not None:
+                resourceId = sqlObj.parse_id_value('id', resourceId)
+            parsed.append((lineNo, resourceId, sqlObj.parse_json_object(jsonObj, typeString, checkKeys=False)))
+        except (ValueError, AttributeError, KeyError) as ex:
+            add_error(result, lineNo, ex)
+
+    fkCache = {}
+    sqlObj.load_foreign_keys([attrs for lineNo, resourceId, attrs in parsed], fkCache)
+
+    rows = ([], [])
+    for lineNo, resourceId, attrs in parsed:
+        try:
+            sqlObj.check_foreign_keys(attrs, fkCache)
+            row = sqlObj.to_row(attrs)
+        except ValueError as ex:
+            add_error(result, lineNo, ex)
+            continue
+
+        if resourceId is None:
+            rows[0].append((attrs, row))
+        else:
+            rows[1].append((attrs, (resourceId,) + row))
+
+    try:
+        commit_chunk(sqlObj, rows)
+    except Exception as ex:
+        # e.g. an id that's already taken
+        log.exception('Importing lines %d-%d failed', chunk[0][0], chunk[-1][0])
+        result['failed'] += len(rows[0]) + len(rows[1])
+        add_error(result, chunk[0][0], 'Lines {0}-{1} were not imported: {2}'.format(
+            chunk[0][0], chunk[-1][0], ex), count=False)
+        return False
+
+    result['imported'] += len(rows[0]) + len(rows[1])
+    return bool(rows[1])
+
+
+def add_error(result, lineNo, ex, count=True):
+    if count:
+        result['failed'] += 1
+    if len(result['errors']) < MAX_IMPORT_ERRORS:
+        result['errors'].append({'line': lineNo, 'title': 'Bad Request', 'description': str(ex)})
+
+
+def commit_chunk(sqlObj, rows):
+    """Writes the (attrs, row) pairs without and with ids in one transaction,
+    holding back cache invalidations and feed updates until it commits, like
+    TransactionMiddleware"""
+    responseCache.track_pending()
+    versions.track_pending()
+    feedHub.track_pending()
+    try:
+        with transaction() as trans:
+            for withIds, objs in enumerate(rows):
+                if objs:
+                    insert_objects(sqlObj, objs, trans, bool(withIds))
+        versions.write_pending()
+        feedHub.publish_pending()
+    finally:
+        versions.discard_pending()
+        feedHub.discard_pending()
+        responseCache.invalidate_pending()
+
+
+def insert_objects(sqlObj, objs, trans, withIds):
+    """Inserts (attrs, row) pairs with bulk_insert(), updating stats and
+    caches as creating them through the API would"""
+    if sqlObj is GameEvent:
+        insert_events(objs, trans, withIds)
+        return
+
+    sqlObj.bulk_insert([row for attrs, row in objs], trans, withIds)
+
+    delta = StatsDelta()
+    for attrs, row in objs:
+        invalidate_row(sqlObj, None, attrs)
+        if sqlObj is Game:
+            delta.add_win(attrs['winnerID'])
+        elif sqlObj is Achievement:
+            delta.add_achievement(attrs['playerID'])
+    delta.apply(trans)
+
+
+def reset_id_sequence(sqlObj):
+    """Moves PostgreSQL's id sequence past ids that were inserted explicitly.
+    SQLite and MySQL already carry on from the largest id."""
+    conn = sqlhub.getConnection()
+    if conn.dbName == 'postgres':
+        conn.query("SELECT setval(pg_get_serial_sequence('{0}', '{1}'), (SELECT MAX({1}) FROM {0}))".format(
+            sqlObj.sqlmeta.table, sqlObj.sqlmeta.idName))
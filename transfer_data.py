@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# Exports the objects of a model to NDJSON or CSV, or imports them, see
+# transfer.py. For example, to copy a database:
+#
+#   python transfer_data.py --db old.db export players > players.ndjson
+#   python transfer_data.py --db new.db import players players.ndjson
+#
+# The database defaults to LEDGERMAN_DB, as for the server. Import models in
+# the order export lists them, so foreign keys point at existing rows.
+from models import init_db
+from transfer import DEFAULT_IMPORT_CHUNK_SIZE, FORMATS, MODELS, export_rows, import_rows
+import argparse
+import json
+import logging
+import sys
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export or import Ledgerman data')
+    parser.add_argument('--db', help='database to use (default: LEDGERMAN_DB)')
+    parser.add_argument('--format', choices=FORMATS, help='file format (default: from the extension, or ndjson)')
+    commands = parser.add_subparsers(dest='command')
+    exportParser = commands.add_parser('export', help='write every object of a model to stdout')
+    exportParser.add_argument('model', choices=list(MODELS))
+    importParser = commands.add_parser('import', help='load objects of a model from a file, or - for stdin')
+    importParser.add_argument('model', choices=list(MODELS))
+    importParser.add_argument('file')
+    importParser.add_argument('--chunk-size', type=int, default=DEFAULT_IMPORT_CHUNK_SIZE,
+                              help='objects written per transaction')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    init_db(args.db)
+    if args.command == 'export':
+        for chunk in export_rows(args.model, args.format or 'ndjson'):
+            sys.stdout.write(chunk)
+        sys.exit(0)
+
+    fmt = args.format or ('csv' if args.file.endswith('.csv') else 'ndjson')
+    lines = sys.stdin if args.file == '-' else open(args.file, 'rb')
+    result = import_rows(args.model, lines, fmt, args.chunk_size)
+    for error in result['errors']:
+        sys.stderr.write('line {0}: {1}\n'.format(error['line'], error['description']))
+    print json.dumps({'imported': result['imported'], 'failed': result['failed']})
+    sys.exit(1 if result['failed'] else 0)
@@ -0,0 +1,101 @@
+from datetime import datetime
+from models import sqlhub
+import logging
+import threading
+import time
+
+# Writes made while a request's transaction is open are collected here, per
+# thread, and written once each after it commits
+local = threading.local()
+
+log = logging.getLogger(__name__)
+
+
+def group_key(group):
+    """Converts a group, e.g. ('Game', 1, 'events'), to its resource_version key"""
+    return ':'.join(str(x) for x in group)
+
+
+def touch(group):
+    """Records that the responses in group have changed, see cache.invalidate()"""
+    pending = getattr(local, 'pending', None)
+    if pending is not None:
+        pending.add(group)
+    else:
+        write_versions([group], sqlhub.getConnection())
+
+
+def track_pending():
+    """Starts collecting this thread's touch()es for write_pending()"""
+    local.pending = set()
+
+
+def write_pending(conn=None):
+    """Writes the versions touched while the transaction was open. Called
+    once it has committed, so the shared version rows are only locked for
+    one statement, not for the whole of every write transaction.
+
+    Clients can be told a version has changed a moment before it shows up,
+    never before the change it stands for."""
+    pending = getattr(local, 'pending', None)
+    local.pending = None
+    if not pending:
+        return
+
+    try:
+        write_versions(pending, conn or sqlhub.getConnection())
+    except Exception as ex:
+        # The write has committed, so it mustn't fail now
+        log.warning('Writing versions failed: %s', ex)
+
+
+def discard_pending():
+    local.pending = None
+
+
+def write_versions(groups, conn):
+    """Increments the version of each group and sets its modified time to
+    now, in one statement. Rows are always written in the same order, so
+    concurrent writers can't deadlock on them."""
+    modified = int(time.time() * 1000000)
+    keys = sorted(group_key(group) for group in groups)
+    conn.query(
+        'INSERT INTO resource_version (resource, version, modified) VALUES {0} '
+        'ON CONFLICT (resource) DO UPDATE SET version = resource_version.version + 1, '
+        'modified = {1}'.format(', '.join('({0}, 1, {1})'.format(conn.sqlrepr(key), modified) for key in keys),
+                                modified))
+
+
+def get_version(group):
+    """Returns the version of group and the time it was last modified as a
+    UTC datetime, or (0, None) if it's never been written"""
+    conn = sqlhub.getConnection()
+    row = conn.queryOne('SELECT version, modified FROM resource_version WHERE resource = {0}'.format(
+        conn.sqlrepr(group_key(group))))
+    if row is None:
+        return 0, None
+
+    return row[0], datetime.utcfromtimestamp(row[1] / 1000000.0)
+
+
+def etag(version, modified, variant=''):
+    """Returns the ETag of a version, with a suffix for each representation
+    of it other than the default, e.g. '-columns' for parallel arrays"""
+    if modified is None:
+        return '"0{0}"'.format(variant)
+    return '"{0}-{1}{2}"'.format(version, modified.strftime('%Y%m%d%H%M%S%f'), variant)
+
+
+def not_modified(req, version, modified, variant=''):
+    """Returns whether the conditional headers of req match the given
+    version, so the response would be 304 Not Modified"""
+    if req.if_none_match is not None:
+        tags = [x.strip() for x in req.if_none_match.split(',')]
+        tags = [x[2:] if x.startswith('W/') else x for x in tags]
+        return '*' in tags or etag(version, modified, variant) in tags
+
+    since = req.if_modified_since
+    if since is not None and modified is not None:
+        return modified.replace(microsecond=0) <= since
+
+    return False
@@ -0,0 +1,234 @@
+from cache import responseCache, invalidate_join, invalidate_row
+from feed import feedHub
+from models import IN, Game, GameEvent, Player, transaction
+from stats import StatsDelta
+import atexit
+import itertools
+import logging
+import models
+import os
+import Queue
+import threading
+import time
+import versions
+
+# Largest number of events written by one group commit
+MAX_WRITE_BATCH = 1000
+
+# Number of events that can wait to be written before POST /events goes back
+# to writing them itself
+DEFAULT_WRITE_QUEUE_SIZE = 10000
+
+STOP = object()
+
+log = logging.getLogger(__name__)
+
+
+def insert_events(events, trans, withIds=False):
+    """Writes events, given as (attrs, row) pairs from parse_json_payload()
+    and GameEvent.to_row(), in trans with a single INSERT. Players are added
+    to the games they join, and stats, cached responses and watchers are
+    updated to match. With withIds, each row starts with the event's id."""
+    gameIds = set()
+    joins = set()
+    delta = StatsDelta()
+    for attrs, row in events:
+        invalidate_row(GameEvent, None, attrs)
+        gameIds.add(attrs['gameID'])
+        delta.add_event(attrs)
+        if attrs['eventType'] == 'joined':
+            joins.add((attrs['gameID'], attrs['playerID']))
+
+    GameEvent.bulk_insert([row for attrs, row in events], trans, withIds)
+
+    # Mark when players join, same as for single events
+    for gameId, playerId in joins:
+        game = Game.get(gameId, connection=trans)
+        player = Player.get(playerId, connection=trans)
+        if player not in game.players:
+            game.addPlayer(player)
+            invalidate_join(Game, gameId, 'players', playerId)
+            delta.add_join(gameId, playerId)
+
+    delta.apply(trans)
+
+    # The new events' ids aren't known, so watchers read them back
+    for gameId in gameIds:
+        feedHub.publish(gameId)
+
+
+def check_events(events, trans):
+    """Splits events, given as for insert_events(), into those that are still
+    valid and those that aren't any more, e.g. because their game ended or a
+    player was deleted since they were queued. Every foreign key is looked up
+    in trans, with one query per foreign class, rather than trusting
+    existingIds. Returns the valid events, and (attrs, message) pairs for the
+    invalid ones."""
+    found = {}
+    for col in GameEvent.foreignKeys:
+        ids = set(attrs[col.name] for attrs, row in events if attrs.get(col.name) is not None)
+        if ids:
+            sqlObj = getattr(models, col.foreignKey)
+            for obj in sqlObj.select(IN(sqlObj.q.id, list(ids)), connection=trans):
+                found[(col.foreignKey, obj.id)] = obj
+
+    valid = []
+    invalid = []
+    for attrs, row in events:
+        missing = [col.name for col in GameEvent.foreignKeys
+                   if attrs.get(col.name) is not None and (col.foreignKey, attrs[col.name]) not in found]
+        if missing:
+            invalid.append((attrs, 'No such {0}'.format(', '.join(missing))))
+        elif not found[('Game', attrs['gameID'])].active:
+            invalid.append((attrs, 'Events cannot be created for an inactive game'))
+        else:
+            valid.append((attrs, row))
+
+    return valid, invalid
+
+
+class EventWriter(object):
+    """Writes events in the background, so POST /events can respond as soon
+    as an event is validated.
+
+    A writer thread group-commits the queued events: once an event is queued
+    it waits up to interval seconds for more, then writes them all in one
+    transaction. interval is also how long an acknowledged event can be held
+    in memory, and lost if the process dies. drain() writes everything still
+    queued, and is called when the process exits normally."""
+
+    def __init__(self, interval, queueSize=DEFAULT_WRITE_QUEUE_SIZE):
+        self.interval = interval
+        self.queue = Queue.Queue(queueSize)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+        self.ids = itertools.count(1)
+        self.writing = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+
+    def offer(self, attrs, row):
+        """Queues an event to be written, returning its provisional id, or
+        None if the queue is full or the writer has been drained"""
+        with self.lock:
+            if self.closed:
+                return None
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='event-writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+        try:
+            self.queue.put_nowait((attrs, row))
+        except Queue.Full:
+            return None
+
+        # Unique across worker processes, but only meaningful to the client
+        return '{0}-{1}'.format(os.getpid(), next(self.ids))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                return
+
+            events = [item]
+            stop = False
+            deadline = time.time() + self.interval
+            while len(events) < MAX_WRITE_BATCH:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+
+                if item is STOP:
+                    stop = True
+                    break
+                events.append(item)
+
+            self.write(events)
+            if stop:
+                return
+
+    def write(self, events):
+        self.writing = len(events)
+        try:
+            written = self.commit(events)
+            self.batches += 1
+            self.written += written
+            self.failed += len(events) - written
+        except Exception:
+            # Retried one at a time, so only the events that can't be
+            # written are lost
+            log.exception('Writing %d events failed, retrying them one by one', len(events))
+            for event in events:
+                try:
+                    written = self.commit([event])
+                    self.written += written
+                    self.failed += 1 - written
+                except Exception:
+                    log.exception('Dropped event %r', event[0])
+                    self.failed += 1
+        finally:
+            self.writing = 0
+
+    def commit(self, events):
+        """Writes the events that are still valid in one transaction, logging
+        and dropping the others, see check_events(). Cache invalidations and
+        feed updates are held back until it commits, like
+        TransactionMiddleware. Returns the number of events written."""
+        responseCache.track_pending()
+        versions.track_pending()
+        feedHub.track_pending()
+        try:
+            with transaction() as trans:
+                events, invalid = check_events(events, trans)
+                if events:
+                    insert_events(events, trans)
+            versions.write_pending()
+            feedHub.publish_pending()
+        finally:
+            versions.discard_pending()
+            feedHub.discard_pending()
+            responseCache.invalidate_pending()
+
+        for attrs, message in invalid:
+            log.warning('Dropped event %r: %s', attrs, message)
+        return len(events)
+
+    def drain(self, timeout=None):
+        """Stops queueing events and waits for the ones already queued to be written"""
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+
+        if thread is not None:
+            self.queue.put(STOP)
+            thread.join(timeout)
+
+    def counters(self):
+        return {'depth': self.queue.qsize() + self.writing, 'written': self.written,
+                'failed': self.failed, 'batches': self.batches}
+
+
+def init_writer():
+    """Returns an EventWriter if LEDGERMAN_WRITE_BEHIND is set to a flush
+    interval in milliseconds, or None to write events as they're posted"""
+    interval = int(os.environ.get('LEDGERMAN_WRITE_BEHIND', 0))
+    if interval <= 0:
+        return None
+
+    writer = EventWriter(interval / 1000.0,
+                         int(os.environ.get('LEDGERMAN_WRITE_QUEUE_SIZE', DEFAULT_WRITE_QUEUE_SIZE)))
+    atexit.register(writer.drain)
+    return writer
+
+
+eventWriter = init_writer()